@@ -0,0 +1,177 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from usage_store import UsageStore, usage_key, seconds_until_next_period
+from config import (
+    RATE_LIMIT_PER_KEY_PER_MINUTE,
+    RATE_LIMIT_PER_KEY_BURST,
+    RATE_LIMIT_GLOBAL_PER_SECOND,
+    RATE_LIMIT_GLOBAL_BURST,
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_MAX_WAITING,
+    ADMISSION_QUEUE_TIMEOUT_SECONDS,
+    USAGE_MAX_KEYS,
+    SERVER_WORKERS
+)
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a request is turned away; main.py maps it to a 429 with Retry-After.
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, retry_after)
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to `capacity` tokens, refilled at `rate` per second.
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def try_take(self, amount: float = 1.0) -> float:
+        """
+        Take `amount` tokens if available and return 0, otherwise return the
+        number of seconds until they will be.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+class AdmissionController:
+    """
+    Decide up front whether a request may go upstream, so callers over their
+    limits get an immediate 429 instead of a slow provider error.
+
+    Checks, in order: the key's recorded usage plus the projected prompt cost
+    against its quota, the per-key and global token buckets, and finally a
+    bounded queue for one of max_in_flight upstream slots.
+
+    The server's own key (server_key) is exempt from the per-key checks: keyless
+    learners fall back to it, and quiz bank refills and warm-ups are charged to
+    it, so a per-key quota on it would lock every keyless learner out once the
+    background work had used it up. Only the global limits apply to it.
+    """
+
+    def __init__(
+        self,
+        usage_store: UsageStore,
+        quota_limit: int,
+        server_key: Optional[str] = None,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        max_waiting: int = ADMISSION_MAX_WAITING,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT_SECONDS
+    ):
+        self.usage_store = usage_store
+        self.quota_limit = quota_limit
+        self.server_key = server_key
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        # The global limit is for the whole server, so each worker process enforces its share
+        self._global_bucket = TokenBucket(RATE_LIMIT_GLOBAL_PER_SECOND / SERVER_WORKERS, max(1, RATE_LIMIT_GLOBAL_BURST // SERVER_WORKERS))
+        self._key_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.in_flight = 0
+        self.rejected = 0
+
+    def _key_bucket(self, api_key: str) -> TokenBucket:
+        key = usage_key(api_key)
+        bucket = self._key_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(RATE_LIMIT_PER_KEY_PER_MINUTE / 60.0, RATE_LIMIT_PER_KEY_BURST)
+            self._key_buckets[key] = bucket
+            while len(self._key_buckets) > USAGE_MAX_KEYS:
+                self._key_buckets.popitem(last=False)
+        else:
+            self._key_buckets.move_to_end(key)
+        return bucket
+
+    def _reject(self, reason: str, retry_after: float) -> None:
+        self.rejected += 1
+        raise AdmissionRejected(reason, math.ceil(retry_after))
+
+    def check(self, api_key: Optional[str], projected_tokens: int = 0) -> None:
+        """
+        The non-blocking part of admission: quota and rate limits.
+        """
+        metered = bool(api_key) and api_key != self.server_key
+        if metered:
+            used = self.usage_store.get(api_key)
+            if used + projected_tokens > self.quota_limit:
+                self._reject("Token quota exhausted for this API key.", seconds_until_next_period())
+
+        with self._lock:
+            if metered:
+                wait = self._key_bucket(api_key).try_take()
+                if wait:
+                    self._reject("Too many requests for this API key.", wait)
+            wait = self._global_bucket.try_take()
+            if wait:
+                self._reject("The server is handling too many requests.", wait)
+
+    async def acquire(self, api_key: Optional[str], projected_tokens: int = 0) -> None:
+        """
+        Admit a request and take an upstream slot; pair with release().
+        """
+        self.check(api_key, projected_tokens)
+        await self._take_slot()
+
+    async def _take_slot(self) -> None:
+        if self.waiting >= self.max_waiting:
+            self._reject("The server is busy. Please try again shortly.", 1)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject("The server is busy. Please try again shortly.", 1)
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._slots.release()
+
+    @asynccontextmanager
+    async def admit(self, api_key: Optional[str], projected_tokens: int = 0) -> AsyncIterator[None]:
+        await self.acquire(api_key, projected_tokens)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        """
+        Hold an upstream slot without the quota and rate checks, for each
+        upstream call of a request that was admitted once with check().
+        """
+        await self._take_slot()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected
+        }
@@ -0,0 +1,267 @@
+"""
+Offline load test for the backend API.
+
+Drives /api/chat, /api/quiz and /api/check-quota at fixed concurrency levels
+and reports p50/p95/p99 latency, requests/s, event-loop lag and the share
+of requests answered without an LLM call as JSON, so runs can be compared
+over time. By default the app runs in-process against
+the fake LLM provider, so no quota is spent.
+
+Run from the backend directory:
+
+    python -m bench.loadtest --scenarios chat quiz check-quota --concurrency 1 8 32 --requests 200 --output bench_results.json
+
+Fake provider timing is configured through the FAKE_LLM_* environment
+variables (see config.py). Pass --url to load-test a running server instead;
+event-loop lag is then not measured.
+"""
+import argparse
+import asyncio
+import hashlib
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+# Must be set before the app is imported
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("USAGE_STORE", "memory")
+os.environ.setdefault("QUIZ_BANK_PATH", ":memory:")
+os.environ.setdefault("RATE_LIMIT_PER_KEY_PER_MINUTE", "1000000")
+os.environ.setdefault("RATE_LIMIT_PER_KEY_BURST", "1000000")
+os.environ.setdefault("RATE_LIMIT_GLOBAL_PER_SECOND", "1000000")
+os.environ.setdefault("RATE_LIMIT_GLOBAL_BURST", "1000000")
+os.environ.setdefault("ADMISSION_MAX_WAITING", "100000")
+os.environ.setdefault("ADMISSION_QUEUE_TIMEOUT_SECONDS", "600")
+
+import httpx
+
+from config import AVAILABLE_TOPICS, AVAILABLE_LANGUAGES, FAMILIARITY_LEVELS, DEFAULT_MODEL
+
+# Every distinct quiz a request can ask for
+QUIZ_VARIANTS = len(AVAILABLE_TOPICS) * len(FAMILIARITY_LEVELS) * len(AVAILABLE_LANGUAGES)
+
+def bench_api_key(index: int) -> str:
+    # A fresh key per request keeps the benchmark clear of the quota check
+    return f"bench-{index:032d}"
+
+def bench_query(index: int) -> str:
+    """
+    A query sharing no words with any other index's, so neither the response
+    cache nor the semantic cache can answer it from an earlier request.
+    """
+    digest = hashlib.sha256(str(index).encode("utf-8")).hexdigest()
+    return " ".join(digest[start:start + 8] for start in range(0, 32, 8))
+
+def quiz_variant(index: int) -> Dict[str, str]:
+    # Mixed radix over topic, level and language: distinct for QUIZ_VARIANTS indexes
+    index, topic = divmod(index, len(AVAILABLE_TOPICS))
+    index, level = divmod(index, len(FAMILIARITY_LEVELS))
+    return {
+        "topic": AVAILABLE_TOPICS[topic],
+        "familiarity_level": FAMILIARITY_LEVELS[level],
+        "language": AVAILABLE_LANGUAGES[index % len(AVAILABLE_LANGUAGES)]
+    }
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    return {
+        "p50": round(percentile(ordered, 50), 3),
+        "p95": round(percentile(ordered, 95), 3),
+        "p99": round(percentile(ordered, 99), 3),
+        "max": round(ordered[-1], 3) if ordered else 0.0,
+        "mean": round(sum(ordered) / len(ordered), 3) if ordered else 0.0
+    }
+
+class LoopLagMonitor:
+    """
+    Measures how late a periodic timer fires; a blocked event loop shows up
+    directly as lag.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected) * 1000)
+
+    def start(self) -> None:
+        self.samples = []
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+def build_request(scenario: str, index: int, repeat: bool) -> Dict[str, Any]:
+    """
+    Indexes are unique across the whole run, so unless --repeat is given no
+    request, in any level, repeats an earlier one and the results measure
+    generation rather than cache hits.
+    """
+    if scenario == "check-quota":
+        return {"path": "/api/check-quota", "json": {"api_key": bench_api_key(index)}}
+    body = {
+        "topic": AVAILABLE_TOPICS[index % len(AVAILABLE_TOPICS)],
+        "language": "English",
+        "model": DEFAULT_MODEL,
+        "query": "" if repeat else bench_query(index),
+        "familiarity_level": "Novice",
+        "conversation_mode": "Informative",
+        "api_key": bench_api_key(index)
+    }
+    if scenario == "quiz" and not repeat:
+        body.update(quiz_variant(index))
+    return {"path": "/api/chat" if scenario == "chat" else "/api/quiz", "json": body}
+
+async def cache_counters(client: httpx.AsyncClient) -> Dict[str, int]:
+    stats = (await client.get("/api/stats")).json()
+    return {
+        "upstream_calls": stats["single_flight"]["upstream_calls"],
+        "response_cache_hits": stats["response_cache"]["hits"],
+        "semantic_cache_hits": stats["semantic_cache"]["hits"]
+    }
+
+def cache_report(before: Dict[str, int], after: Dict[str, int], requests: int) -> Dict[str, Any]:
+    """
+    How the level's requests were answered; hit_ratio is the share that
+    never reached the LLM (cache, quiz bank or a shared in-flight call).
+    """
+    report = {name: after[name] - before[name] for name in after}
+    report["hit_ratio"] = round(max(0.0, 1 - report["upstream_calls"] / requests), 3) if requests else 0.0
+    return report
+
+async def run_level(
+    client: httpx.AsyncClient,
+    scenario: str,
+    concurrency: int,
+    total: int,
+    repeat: bool,
+    monitor: Optional[LoopLagMonitor],
+    indexes: Iterator[int]
+) -> Dict[str, Any]:
+    latencies: List[float] = []
+    status_codes: Dict[str, int] = {}
+    errors = 0
+    counter = itertools.count()
+
+    async def worker() -> None:
+        nonlocal errors
+        while next(counter) < total:
+            request = build_request(scenario, next(indexes), repeat)
+            started = time.perf_counter()
+            try:
+                response = await client.post(request["path"], json=request["json"])
+                code = str(response.status_code)
+                body = response.json()
+                if response.status_code != 200 or body.get("error"):
+                    errors += 1
+            except Exception:
+                code = "exception"
+                errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+            status_codes[code] = status_codes.get(code, 0) + 1
+
+    counters = await cache_counters(client) if scenario != "check-quota" else None
+    if monitor is not None:
+        monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration = time.perf_counter() - started
+    if monitor is not None:
+        await monitor.stop()
+
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "status_codes": status_codes,
+        "duration_s": round(duration, 3),
+        "requests_per_s": round(total / duration, 2) if duration else 0.0,
+        "latency_ms": summarize(latencies)
+    }
+    if counters is not None:
+        result["cache"] = cache_report(counters, await cache_counters(client), total)
+    if monitor is not None:
+        result["loop_lag_ms"] = summarize(monitor.samples)
+    return result
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+        monitor = None
+    else:
+        from main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=args.timeout)
+        monitor = LoopLagMonitor()
+
+    if "quiz" in args.scenarios and not args.repeat and args.requests * len(args.concurrency) > QUIZ_VARIANTS:
+        print(f"warning: only {QUIZ_VARIANTS} distinct quizzes, later quiz requests repeat earlier ones", file=sys.stderr)
+
+    results = []
+    # Shared by every level, so no level reuses an earlier level's requests
+    indexes = itertools.count()
+    async with client:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = await run_level(client, scenario, concurrency, args.requests, args.repeat, monitor, indexes)
+                results.append(result)
+                hit_ratio = f" cache_hits={result['cache']['hit_ratio']:.1%}" if "cache" in result else ""
+                print(
+                    f"{scenario:12} c={concurrency:<4} {result['requests_per_s']:>8} req/s  "
+                    f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+                    f"p99={result['latency_ms']['p99']}ms errors={result['errors']}{hit_ratio}",
+                    file=sys.stderr
+                )
+
+    return {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "target": args.url or "in-process",
+        "python": platform.python_version(),
+        "environment": {key: value for key, value in os.environ.items() if key.startswith(("FAKE_LLM_", "LLM_", "ADMISSION_"))},
+        "results": results
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline load test for the Python tutor backend")
+    parser.add_argument("--scenarios", nargs="+", default=["chat", "quiz", "check-quota"], choices=["chat", "quiz", "check-quota"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario and concurrency level")
+    parser.add_argument("--repeat", action="store_true", help="send repeating chat queries and quizzes so the caches are exercised")
+    parser.add_argument("--url", help="base URL of a running server; default runs the app in-process")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark for quiz output parsing.
+
+Compares the single-pass QuizStreamParser with the previous
+strip/replace/find cascade (kept here as legacy_parse) over a corpus of
+well-formed and malformed model outputs. For each case it reports the
+number of questions recovered and the mean time per parse.
+
+Run from the backend directory:
+
+    python -m bench.quiz_parser_bench --output parser_bench.json
+    python -m bench.quiz_parser_bench --corpus path/to/raw_outputs
+
+A corpus directory holds one raw model response per *.txt file, for
+example responses captured from production logs.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+os.environ.setdefault("LLM_PROVIDER", "fake")
+
+from models.chat import QuizQuestion
+from providers import FAKE_QUIZ_VARIANTS, fake_quiz_output
+from quiz_parser import parse_quiz, coerce_question
+
+def legacy_parse(content: str, topic: str) -> List[QuizQuestion]:
+    """
+    The parsing logic generate_quiz used before QuizStreamParser.
+    """
+    cleaned_content = content.strip()
+    if cleaned_content.startswith("```json"):
+        cleaned_content = cleaned_content.replace("```json", "", 1)
+    if cleaned_content.startswith("```"):
+        cleaned_content = cleaned_content.replace("```", "", 1)
+    if cleaned_content.endswith("```"):
+        cleaned_content = cleaned_content[:-3]
+    cleaned_content = cleaned_content.strip()
+    if not cleaned_content.startswith("["):
+        start_idx = cleaned_content.find("[")
+        end_idx = cleaned_content.rfind("]")
+        if start_idx != -1 and end_idx != -1:
+            cleaned_content = cleaned_content[start_idx:end_idx + 1]
+    try:
+        quiz_data = json.loads(cleaned_content)
+    except json.JSONDecodeError:
+        try:
+            json_match = re.search(r'\[\s*\{.*\}\s*\]', content, re.DOTALL)
+            if not json_match:
+                return []
+            quiz_data = json.loads(json_match.group(0))
+        except Exception:
+            return []
+    questions = []
+    for item in quiz_data:
+        question = coerce_question(item, topic)
+        if question is not None:
+            questions.append(question)
+    return questions
+
+def build_corpus(corpus_dir: str = None) -> List[Tuple[str, str]]:
+    cases = []
+    # 5 questions is a normal quiz; 60 is close to the 8192 output-token limit
+    for count in (5, 60):
+        for variant in FAKE_QUIZ_VARIANTS:
+            cases.append((f"{variant}-{count}", fake_quiz_output("List comprehensions", variant, count)))
+    if corpus_dir:
+        for name in sorted(os.listdir(corpus_dir)):
+            if name.endswith(".txt"):
+                with open(os.path.join(corpus_dir, name), encoding="utf-8") as f:
+                    cases.append((name, f.read()))
+    return cases
+
+def time_parser(parse: Callable[[str, str], List[QuizQuestion]], text: str, iterations: int) -> Tuple[int, float]:
+    recovered = len(parse(text, "List comprehensions"))
+    started = time.perf_counter()
+    for _ in range(iterations):
+        parse(text, "List comprehensions")
+    return recovered, (time.perf_counter() - started) / iterations * 1e6
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark quiz output parsing")
+    parser.add_argument("--corpus", help="directory of raw model outputs (*.txt) to include")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    # Parsers log every dropped question; that would dominate the timings
+    logging.disable(logging.CRITICAL)
+
+    results: List[Dict] = []
+    for name, text in build_corpus(args.corpus):
+        legacy_count, legacy_us = time_parser(legacy_parse, text, args.iterations)
+        new_count, new_us = time_parser(parse_quiz, text, args.iterations)
+        results.append({
+            "case": name,
+            "chars": len(text),
+            "legacy": {"questions": legacy_count, "mean_us": round(legacy_us, 1)},
+            "single_pass": {"questions": new_count, "mean_us": round(new_us, 1)}
+        })
+        print(
+            f"{name:28} {len(text):>7} chars  legacy {legacy_count:>3}q {legacy_us:>9.1f}us   "
+            f"single-pass {new_count:>3}q {new_us:>9.1f}us",
+            file=sys.stderr
+        )
+
+    report = {"iterations": args.iterations, "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
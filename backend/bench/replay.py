@@ -0,0 +1,282 @@
+"""
+Replay recorded traffic for performance regression testing.
+
+`run` plays the requests of one or more trace files (recorded with
+TRACE_RECORD_PATH, see config.py) at their original arrival times, sped up
+by --speed, and reports latency per endpoint as JSON. In-process, the LLM is
+a stub that answers each upstream call with the timing recorded for the same
+request, so every build replaying a trace sees the same upstream behaviour
+and only the app's own overhead differs. `compare` puts two reports side by
+side and exits non-zero when an endpoint's p95 regressed.
+
+Run from the backend directory:
+
+    python -m bench.replay run trace.jsonl.gz --speed 10 --output before.json
+    git checkout my-branch
+    python -m bench.replay run trace.jsonl.gz --speed 10 --output after.json
+    python -m bench.replay compare before.json after.json --threshold 0.1
+
+Pass --url to replay against a running server instead; its own provider
+then answers, so that mode compares deployments rather than builds.
+Rate limits are lifted in-process, since a sped-up replay would otherwise
+trip the per-key buckets that the original traffic passed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List
+
+# Must be set before the app is imported
+os.environ["TRACE_RECORD_PATH"] = ""
+os.environ.setdefault("LLM_PROVIDER", "fake")
+os.environ.setdefault("WARMUP_DB_PATH", ":memory:")
+
+# Also lifts the rate limits and keeps usage and the quiz bank in memory
+from bench.loadtest import summarize
+
+import httpx
+
+from google.api_core import exceptions as google_exceptions
+from providers import FakeProvider, ProviderResponse
+from trace_recorder import current_trace_id, read_trace
+
+def load_traces(paths: List[str]) -> List[Dict[str, Any]]:
+    records = [record for path in paths for record in read_trace(path)]
+    # Files of several workers interleave by arrival time
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+class ReplayProvider(FakeProvider):
+    """
+    Fake provider that takes its timings from a trace: each upstream call of
+    a replayed request gets the next call recorded for that request. Calls
+    the recording doesn't have, such as a new build calling upstream where
+    the old one didn't, get the median recorded timing.
+    """
+
+    def __init__(self, upstream_records: List[Dict[str, Any]], speed: float):
+        super().__init__(error_rate=0)
+        self.speed = speed
+        self._by_request: Dict[str, Deque[Dict[str, Any]]] = defaultdict(deque)
+        for record in upstream_records:
+            if record["id"] is not None:
+                self._by_request[record["id"]].append(record)
+        completed = sorted(
+            (record for record in upstream_records if record["outcome"] == "ok"),
+            key=lambda record: record["seconds"]
+        )
+        self._median = completed[len(completed) // 2] if completed else {
+            "seconds": self.latency, "first_chunk_seconds": self.latency, "outcome": "ok"
+        }
+        self.matched = 0
+        self.unmatched = 0
+
+    def _next_timing(self) -> Dict[str, Any]:
+        recorded = self._by_request.get(current_trace_id.get())
+        if recorded:
+            self.matched += 1
+            return recorded.popleft()
+        self.unmatched += 1
+        return self._median
+
+    def _replay_failure(self, timing: Dict[str, Any]) -> None:
+        if timing["outcome"] == "error":
+            raise google_exceptions.ServiceUnavailable("Replayed upstream error")
+
+    async def generate(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None, on_abandoned=None) -> ProviderResponse:
+        self.calls += 1
+        timing = self._next_timing()
+        text = self._respond(prompt)
+        await self._sleep(timing["seconds"] / self.speed, (lambda: on_abandoned(ProviderResponse(text))) if on_abandoned else None)
+        self._replay_failure(timing)
+        return ProviderResponse(text)
+
+    async def stream(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None):
+        self.calls += 1
+        timing = self._next_timing()
+        text = self._respond(prompt)
+        first_chunk = timing["first_chunk_seconds"] if timing["first_chunk_seconds"] is not None else timing["seconds"]
+        await self._sleep(first_chunk / self.speed)
+        self._replay_failure(timing)
+        starts = range(0, len(text), self.chunk_chars)
+        # The rest of the recorded duration is spread evenly over the chunks
+        chunk_delay = max(0.0, timing["seconds"] - first_chunk) / max(1, len(starts) - 1) / self.speed
+        for start in starts:
+            if start:
+                await self._sleep(chunk_delay)
+            yield ProviderResponse(text[start:start + self.chunk_chars])
+
+def replay_body(body: Any) -> Any:
+    """
+    Recorded bodies carry hashed API keys; a key derived from the hash keeps
+    each learner's requests together and passes the key format checks.
+    """
+    if isinstance(body, dict) and body.get("api_key"):
+        return {**body, "api_key": f"replay-{body['api_key']}"}
+    return body
+
+async def replay_request(client: httpx.AsyncClient, record: Dict[str, Any], results: Dict[str, Dict[str, list]]) -> None:
+    # Upstream calls made for this request look up its recorded timings
+    current_trace_id.set(record["id"])
+    url = record["endpoint"] + (f"?{record['query_string']}" if record["query_string"] else "")
+    result = results[record["endpoint"]]
+    started = time.perf_counter()
+    first_byte = None
+    try:
+        async with client.stream(record["method"], url, json=replay_body(record["body"])) as response:
+            async for _ in response.aiter_bytes():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - started
+            code = str(response.status_code)
+    except Exception:
+        code = "exception"
+    elapsed = time.perf_counter() - started
+    result["latency_ms"].append(elapsed * 1000)
+    result["first_byte_ms"].append((first_byte if first_byte is not None else elapsed) * 1000)
+    result["status_codes"].append(code)
+
+def recorded_summary(requests: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    by_endpoint = defaultdict(list)
+    for record in requests:
+        by_endpoint[record["endpoint"]].append(record["seconds"] * 1000)
+    return {endpoint: summarize(latencies) for endpoint, latencies in sorted(by_endpoint.items())}
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    records = load_traces(args.traces)
+    requests = [record for record in records if record["type"] == "request"]
+    if args.limit:
+        requests = requests[:args.limit]
+    if not requests:
+        raise SystemExit("No requests in the trace")
+
+    replay_provider = None
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout)
+    else:
+        import llm_handler
+        from main import app
+        replay_provider = ReplayProvider([record for record in records if record["type"] == "upstream"], args.speed)
+        llm_handler.provider = replay_provider
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://replay", timeout=args.timeout)
+        # ASGITransport doesn't send lifespan events; quiz jobs need their workers
+        await app.router.startup()
+
+    results: Dict[str, Dict[str, list]] = defaultdict(lambda: {"latency_ms": [], "first_byte_ms": [], "status_codes": []})
+    schedule_lag_ms: List[float] = []
+    tasks = []
+    async with client:
+        first_ts = requests[0]["ts"]
+        started = time.perf_counter()
+        for record in requests:
+            due = (record["ts"] - first_ts) / args.speed
+            delay = due - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            schedule_lag_ms.append(max(0.0, (time.perf_counter() - started) - due) * 1000)
+            tasks.append(asyncio.create_task(replay_request(client, record, results)))
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - started
+    if not args.url:
+        await app.router.shutdown()
+
+    endpoints = {}
+    for endpoint, result in sorted(results.items()):
+        status_codes: Dict[str, int] = {}
+        for code in result["status_codes"]:
+            status_codes[code] = status_codes.get(code, 0) + 1
+        endpoints[endpoint] = {
+            "requests": len(result["latency_ms"]),
+            "status_codes": status_codes,
+            "latency_ms": summarize(result["latency_ms"]),
+            "first_byte_ms": summarize(result["first_byte_ms"])
+        }
+        print(
+            f"{endpoint:28} n={len(result['latency_ms']):<6} p50={endpoints[endpoint]['latency_ms']['p50']}ms "
+            f"p95={endpoints[endpoint]['latency_ms']['p95']}ms p99={endpoints[endpoint]['latency_ms']['p99']}ms",
+            file=sys.stderr
+        )
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "target": args.url or "in-process",
+        "python": platform.python_version(),
+        "traces": args.traces,
+        "speed": args.speed,
+        "requests": len(requests),
+        "duration_s": round(duration, 3),
+        "schedule_lag_ms": summarize(schedule_lag_ms),
+        "endpoints": endpoints,
+        # Original latencies, unscaled, for reference
+        "recorded_latency_ms": recorded_summary(requests)
+    }
+    if replay_provider is not None:
+        report["upstream"] = {"matched": replay_provider.matched, "unmatched": replay_provider.unmatched}
+    return report
+
+def compare(args: argparse.Namespace) -> int:
+    """
+    Print p50/p95/p99 per endpoint for both reports; returns 1 if any
+    endpoint's p95 grew by more than the threshold and by at least
+    --min-delta-ms, so jitter on millisecond endpoints isn't a regression.
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline.get("traces") != candidate.get("traces") or baseline.get("speed") != candidate.get("speed"):
+        print("warning: the reports replayed different traces or speeds", file=sys.stderr)
+
+    regressed = []
+    print(f"{'endpoint':28} {'':>4} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for endpoint in sorted(set(baseline["endpoints"]) | set(candidate["endpoints"])):
+        before = baseline["endpoints"].get(endpoint)
+        after = candidate["endpoints"].get(endpoint)
+        if before is None or after is None:
+            print(f"{endpoint:28} only in {'candidate' if before is None else 'baseline'}")
+            continue
+        for stat in ("p50", "p95", "p99"):
+            old, new = before["latency_ms"][stat], after["latency_ms"][stat]
+            change = (new - old) / old if old else 0.0
+            print(f"{endpoint if stat == 'p50' else '':28} {stat:>4} {old:>10.1f} {new:>10.1f} {change:>+8.1%}")
+            if stat == "p95" and change > args.threshold and new - old >= args.min_delta_ms:
+                regressed.append(endpoint)
+    if regressed:
+        print(f"p95 regressed by more than {args.threshold:.0%}: {', '.join(regressed)}", file=sys.stderr)
+        return 1
+    return 0
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay recorded traffic and compare latency between builds")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subcommands.add_parser("run", help="replay trace files and report latency per endpoint")
+    run_parser.add_argument("traces", nargs="+", help="trace files (*.jsonl.gz) recorded with TRACE_RECORD_PATH")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="replay this many times faster than recorded")
+    run_parser.add_argument("--limit", type=int, help="replay only the first N requests")
+    run_parser.add_argument("--url", help="base URL of a running server; default runs the app in-process with recorded upstream timings")
+    run_parser.add_argument("--timeout", type=float, default=120.0)
+    run_parser.add_argument("--output", help="write the JSON report here instead of stdout")
+
+    compare_parser = subcommands.add_parser("compare", help="compare two replay reports")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="largest accepted relative p95 increase")
+    compare_parser.add_argument("--min-delta-ms", type=float, default=5.0, help="smallest p95 increase counted as a regression")
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        sys.exit(compare(args))
+    report = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
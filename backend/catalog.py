@@ -0,0 +1,67 @@
+import gzip
+import hashlib
+import json
+from typing import Dict, Optional
+from response_cache import normalize_text
+from config import (
+    AVAILABLE_MODELS,
+    AVAILABLE_LANGUAGES,
+    AVAILABLE_TOPICS,
+    AVAILABLE_CHAPTERS,
+    CHAPTER_TOPICS,
+    FAMILIARITY_LEVELS,
+    CONVERSATION_MODES
+)
+
+class CatalogPayload:
+    """
+    The /api/config response, serialized and compressed once. The catalog
+    only changes with a deploy, so every request is served from these bytes.
+    """
+
+    def __init__(self, catalog: dict):
+        self.body = json.dumps(catalog, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # mtime=0 keeps the compressed bytes identical across restarts and workers
+        self.gzip_body = gzip.compress(self.body, compresslevel=9, mtime=0)
+        digest = hashlib.sha256(self.body).hexdigest()[:32]
+        # Strong validators; each encoding is a different representation
+        self.etag = f'"{digest}"'
+        self.gzip_etag = f'"{digest}-gzip"'
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        """
+        Whether an If-None-Match header names either representation.
+        """
+        if not if_none_match:
+            return False
+        if if_none_match.strip() == "*":
+            return True
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return self.etag in tags or self.gzip_etag in tags
+
+CATALOG = {
+    "models": AVAILABLE_MODELS,
+    "languages": AVAILABLE_LANGUAGES,
+    "chapters": AVAILABLE_CHAPTERS,
+    "chapterTopics": CHAPTER_TOPICS,
+    "topics": AVAILABLE_TOPICS,  # Keep for backward compatibility
+    "familiarityLevels": FAMILIARITY_LEVELS,
+    "conversationModes": CONVERSATION_MODES
+}
+
+catalog_payload = CatalogPayload(CATALOG)
+
+# Normalized topic -> catalog spelling, for O(1) request validation
+TOPIC_INDEX: Dict[str, str] = {normalize_text(topic): topic for topic in AVAILABLE_TOPICS}
+
+def canonical_topic(topic: str) -> Optional[str]:
+    """
+    The catalog spelling of a topic, ignoring case and whitespace, or None
+    if it isn't in the catalog.
+    """
+    return TOPIC_INDEX.get(normalize_text(topic))
+
+CHAPTER_INDEX: Dict[str, str] = {normalize_text(chapter): chapter for chapter in CHAPTER_TOPICS}
+
+def canonical_chapter(chapter: str) -> Optional[str]:
+    return CHAPTER_INDEX.get(normalize_text(chapter))
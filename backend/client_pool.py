@@ -0,0 +1,185 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, Optional
+from google.ai import generativelanguage as glm
+from google.generativeai.types import content_types, generation_types, safety_types
+from config import CLIENT_POOL_MAX_KEYS, CLIENT_POOL_IDLE_SECONDS
+
+class _KeyEntry:
+    """
+    The service client cached for one API key. `active` counts calls still
+    using it, so an entry evicted mid-call is only closed once they finish.
+    """
+    __slots__ = ("client", "last_used", "active", "evicted", "_lock")
+
+    def __init__(self, client: glm.GenerativeServiceClient):
+        self.client = client
+        self.last_used = time.monotonic()
+        self.active = 0
+        self.evicted = False
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        with self._lock:
+            self.active += 1
+
+    def release(self) -> None:
+        with self._lock:
+            self.active -= 1
+            close = self.evicted and self.active == 0
+        if close:
+            self.client.transport.close()
+
+    def evict(self) -> None:
+        with self._lock:
+            self.evicted = True
+            close = self.active == 0
+        if close:
+            # Otherwise every evicted key would keep its gRPC channel open
+            self.client.transport.close()
+
+class ResponseStream:
+    """
+    A streaming generation, one GenerateContentResponse per chunk.
+
+    cancel() may be called from any thread, including while another thread
+    is blocked waiting for the next chunk; it ends the gRPC stream, so the
+    upstream generation stops too.
+    """
+
+    def __init__(self, stream: Any, entry: _KeyEntry):
+        self._stream = stream
+        self._entry = entry
+        self._finished = False
+
+    def __iter__(self) -> Iterator[generation_types.GenerateContentResponse]:
+        return self
+
+    def __next__(self) -> generation_types.GenerateContentResponse:
+        try:
+            with generation_types.rewrite_stream_error():
+                chunk = next(self._stream)
+        except BaseException:
+            self._finish()
+            raise
+        return generation_types.GenerateContentResponse.from_response(chunk)
+
+    def _finish(self) -> None:
+        if not self._finished:
+            self._finished = True
+            self._entry.release()
+
+    def cancel(self) -> None:
+        if not self._finished:
+            self._stream.cancel()
+
+class BoundModel:
+    """
+    A model name and generation config bound to one key's service client,
+    for a single generate_content call.
+
+    Requests are built with the SDK's public type helpers and sent through
+    that client, so the call never touches genai's process-global default
+    client or the internals of genai.GenerativeModel.
+    """
+
+    def __init__(self, entry: _KeyEntry, model_name: str, generation_config: Optional[Dict[str, Any]] = None):
+        self._entry = entry
+        self.model_name = model_name if model_name.startswith(("models/", "tunedModels/")) else f"models/{model_name}"
+        self.generation_config = generation_config
+
+    def build_request(self, prompt: Any, safety_settings: Any = None) -> glm.GenerateContentRequest:
+        request = glm.GenerateContentRequest(
+            model=self.model_name,
+            contents=content_types.to_contents(prompt),
+            generation_config=generation_types.to_generation_config_dict(self.generation_config),
+            safety_settings=safety_types.normalize_safety_settings(safety_types.to_easy_safety_dict(safety_settings))
+        )
+        if request.contents and not request.contents[-1].role:
+            request.contents[-1].role = "user"
+        return request
+
+    def generate_content(
+        self,
+        prompt: Any,
+        safety_settings: Any = None,
+        stream: bool = False,
+        request_options: Optional[Dict[str, Any]] = None
+    ):
+        """
+        Same contract as genai.GenerativeModel.generate_content: a
+        GenerateContentResponse, or with stream=True a ResponseStream.
+        """
+        try:
+            request = self.build_request(prompt, safety_settings)
+            if stream:
+                with generation_types.rewrite_stream_error():
+                    response_stream = self._entry.client.stream_generate_content(request, **(request_options or {}))
+                return ResponseStream(response_stream, self._entry)
+            response = self._entry.client.generate_content(request, **(request_options or {}))
+        except BaseException:
+            self._entry.release()
+            raise
+        self._entry.release()
+        return generation_types.GenerateContentResponse.from_response(response)
+
+class ClientPool:
+    """
+    Long-lived Gemini clients keyed by API key.
+
+    genai.configure() rewrites process-global state, so concurrent requests
+    with different keys would race. Instead each key gets its own
+    GenerativeServiceClient, and every model handed out sends its requests
+    through that client. Entries are kept in LRU order and dropped when the
+    pool is full or when they have been idle for longer than idle_seconds;
+    a dropped client's channel is closed once no call is using it.
+    """
+
+    def __init__(self, max_keys: int = CLIENT_POOL_MAX_KEYS, idle_seconds: int = CLIENT_POOL_IDLE_SECONDS):
+        self.max_keys = max_keys
+        self.idle_seconds = idle_seconds
+        self._entries: "OrderedDict[str, _KeyEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _create_client(self, api_key: str) -> glm.GenerativeServiceClient:
+        return glm.GenerativeServiceClient(client_options={"api_key": api_key})
+
+    def get_model(self, api_key: str, model_name: str, generation_config: Optional[Dict[str, Any]] = None) -> BoundModel:
+        """
+        Return a model for this key, model and generation config on the key's
+        warm client. The client stays open until its generate_content call ends.
+        """
+        with self._lock:
+            entry = self._get_entry(api_key)
+            entry.acquire()
+        return BoundModel(entry, model_name, generation_config)
+
+    def _get_entry(self, api_key: str) -> _KeyEntry:
+        now = time.monotonic()
+        self._evict_idle(now)
+
+        entry = self._entries.get(api_key)
+        if entry is None:
+            entry = _KeyEntry(self._create_client(api_key))
+            self._entries[api_key] = entry
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)[1].evict()
+        else:
+            self._entries.move_to_end(api_key)
+        entry.last_used = now
+        return entry
+
+    def _evict_idle(self, now: float) -> None:
+        # Entries are in last-used order, so only the head can be idle
+        while self._entries:
+            api_key, entry = next(iter(self._entries.items()))
+            if now - entry.last_used < self.idle_seconds:
+                break
+            del self._entries[api_key]
+            entry.evict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+client_pool = ClientPool()
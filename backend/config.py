@@ -7,8 +7,189 @@ load_dotenv()
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 DEFAULT_MODEL = "gemini-1.5-flash"  # Default model to use if not specified
 
+# LLM provider: "gemini" for the real API, "fake" for offline benchmarks and load tests
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini")
+
+# Fake provider behaviour: time to first chunk, delay between chunks, chunk size,
+# quiz output variant (valid, fenced, prose, trailing_comma, truncated,
+# string_answer, broken_item or random), and whether it blocks a pool thread like Gemini
+FAKE_LLM_LATENCY_SECONDS = float(os.getenv("FAKE_LLM_LATENCY_SECONDS", "0.5"))
+FAKE_LLM_CHUNK_DELAY_SECONDS = float(os.getenv("FAKE_LLM_CHUNK_DELAY_SECONDS", "0.02"))
+FAKE_LLM_CHUNK_CHARS = int(os.getenv("FAKE_LLM_CHUNK_CHARS", "40"))
+FAKE_LLM_QUIZ_VARIANT = os.getenv("FAKE_LLM_QUIZ_VARIANT", "valid")
+FAKE_LLM_BLOCKING = os.getenv("FAKE_LLM_BLOCKING", "true").lower() == "true"
+# Fraction of fake calls that fail with a 503, for exercising retries and breakers
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))
+
+# Upstream concurrency: size of the thread pool that runs blocking Gemini calls
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+
+# Per-API-key client pool: how many keys keep a warm client, and how long an idle one lives
+CLIENT_POOL_MAX_KEYS = int(os.getenv("CLIENT_POOL_MAX_KEYS", "256"))
+CLIENT_POOL_IDLE_SECONDS = int(os.getenv("CLIENT_POOL_IDLE_SECONDS", "900"))
+
+# Serving: `python main.py` starts SERVER_WORKERS uvicorn processes
+# (`uvicorn --workers` reads WEB_CONCURRENCY). With more than one worker,
+# shared state moves to SQLite files every worker opens: token usage, the
+# response cache's disk tier, sessions and single-flight leases. In-memory
+# copies of shared state are re-read after SHARED_STATE_REFRESH_SECONDS, and
+# a lease expires after FLIGHT_LEASE_TTL_SECONDS if its worker dies.
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", os.getenv("WEB_CONCURRENCY", "1")))
+SHARED_STATE = SERVER_WORKERS > 1 or os.getenv("SHARED_STATE", "false").lower() == "true"
+SHARED_STATE_REFRESH_SECONDS = float(os.getenv("SHARED_STATE_REFRESH_SECONDS", "1"))
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.db")
+FLIGHT_LEASE_PATH = os.getenv("FLIGHT_LEASE_PATH", "flight_leases.db")
+FLIGHT_LEASE_TTL_SECONDS = float(os.getenv("FLIGHT_LEASE_TTL_SECONDS", "120"))
+FLIGHT_LEASE_POLL_SECONDS = float(os.getenv("FLIGHT_LEASE_POLL_SECONDS", "0.1"))
+
+# Tutor response cache: in-memory LRU size, entry lifetime, and optional
+# SQLite file for a disk tier that survives restarts (unset = memory only,
+# except with shared state, where the disk tier is what workers share)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "86400"))
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.db" if SHARED_STATE else None)
+
+# Semantic cache for paraphrased tutor queries: cosine similarity threshold
+# over hashed n-gram vectors, vector size, and memory bounds (entries per
+# topic partition, number of partitions; the defaults cap the vectors at 64 MB).
+# Entries share the response cache TTL. A wrong hit serves an answer to a
+# different question, so the threshold only admits close paraphrases.
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_DIM = int(os.getenv("SEMANTIC_CACHE_DIM", "256"))
+SEMANTIC_CACHE_MAX_PER_PARTITION = int(os.getenv("SEMANTIC_CACHE_MAX_PER_PARTITION", "256"))
+SEMANTIC_CACHE_MAX_PARTITIONS = int(os.getenv("SEMANTIC_CACHE_MAX_PARTITIONS", "256"))
+
+# Quiz question bank: SQLite file, questions per quiz, and the refill thresholds
+# per (topic, familiarity level, language) bucket. The background refill uses
+# GEMINI_API_KEY; set QUIZ_BANK_PREFILL to also walk the whole topic matrix.
+QUIZ_BANK_PATH = os.getenv("QUIZ_BANK_PATH", "quiz_bank.db")
+QUIZ_QUESTION_COUNT = 5
+QUIZ_BANK_LOW_WATER = int(os.getenv("QUIZ_BANK_LOW_WATER", "10"))
+QUIZ_BANK_TARGET = int(os.getenv("QUIZ_BANK_TARGET", "25"))
+QUIZ_BANK_REFILL_INTERVAL_SECONDS = float(os.getenv("QUIZ_BANK_REFILL_INTERVAL_SECONDS", "5"))
+QUIZ_BANK_PREFILL = os.getenv("QUIZ_BANK_PREFILL", "false").lower() == "true"
+QUIZ_BANK_LANGUAGES = [language.strip() for language in os.getenv("QUIZ_BANK_LANGUAGES", "English").split(",") if language.strip()]
+
+# Chapter quizzes (POST /api/quiz/batch): most topics per request, most
+# questions per topic, and the output tokens budgeted per question when
+# packing topics into one generation (bounded by the quiz max_output_tokens)
+QUIZ_BATCH_MAX_TOPICS = int(os.getenv("QUIZ_BATCH_MAX_TOPICS", "20"))
+QUIZ_BATCH_MAX_QUESTIONS_PER_TOPIC = int(os.getenv("QUIZ_BATCH_MAX_QUESTIONS_PER_TOPIC", "10"))
+QUIZ_BATCH_TOKENS_PER_QUESTION = int(os.getenv("QUIZ_BATCH_TOKENS_PER_QUESTION", "400"))
+
+# Quiz job queue (POST /api/quiz?job=true): workers, i.e. concurrent quiz
+# generations, capped separately from the chat admission slots; how many
+# unfinished jobs may exist; how long results are kept for polling; and the
+# longest a poll may wait for a job to finish
+QUIZ_JOB_WORKERS = int(os.getenv("QUIZ_JOB_WORKERS", "4"))
+QUIZ_JOB_MAX_PENDING = int(os.getenv("QUIZ_JOB_MAX_PENDING", "256"))
+QUIZ_JOB_RESULT_TTL_SECONDS = int(os.getenv("QUIZ_JOB_RESULT_TTL_SECONDS", "600"))
+QUIZ_JOB_MAX_WAIT_SECONDS = float(os.getenv("QUIZ_JOB_MAX_WAIT_SECONDS", "30"))
+# With shared state, job status and results are also written here so any worker can answer a poll
+QUIZ_JOB_DB_PATH = os.getenv("QUIZ_JOB_DB_PATH", "quiz_jobs.db")
+
+# Token usage accounting: "memory" or "sqlite" (always sqlite with shared state).
+# The SQLite store batches writes and flushes them every
+# USAGE_FLUSH_INTERVAL_SECONDS. Usage resets each calendar month.
+USAGE_STORE = os.getenv("USAGE_STORE", "sqlite" if SHARED_STATE else "memory")
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "usage.db")
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "2"))
+USAGE_MAX_KEYS = int(os.getenv("USAGE_MAX_KEYS", "10000"))
+
+# Admission control in front of /api/chat and /api/quiz: token buckets per API
+# key and for the whole process, plus a bounded wait queue for upstream slots
+RATE_LIMIT_PER_KEY_PER_MINUTE = float(os.getenv("RATE_LIMIT_PER_KEY_PER_MINUTE", "30"))
+RATE_LIMIT_PER_KEY_BURST = int(os.getenv("RATE_LIMIT_PER_KEY_BURST", "10"))
+RATE_LIMIT_GLOBAL_PER_SECOND = float(os.getenv("RATE_LIMIT_GLOBAL_PER_SECOND", "50"))
+RATE_LIMIT_GLOBAL_BURST = int(os.getenv("RATE_LIMIT_GLOBAL_BURST", "100"))
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", str(LLM_MAX_CONCURRENCY)))
+ADMISSION_MAX_WAITING = int(os.getenv("ADMISSION_MAX_WAITING", "64"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "5"))
+
+# Upstream resilience: total deadline per endpoint (all attempts included),
+# stream timeouts for the first chunk and between chunks, bounded retries with
+# jittered exponential backoff for transient errors, and a circuit breaker per
+# model that opens after consecutive failures. Requests for a model whose
+# breaker is open fail over to the first healthy model in LLM_FAILOVER_MODELS.
+LLM_CHAT_DEADLINE_SECONDS = float(os.getenv("LLM_CHAT_DEADLINE_SECONDS", "60"))
+LLM_QUIZ_DEADLINE_SECONDS = float(os.getenv("LLM_QUIZ_DEADLINE_SECONDS", "90"))
+LLM_STREAM_FIRST_CHUNK_TIMEOUT_SECONDS = float(os.getenv("LLM_STREAM_FIRST_CHUNK_TIMEOUT_SECONDS", "30"))
+LLM_STREAM_IDLE_TIMEOUT_SECONDS = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT_SECONDS", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.5"))
+LLM_RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "8"))
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RECOVERY_SECONDS = float(os.getenv("CIRCUIT_RECOVERY_SECONDS", "30"))
+LLM_FAILOVER_MODELS = [model.strip() for model in os.getenv("LLM_FAILOVER_MODELS", "gemini-2.0-flash,gemini-1.5-flash,gemini-1.5-pro").split(",") if model.strip()]
+
+# Conversation sessions: how many are kept (least recently used are evicted),
+# how long an idle one lives, the history token budget past which older turns
+# are compacted into a summary, how many recent turns are always kept verbatim,
+# and the model that writes the summaries
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "5000"))
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", "3600"))
+SESSION_HISTORY_TOKEN_BUDGET = int(os.getenv("SESSION_HISTORY_TOKEN_BUDGET", "2000"))
+SESSION_KEEP_RECENT_TURNS = int(os.getenv("SESSION_KEEP_RECENT_TURNS", "4"))
+SESSION_SUMMARY_MODEL = os.getenv("SESSION_SUMMARY_MODEL", "gemini-1.5-flash")
+
+# Model router for model="auto": candidate models, EWMA smoothing, the share
+# of requests sent to a random candidate to keep estimates fresh, and samples
+# needed before a model's estimate is trusted. Auto chat requests are hedged:
+# when the first model passes its p95 latency, a second model is asked too and
+# the slower call is cancelled. Hedges are capped at a share of requests.
+AUTO_MODEL = "auto"
+ROUTER_MODELS = [model.strip() for model in os.getenv("ROUTER_MODELS", "gemini-2.0-flash,gemini-1.5-flash,gemini-2.5-flash,gemini-1.5-pro").split(",") if model.strip()]
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.2"))
+ROUTER_EXPLORE_RATIO = float(os.getenv("ROUTER_EXPLORE_RATIO", "0.05"))
+ROUTER_MIN_SAMPLES = int(os.getenv("ROUTER_MIN_SAMPLES", "5"))
+ROUTER_LATENCY_WINDOW = int(os.getenv("ROUTER_LATENCY_WINDOW", "200"))
+ROUTER_HEDGE_ENABLED = os.getenv("ROUTER_HEDGE_ENABLED", "true").lower() == "true"
+ROUTER_HEDGE_DEFAULT_SECONDS = float(os.getenv("ROUTER_HEDGE_DEFAULT_SECONDS", "10"))
+ROUTER_HEDGE_MAX_RATIO = float(os.getenv("ROUTER_HEDGE_MAX_RATIO", "0.1"))
+
+# /api/config: how long browsers and CDNs may reuse the catalog before
+# revalidating it with its ETag
+CONFIG_CACHE_MAX_AGE_SECONDS = int(os.getenv("CONFIG_CACHE_MAX_AGE_SECONDS", "300"))
+
+# Warm-up: pre-generate the default explanation (empty query) for every
+# topic x familiarity level x conversation mode, and a quiz for every topic x
+# familiarity level, in WARMUP_LANGUAGES, most requested topics first. Runs
+# in the background after startup if WARMUP_ON_STARTUP is set, or with
+# `python warmup.py`, paid for with GEMINI_API_KEY. WARMUP_DB_PATH keeps the
+# progress, the tokens spent per UTC day (capped at WARMUP_TOKEN_BUDGET) and
+# the observed topic popularity. Explanations only outlive the process with
+# a RESPONSE_CACHE_PATH.
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true"
+WARMUP_LANGUAGES = [language.strip() for language in os.getenv("WARMUP_LANGUAGES", "English").split(",") if language.strip()]
+WARMUP_MODEL = os.getenv("WARMUP_MODEL", AUTO_MODEL)
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "2"))
+WARMUP_TOKEN_BUDGET = int(os.getenv("WARMUP_TOKEN_BUDGET", "2000000"))
+WARMUP_DB_PATH = os.getenv("WARMUP_DB_PATH", "warmup.db")
+WARMUP_POPULARITY_FLUSH_SECONDS = float(os.getenv("WARMUP_POPULARITY_FLUSH_SECONDS", "60"))
+
+# Tutor WebSocket (/api/ws): requests one connection may have in progress at
+# once, messages buffered for a client that reads slowly before its
+# generations wait for it, and the largest accepted client message
+WS_MAX_CONCURRENT_REQUESTS = int(os.getenv("WS_MAX_CONCURRENT_REQUESTS", "4"))
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "64"))
+WS_MAX_MESSAGE_BYTES = int(os.getenv("WS_MAX_MESSAGE_BYTES", "65536"))
+
+# Trace recording for offline replay (python -m bench.replay): with a path
+# set, a TRACE_SAMPLE_RATE share of /api requests (endpoint, body with the API
+# key and session id hashed, arrival time, status, latency) and the timing of
+# every upstream call they make are appended to gzip-compressed JSONL, flushed
+# every TRACE_FLUSH_SECONDS. With several workers each writes its own file,
+# suffixed with its pid.
+TRACE_RECORD_PATH = os.getenv("TRACE_RECORD_PATH", "")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_FLUSH_SECONDS = float(os.getenv("TRACE_FLUSH_SECONDS", "5"))
+TRACE_MAX_BODY_BYTES = int(os.getenv("TRACE_MAX_BODY_BYTES", "65536"))
+
 # Available models
-AVAILABLE_MODELS = ["gemini-2.5-flash", "gemini-2.0-flash", "gemini-1.5-flash", "gemini-1.5-pro", "gemini-1.0-pro", "gemini-1.0-pro-vision"]
+AVAILABLE_MODELS = [AUTO_MODEL, "gemini-2.5-flash", "gemini-2.0-flash", "gemini-1.5-flash", "gemini-1.5-pro", "gemini-1.0-pro", "gemini-1.0-pro-vision"]
 
 # Available languages
 AVAILABLE_LANGUAGES = ["English", "Hindi", "Spanish", "French", "German", "Bengali"]
@@ -69,7 +250,7 @@ CHAPTER_TOPICS = {
     ],
     "Errors": [
         "Syntax errors",
-        "Logical errors"
+        "Logical errors",
         "Run-time errors",
     ],
     "Flow of Control": [
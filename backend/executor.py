@@ -0,0 +1,81 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Optional, Set
+from config import LLM_MAX_CONCURRENCY
+
+# Dedicated pool for blocking provider calls. Keeping it separate from the
+# default asyncio executor means a burst of slow generations can't starve
+# anything else that uses asyncio.to_thread.
+llm_executor = ThreadPoolExecutor(max_workers=LLM_MAX_CONCURRENCY, thread_name_prefix="llm")
+
+async def run_blocking(func: Callable[..., Any], *args, on_abandoned: Optional[Callable[[Any], None]] = None, **kwargs) -> Any:
+    """
+    Run a blocking function on the LLM thread pool without blocking the event loop.
+
+    Cancelling the caller can't stop a call that is already running on its
+    thread. If on_abandoned is given, it is called on the event loop with
+    the result of such a call once it finishes, e.g. to charge its tokens.
+    """
+    loop = asyncio.get_running_loop()
+    future = llm_executor.submit(functools.partial(func, *args, **kwargs))
+    try:
+        return await asyncio.wrap_future(future)
+    except asyncio.CancelledError:
+        # cancel() only succeeds for a call still waiting for a thread
+        if on_abandoned is not None and not future.cancel():
+            future.add_done_callback(lambda done: _deliver_abandoned(loop, done, on_abandoned))
+        raise
+
+def _deliver_abandoned(loop: asyncio.AbstractEventLoop, future, on_abandoned: Callable[[Any], None]) -> None:
+    if future.cancelled() or future.exception() is not None:
+        return
+    try:
+        loop.call_soon_threadsafe(on_abandoned, future.result())
+    except RuntimeError:
+        # The event loop has shut down meanwhile
+        pass
+
+async def iterate_blocking(iterable: Iterable[Any]) -> AsyncIterator[Any]:
+    """
+    Iterate a blocking iterator (e.g. a Gemini response stream), pulling each
+    item on the LLM thread pool.
+
+    If the caller stops early, the iterator's cancel() is called when it has
+    one: for a gRPC stream that ends the upstream generation and makes a
+    next() still blocked on a pool thread return.
+    """
+    iterator = iter(iterable)
+    sentinel = object()
+    exhausted = False
+    try:
+        while True:
+            item = await run_blocking(next, iterator, sentinel)
+            if item is sentinel:
+                exhausted = True
+                break
+            yield item
+    finally:
+        cancel = getattr(iterator, "cancel", None)
+        if not exhausted and cancel is not None:
+            cancel()
+
+# The event loop only keeps weak references to tasks, so fire-and-forget work
+# is held here until it finishes
+_background_tasks: Set[asyncio.Future] = set()
+
+def run_in_background(awaitable: Awaitable[Any]) -> asyncio.Future:
+    """
+    Start work nobody awaits (e.g. a session compaction) without it being
+    garbage collected mid-run.
+    """
+    task = asyncio.ensure_future(awaitable)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def shutdown_executor() -> None:
+    """
+    Stop accepting new work and let in-flight calls finish.
+    """
+    llm_executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,281 @@
+import asyncio
+import itertools
+import json
+import logging
+import secrets
+import sqlite3
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from models.chat import QuizQuestion, QuizJobResponse
+from admission import AdmissionRejected
+from usage_store import usage_key
+from quiz_bank import get_quiz_questions
+from config import (
+    QUIZ_JOB_WORKERS,
+    QUIZ_JOB_MAX_PENDING,
+    QUIZ_JOB_RESULT_TTL_SECONDS,
+    QUIZ_JOB_DB_PATH,
+    SHARED_STATE,
+    SHARED_STATE_REFRESH_SECONDS
+)
+
+# Lower runs first
+JOB_PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+class QuizJob:
+    """
+    One quiz generation: queued -> running -> done | failed.
+    """
+
+    def __init__(self, topic: str, language: str, familiarity_level: str, api_key: str, priority: int):
+        self.id = secrets.token_urlsafe(16)
+        self.topic = topic
+        self.language = language
+        self.familiarity_level = familiarity_level
+        self.api_key: Optional[str] = api_key
+        # Kept after the key itself is dropped, so the job can still be found by it
+        self.key_hash = usage_key(api_key)
+        self.priority = priority
+        self.status = "queued"
+        self.questions: List[QuizQuestion] = []
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def dedup_key(self) -> Tuple[str, str, str, str]:
+        # Per key: a shared job would spend the first learner's quota and
+        # hand their failures (an invalid or exhausted key) to everyone else
+        return (self.key_hash, self.topic, self.familiarity_level, self.language)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def _set_status(self, status: str) -> None:
+        self.status = status
+        # Wake everyone waiting on this change; later waiters get a fresh event
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_for_change(self, timeout: float) -> None:
+        if self.finished or timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def response(self) -> QuizJobResponse:
+        return QuizJobResponse(job_id=self.id, status=self.status, questions=self.questions, error=self.error)
+
+class QuizJobQueue:
+    """
+    In-process queue that runs quiz generations off the request path.
+
+    A fixed pool of workers bounds how many quizzes generate at once,
+    separately from the chat admission slots. An identical job that is
+    still queued or running for the same API key is shared rather than
+    generated twice (learners share finished quizzes through the quiz bank), and
+    finished jobs are kept for `result_ttl` seconds for clients to poll.
+
+    With a database path, every status change is also written to SQLite,
+    so a worker process that didn't take the job can still report on it.
+    """
+
+    def __init__(
+        self,
+        workers: int = QUIZ_JOB_WORKERS,
+        max_pending: int = QUIZ_JOB_MAX_PENDING,
+        result_ttl: int = QUIZ_JOB_RESULT_TTL_SECONDS,
+        path: Optional[str] = QUIZ_JOB_DB_PATH if SHARED_STATE else None
+    ):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self._db = None
+        self._pruned_at = 0.0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS quiz_jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    questions_json TEXT NOT NULL,
+                    error TEXT,
+                    finished_at REAL
+                )
+            """)
+            self._db.commit()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._seq = itertools.count()
+        self._jobs: Dict[str, QuizJob] = {}
+        self._pending: Dict[Tuple[str, str, str, str], QuizJob] = {}
+        # Finish order is expiry order, so expiring is popping from the left
+        self._finished: Deque[QuizJob] = deque()
+        self._tasks: List[asyncio.Task] = []
+        self.running = 0
+        self.submitted = 0
+        self.deduplicated = 0
+        self.completed = 0
+        self.failed = 0
+
+    def _expire(self) -> None:
+        cutoff = time.time() - self.result_ttl
+        while self._finished and self._finished[0].finished_at <= cutoff:
+            self._jobs.pop(self._finished.popleft().id, None)
+        if self._db is not None and time.monotonic() - self._pruned_at >= 60:
+            self._pruned_at = time.monotonic()
+            self._execute("DELETE FROM quiz_jobs WHERE finished_at <= ?", (cutoff,))
+
+    def _execute(self, sql: str, params: tuple) -> Optional[tuple]:
+        try:
+            row = self._db.execute(sql, params).fetchone()
+            self._db.commit()
+            return row
+        except sqlite3.Error as e:
+            logging.error(f"Quiz job store database error: {str(e)}")
+            return None
+
+    def _persist(self, job: QuizJob) -> None:
+        if self._db is None:
+            return
+        self._execute(
+            "INSERT OR REPLACE INTO quiz_jobs (id, status, questions_json, error, finished_at) VALUES (?, ?, ?, ?, ?)",
+            (job.id, job.status, json.dumps([question.model_dump() for question in job.questions]), job.error, job.finished_at)
+        )
+
+    def _load(self, job_id: str) -> Optional[QuizJob]:
+        """
+        A read-only snapshot of a job run by another worker process.
+        """
+        if self._db is None:
+            return None
+        row = self._execute(
+            "SELECT status, questions_json, error, finished_at FROM quiz_jobs WHERE id = ? AND (finished_at IS NULL OR finished_at > ?)",
+            (job_id, time.time() - self.result_ttl)
+        )
+        if row is None:
+            return None
+        job = QuizJob("", "", "", None, JOB_PRIORITIES["normal"])
+        job.id = job_id
+        job.status, job.error, job.finished_at = row[0], row[2], row[3]
+        job.questions = [QuizQuestion(**question) for question in json.loads(row[1])]
+        return job
+
+    def submit(self, topic: str, language: str, familiarity_level: str, api_key: str, priority: str = "normal") -> QuizJob:
+        """
+        Queue a quiz generation, or return the identical job already queued
+        or running. Raises AdmissionRejected when the queue is full.
+        """
+        self._expire()
+        rank = JOB_PRIORITIES.get(priority, JOB_PRIORITIES["normal"])
+        existing = self._pending.get((usage_key(api_key), topic, familiarity_level, language))
+        if existing is not None:
+            self.deduplicated += 1
+            if existing.status == "queued" and rank < existing.priority:
+                # Re-queue at the higher priority; the worker skips the stale entry
+                existing.priority = rank
+                self._queue.put_nowait((rank, next(self._seq), existing))
+            return existing
+
+        if len(self._pending) >= self.max_pending:
+            raise AdmissionRejected("The quiz queue is full. Please try again shortly.", 5)
+
+        job = QuizJob(topic, language, familiarity_level, api_key, rank)
+        self._jobs[job.id] = job
+        self._pending[job.dedup_key] = job
+        self._queue.put_nowait((rank, next(self._seq), job))
+        self.submitted += 1
+        self._persist(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[QuizJob]:
+        self._expire()
+        return self._jobs.get(job_id) or self._load(job_id)
+
+    async def wait_for_change(self, job: QuizJob, timeout: float) -> QuizJob:
+        """
+        Wait up to `timeout` seconds for the job's status to change and
+        return its latest state. Jobs of other workers are polled.
+        """
+        if self._jobs.get(job.id) is job:
+            await job.wait_for_change(timeout)
+            return job
+        deadline = time.monotonic() + timeout
+        while not job.finished and time.monotonic() < deadline:
+            await asyncio.sleep(min(SHARED_STATE_REFRESH_SECONDS, deadline - time.monotonic()))
+            latest = self._load(job.id)
+            if latest is None:
+                return job
+            if latest.status != job.status:
+                return latest
+        return job
+
+    async def _run(self, job: QuizJob) -> None:
+        job._set_status("running")
+        self._persist(job)
+        self.running += 1
+        try:
+            job.questions = await get_quiz_questions(
+                topic=job.topic,
+                language=job.language,
+                familiarity_level=job.familiarity_level,
+                api_key=job.api_key
+            )
+            if not job.questions:
+                job.error = "Failed to generate quiz questions. Please try again with a different topic."
+        except Exception as e:
+            logging.error(f"Quiz job {job.id} failed: {str(e)}")
+            job.error = f"An error occurred while generating the quiz: {str(e)}"
+        finally:
+            self.running -= 1
+            self._pending.pop(job.dedup_key, None)
+            # Don't keep the learner's key around with the result
+            job.api_key = None
+            job.finished_at = time.time()
+            self._finished.append(job)
+            if job.error:
+                self.failed += 1
+                job._set_status("failed")
+            else:
+                self.completed += 1
+                job._set_status("done")
+            self._persist(job)
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self._queue.get()
+            if job.status != "queued":
+                continue
+            await self._run(job)
+
+    def start(self) -> None:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._tasks:
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": len(self._pending) - self.running,
+            "running": self.running,
+            "retained": len(self._jobs),
+            "submitted": self.submitted,
+            "deduplicated": self.deduplicated,
+            "completed": self.completed,
+            "failed": self.failed,
+            "workers": self.workers
+        }
+
+quiz_jobs = QuizJobQueue()
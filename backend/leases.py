@@ -0,0 +1,68 @@
+import logging
+import os
+import secrets
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+from config import SHARED_STATE, FLIGHT_LEASE_PATH, FLIGHT_LEASE_TTL_SECONDS
+
+class LeaseStore:
+    """
+    Named, expiring leases in a SQLite file, so only one worker process at a
+    time does a given piece of work. A lease left behind by a crashed worker
+    simply expires after ttl_seconds.
+    """
+
+    def __init__(self, path: str = FLIGHT_LEASE_PATH, ttl_seconds: float = FLIGHT_LEASE_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        # Unique per process, including forked or spawned workers
+        self.owner = f"{os.getpid()}-{secrets.token_hex(4)}"
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        """)
+        self._lock = threading.Lock()
+        self.acquired = 0
+        self.contended = 0
+
+    def try_acquire(self, name: str) -> bool:
+        """
+        Take the lease if it is free or expired. Never blocks on other holders.
+        """
+        now = time.time()
+        try:
+            with self._lock:
+                cursor = self._db.execute(
+                    "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE leases.expires_at <= ?",
+                    (name, self.owner, now + self.ttl_seconds, now)
+                )
+        except sqlite3.Error as e:
+            # Doing the work twice beats not doing it at all
+            logging.error(f"Lease store unavailable, proceeding without a lease: {str(e)}")
+            return True
+        if cursor.rowcount == 1:
+            self.acquired += 1
+            return True
+        self.contended += 1
+        return False
+
+    def release(self, name: str) -> None:
+        try:
+            with self._lock:
+                self._db.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, self.owner))
+        except sqlite3.Error as e:
+            logging.error(f"Failed to release lease {name}: {str(e)}")
+
+    def stats(self) -> Dict[str, int]:
+        return {"acquired": self.acquired, "contended": self.contended}
+
+# Only needed when several workers serve the app; otherwise single-flight is in-process only
+flight_leases: Optional[LeaseStore] = LeaseStore() if SHARED_STATE else None
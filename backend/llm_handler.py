@@ -1,37 +1,64 @@
-import google.generativeai as genai
-from config import GEMINI_API_KEY, DEFAULT_MODEL
+from config import (
+    GEMINI_API_KEY,
+    DEFAULT_MODEL,
+    AUTO_MODEL,
+    LLM_CHAT_DEADLINE_SECONDS,
+    LLM_QUIZ_DEADLINE_SECONDS,
+    LLM_STREAM_FIRST_CHUNK_TIMEOUT_SECONDS,
+    SESSION_SUMMARY_MODEL
+)
+import asyncio
 import logging
-from typing import List, Dict, Any, Tuple
-import json
-import requests
+import math
+from typing import List, Dict, Any, Tuple, AsyncIterator, Optional
 import traceback
+import time
 from models.chat import QuizQuestion
+from quiz_parser import QuizStreamParser, BatchQuizParser
+from providers import provider, ProviderResponse, to_gemini_schema
+from response_cache import response_cache, make_cache_key
+from semantic_cache import semantic_cache, make_partition_key
+from singleflight import llm_flight, flight_key
+from usage_store import create_usage_store, usage_key
+from token_counter import count_tokens, count_prompt_tokens
+from metrics import llm_phase_duration, llm_upstream_errors, llm_tokens, llm_abandoned_calls
+from resilience import resilience, CircuitOpen, counts_against_model
+from router import ModelRouter, chat_router, quiz_router
+from sessions import Session, Turn, session_store
+from trace_recorder import trace_recorder
+from executor import run_in_background
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Dictionary to store token usage per API key
-token_usage_store = {}
+# Token usage per API key for the current billing period
+usage_store = create_usage_store()
 
 # Default quota limits for Gemini API (these are example values)
 DEFAULT_QUOTA_LIMIT = 60000  # Default monthly token limit for free tier
 
 def count_tokens_in_text(text: str) -> int:
     """
-    Estimate the number of tokens in a text string.
-    This is a simple approximation - in production, use a proper tokenizer.
+    Count the tokens in a text string with the local tokenizer.
+    Only used when the provider doesn't report usage for a response.
     """
-    # Simple approximation: 1 token ≈ 4 characters
-    return len(text) // 4
+    return count_tokens(text)
+
+def record_token_usage(api_key: str, total_tokens: Optional[int], prompt_tokens: int, response_text: str) -> None:
+    """
+    Charge a generation to an API key, preferring the provider's own usage
+    metadata (total_tokens) over the local count.
+    """
+    if total_tokens is None:
+        total_tokens = prompt_tokens + count_tokens_in_text(response_text)
+    update_token_usage(api_key, total_tokens)
 
 def update_token_usage(api_key: str, tokens_used: int) -> None:
     """
     Update the token usage for a specific API key.
     """
-    if api_key not in token_usage_store:
-        token_usage_store[api_key] = 0
-
-    token_usage_store[api_key] += tokens_used
+    usage_store.add(api_key, tokens_used)
+    llm_tokens.inc(usage_key(api_key)[:12], amount=tokens_used)
 
 async def check_api_key_quota(api_key: str) -> Dict[str, Any]:
     """
@@ -39,9 +66,6 @@ async def check_api_key_quota(api_key: str) -> Dict[str, Any]:
     Returns a dictionary with 'used' and 'limit' values.
     """
     try:
-        # Configure Gemini with the provided API key to validate it
-        genai.configure(api_key=api_key)
-
         # Validate the API key without making an actual request
         # We'll just check if the key is properly formatted and not empty
         if not api_key or len(api_key) < 10:  # Simple validation
@@ -53,12 +77,7 @@ async def check_api_key_quota(api_key: str) -> Dict[str, Any]:
 
         # Get the current token usage for this API key from our tracking system
         # This doesn't make any new API calls that would consume tokens
-        current_usage = token_usage_store.get(api_key, 0)
-
-        # In a production environment, you would:
-        # 1. Store token usage in a database
-        # 2. Reset usage counters at the beginning of each billing period
-        # 3. Possibly query Google Cloud's monitoring APIs for accurate usage data
+        current_usage = usage_store.get(api_key)
 
         return {
             "used": current_usage,
@@ -69,7 +88,7 @@ async def check_api_key_quota(api_key: str) -> Dict[str, Any]:
         logging.error(f"Error checking API key quota: {str(e)}")
         # Return an error response
         return {
-            "used": token_usage_store.get(api_key, 0),
+            "used": usage_store.get(api_key) if api_key else 0,
             "limit": DEFAULT_QUOTA_LIMIT,
             "error": str(e)
         }
@@ -104,84 +123,399 @@ Also include:
 4. Common pitfalls to avoid.
 """
 
-async def get_llm_response(topic: str, language: str, model: str, query: str, familiarity_level: str, conversation_mode: str, api_key: str = None) -> str:
-    try:
-        # Use provided API key or fallback to the one in config
-        api_key = api_key or GEMINI_API_KEY
-
-        if not api_key:
-            return "Error: No API key provided. Please enter your Google Gemini API key in the settings."
+def build_chat_prompt(
+    topic: str,
+    language: str,
+    query: str,
+    familiarity_level: str,
+    conversation_mode: str,
+    session: Optional[Session] = None
+) -> Tuple[str, int]:
+    """
+    Combine the system and user messages into a single Gemini prompt.
+    Gemini doesn't have separate system/user messages like OpenAI.
+    Returns the prompt and its token count; the system message count is memoized.
+    Session history goes between the two, so the prompt prefix stays stable
+    from one turn to the next.
+    """
+    system_prompt = get_system_message()
+    user_prompt = build_user_message(topic, language, query, familiarity_level, conversation_mode)
+    prompt_tokens = count_prompt_tokens(system_prompt, user_prompt)
+    history = session.render() if session is not None else ""
+    if not history:
+        return f"{system_prompt}\n\n{user_prompt}", prompt_tokens
+    return f"{system_prompt}\n\n{history}\n\n{user_prompt}", prompt_tokens + session.tokens
+
+def classify_llm_error(e: Exception) -> str:
+    """
+    Bucket an upstream exception into timeout, unavailable, api_key, network, model or other.
+    """
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(e, CircuitOpen):
+        return "unavailable"
+    message = str(e).lower()
+    if "api_key" in message:
+        return "api_key"
+    elif "network" in message:
+        return "network"
+    elif "model" in message:
+        return "model"
+    return "other"
+
+def format_llm_error(e: Exception) -> str:
+    """
+    Turn an upstream exception into the user-facing error string.
+    """
+    category = classify_llm_error(e)
+    if category == "timeout":
+        return "Error: Google Gemini took too long to respond. Please try again."
+    elif category == "unavailable":
+        return f"Error: The selected model is temporarily unavailable. Please try again in {math.ceil(e.retry_after)} seconds or choose a different model."
+    elif category == "api_key":
+        return "Error: Invalid or missing Google Gemini API key. Please check the backend configuration."
+    elif category == "network":
+        return "Error: Network issue while connecting to Google Gemini API. Please try again later."
+    elif category == "model":
+        return f"Error: The selected model is not available. Please try a different model. Details: {str(e)}"
+    else:
+        return f"Error: An unexpected issue occurred while processing your request. Details: {str(e)}"
+
+async def _generate_attempt(api_key: str, model: str, prompt: str, timeout: float, router: ModelRouter, **kwargs) -> ProviderResponse:
+    """
+    One timed provider call; failures are counted by category and re-raised.
+    """
+    started_at = time.time()
+    started = time.perf_counter()
+    outcome = "error"
+    chars = 0
 
-        # Configure Gemini with the provided API key
-        genai.configure(api_key=api_key)
+    def charge_abandoned(response: ProviderResponse) -> None:
+        # A losing hedge or a call past its deadline still ran to the end upstream
+        llm_abandoned_calls.inc(model)
+        record_token_usage(api_key, response.total_tokens, count_tokens_in_text(prompt), response.text)
 
-        # Create a Gemini model instance
-        gemini_model = genai.GenerativeModel(model_name=model or DEFAULT_MODEL)
+    try:
+        response = await provider.generate(api_key, model, prompt, timeout=timeout, on_abandoned=charge_abandoned, **kwargs)
+        router.observe(model, time.perf_counter() - started, failed=False)
+        outcome = "ok"
+        chars = len(response.text or "")
+        return response
+    except asyncio.CancelledError:
+        # Cancelled by the deadline or a faster hedge; the timeout is counted
+        # once it surfaces, and the elapsed time is still a lower bound on latency
+        router.observe(model, time.perf_counter() - started)
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        llm_upstream_errors.inc(classify_llm_error(e))
+        if counts_against_model(e):
+            router.observe(model, failed=True)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        llm_phase_duration.observe(elapsed, "upstream_wait", model)
+        if trace_recorder is not None:
+            trace_recorder.record_upstream(started_at, model, "generate", None, elapsed, chars, outcome)
+
+async def generate_upstream(
+    api_key: str,
+    model: str,
+    prompt: str,
+    deadline: float = LLM_CHAT_DEADLINE_SECONDS,
+    router: ModelRouter = chat_router,
+    hedge: bool = False,
+    **kwargs
+) -> ProviderResponse:
+    """
+    Provider call within `deadline` seconds, retried on transient errors and
+    failed over to a healthy model when the requested one's breaker is open.
+    model="auto" is resolved by the router, and hedged if `hedge` is set.
+    """
+    deadline_at = time.monotonic() + deadline
 
-        # Build the prompt with system and user messages
-        system_prompt = get_system_message()
-        user_prompt = build_user_message(topic, language, query, familiarity_level, conversation_mode)
+    def call(resolved_model: str):
+        return resilience.call(
+            resolved_model,
+            lambda attempt_model, timeout: _generate_attempt(api_key, attempt_model, prompt, timeout, router, **kwargs),
+            deadline_at - time.monotonic()
+        )
 
-        # Combine prompts for Gemini (which doesn't have separate system/user messages like OpenAI)
-        combined_prompt = f"{system_prompt}\n\n{user_prompt}"
+    try:
+        if model != AUTO_MODEL:
+            return await call(model)
+        if hedge:
+            return await router.hedged(call)
+        return await call(router.choose())
+    except (asyncio.TimeoutError, CircuitOpen) as e:
+        llm_upstream_errors.inc(classify_llm_error(e))
+        raise
+
+async def _stream_attempt(api_key: str, model: str, prompt: str, timeout: float, router: ModelRouter, **kwargs) -> AsyncIterator[ProviderResponse]:
+    started_at = time.time()
+    started = time.perf_counter()
+    first_chunk_seconds = None
+    outcome = "error"
+    chars = 0
+    try:
+        async for chunk in provider.stream(api_key, model, prompt, timeout=timeout, **kwargs):
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.perf_counter() - started
+                llm_phase_duration.observe(first_chunk_seconds, "upstream_first_chunk", model)
+            chars += len(chunk.text or "")
+            yield chunk
+        # Sampled like a generate call: the time to the whole response
+        router.observe(model, time.perf_counter() - started, failed=False)
+        outcome = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        llm_upstream_errors.inc(classify_llm_error(e))
+        if counts_against_model(e):
+            router.observe(model, failed=True)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        llm_phase_duration.observe(elapsed, "upstream_wait", model)
+        if trace_recorder is not None:
+            trace_recorder.record_upstream(started_at, model, "stream", first_chunk_seconds, elapsed, chars, outcome)
+
+async def stream_upstream(
+    api_key: str,
+    model: str,
+    prompt: str,
+    deadline: float = LLM_CHAT_DEADLINE_SECONDS,
+    router: ModelRouter = chat_router,
+    **kwargs
+) -> AsyncIterator[ProviderResponse]:
+    """
+    Streaming counterpart of generate_upstream; also times the first chunk.
+    Retries and failover only happen before the first chunk is yielded.
+    Streams aren't hedged, since a second stream can't be merged into the first.
+    """
+    if model == AUTO_MODEL:
+        model = router.choose()
+    try:
+        async for chunk in resilience.stream(
+            model,
+            lambda attempt_model, timeout: _stream_attempt(api_key, attempt_model, prompt, timeout, router, **kwargs),
+            LLM_STREAM_FIRST_CHUNK_TIMEOUT_SECONDS,
+            deadline
+        ):
+            yield chunk
+    except (asyncio.TimeoutError, CircuitOpen) as e:
+        llm_upstream_errors.inc(classify_llm_error(e))
+        raise
+
+def remember_response(cache_key: Optional[str], partition_key: Optional[str], query: str, response: str) -> None:
+    """
+    Store a finished tutor response under its exact key and, for paraphrases
+    of the query, in the semantic cache.
+    """
+    if cache_key is not None:
+        response_cache.set(cache_key, response)
+    if partition_key is not None:
+        semantic_cache.set(partition_key, query, response)
+
+def cached_chunks(cache_key: str) -> Optional[List[str]]:
+    # A stream finished by another worker is replayed as a single chunk
+    response = response_cache.peek(cache_key)
+    return [response] if response is not None else None
+
+async def _generate_chat_response(
+    cache_key: Optional[str],
+    combined_prompt: str,
+    prompt_tokens: int,
+    model: str,
+    api_key: str,
+    partition_key: Optional[str] = None,
+    query: str = ""
+) -> str:
+    # Auto-routed chat requests are hedged against tail latency
+    response = await generate_upstream(api_key, model, combined_prompt, hedge=True)
+
+    # Update token usage for this API key
+    record_token_usage(api_key, response.total_tokens, prompt_tokens, response.text)
+
+    remember_response(cache_key, partition_key, query, response.text)
+    return response.text
+
+def summary_prompt(session: Session, turns: List[Turn]) -> str:
+    conversation = "\n".join(f"{turn.role}: {turn.text}" for turn in turns)
+    previous = f"Summary so far: {session.summary}\n\n" if session.summary else ""
+    return f"""Summarize this Python tutoring conversation in at most 150 words, for the tutor's own reference.
+Keep what the student has already learned, code they wrote or were shown, mistakes they made and any open questions.
+
+{previous}{conversation}
+"""
 
-        # Generate content
-        response = gemini_model.generate_content(combined_prompt)
+async def compact_session(session: Session, api_key: str) -> None:
+    """
+    Fold the session's older turns into its summary, so the history sent
+    with each prompt stays within SESSION_HISTORY_TOKEN_BUDGET.
+    """
+    turns, count = session.compactable()
+    try:
+        prompt = summary_prompt(session, turns)
+        response = await generate_upstream(
+            api_key,
+            SESSION_SUMMARY_MODEL,
+            prompt,
+            generation_config={"temperature": 0.2, "max_output_tokens": 400}
+        )
+        record_token_usage(api_key, response.total_tokens, count_tokens_in_text(prompt), response.text)
+        session.apply_summary(response.text.strip(), count)
+        session_store.compactions += 1
+    except Exception as e:
+        # Without a summary the oldest turns are simply forgotten
+        logging.error(f"Error while compacting session history: {str(e)}")
+        session.drop_oldest(count)
+    finally:
+        session.compacting = False
+        session_store.save(session)
+
+def record_exchange(session: Session, query: str, response: str, api_key: str) -> None:
+    """
+    Append a completed turn to the session and start a compaction in the
+    background once the history is over budget.
+    """
+    session.add("Student", query)
+    session.add("Tutor", response)
+    session.enforce_hard_limit()
+    session_store.save(session)
+    if session.needs_compaction() and not session.compacting:
+        session.compacting = True
+        run_in_background(compact_session(session, api_key))
+
+async def get_llm_response(topic: str, language: str, model: str, query: str, familiarity_level: str, conversation_mode: str, api_key: str = None, session_id: str = None) -> str:
+    try:
+        # Use provided API key or fallback to the one in config
+        api_key = api_key or GEMINI_API_KEY
 
-        # Count tokens and update usage
-        prompt_tokens = count_tokens_in_text(combined_prompt)
-        response_tokens = count_tokens_in_text(response.text)
-        total_tokens = prompt_tokens + response_tokens
+        if not api_key:
+            return "Error: No API key provided. Please enter your Google Gemini API key in the settings."
 
-        # Update token usage for this API key
-        update_token_usage(api_key, total_tokens)
+        model = model or DEFAULT_MODEL
+        session = session_store.get(api_key, session_id) if session_id else None
 
-        # Return the text response
-        return response.text
+        if session is not None and session.render():
+            # Follow-up turns depend on the conversation, so they are neither
+            # cached nor shared with other requests
+            with llm_phase_duration.time("prompt_build", model):
+                combined_prompt, prompt_tokens = build_chat_prompt(topic, language, query, familiarity_level, conversation_mode, session)
+            response = await _generate_chat_response(None, combined_prompt, prompt_tokens, model, api_key)
+        else:
+            # Serve repeat explanations from the cache without an upstream call,
+            # falling back to a close paraphrase asked earlier on the same topic
+            cache_key = make_cache_key(topic, familiarity_level, conversation_mode, language, model, query)
+            partition_key = make_partition_key(topic, familiarity_level, conversation_mode, language, model)
+            response = response_cache.get(cache_key)
+            if response is None:
+                response = semantic_cache.get(partition_key, query)
+                if response is not None:
+                    response_cache.set(cache_key, response)
+            if response is None:
+                # Build the prompt with system and user messages
+                with llm_phase_duration.time("prompt_build", model):
+                    combined_prompt, prompt_tokens = build_chat_prompt(topic, language, query, familiarity_level, conversation_mode)
+
+                # Identical concurrent requests on one key share one upstream call;
+                # other keys get its result from the response cache once it's done
+                response = await llm_flight.do(
+                    flight_key("chat", api_key, cache_key),
+                    lambda: _generate_chat_response(cache_key, combined_prompt, prompt_tokens, model, api_key, partition_key, query),
+                    lookup=lambda: response_cache.peek(cache_key)
+                )
+
+        if session is not None:
+            record_exchange(session, query, response, api_key)
+        return response
 
     except Exception as e:
         logging.error(f"Error while fetching LLM response: {str(e)}")
-
-        if "api_key" in str(e).lower():
-            return "Error: Invalid or missing Google Gemini API key. Please check the backend configuration."
-        elif "network" in str(e).lower():
-            return "Error: Network issue while connecting to Google Gemini API. Please try again later."
-        elif "model" in str(e).lower():
-            return f"Error: The selected model is not available. Please try a different model. Details: {str(e)}"
-        else:
-            return f"Error: An unexpected issue occurred while processing your request. Details: {str(e)}"
-
-async def generate_quiz(topic: str, language: str, model: str, familiarity_level: str, api_key: str = None) -> List[QuizQuestion]:
+        return format_llm_error(e)
+
+async def _stream_chat_response(
+    cache_key: Optional[str],
+    combined_prompt: str,
+    prompt_tokens: int,
+    model: str,
+    api_key: str,
+    partition_key: Optional[str] = None,
+    query: str = ""
+) -> AsyncIterator[str]:
+    response_parts = []
+    total_tokens = None
     try:
-        # Use provided API key or fallback to the one in config
-        api_key = api_key or GEMINI_API_KEY
-
-        if not api_key:
-            logging.error("No API key provided for quiz generation")
-            return []
+        async for chunk in stream_upstream(api_key, model, combined_prompt):
+            total_tokens = chunk.total_tokens or total_tokens
+            text = chunk.text
+            if text:
+                response_parts.append(text)
+                yield text
+        # Only a stream that ran to completion is worth caching
+        remember_response(cache_key, partition_key, query, "".join(response_parts))
+    finally:
+        # Count whatever was produced, even if the stream failed part way
+        if response_parts:
+            record_token_usage(api_key, total_tokens, prompt_tokens, "".join(response_parts))
+
+async def stream_llm_response(topic: str, language: str, model: str, query: str, familiarity_level: str, conversation_mode: str, api_key: str = None, session_id: str = None) -> AsyncIterator[str]:
+    """
+    Yield the tutor response chunk by chunk as Gemini produces it.
+    Errors are yielded as a single error string, same as get_llm_response.
+    """
+    api_key = api_key or GEMINI_API_KEY
 
-        # Configure Gemini with the provided API key
-        genai.configure(api_key=api_key)
+    if not api_key:
+        yield "Error: No API key provided. Please enter your Google Gemini API key in the settings."
+        return
 
-        # Create a Gemini model instance with specific generation parameters
-        generation_config = {
-            "temperature": 0.2,  # Lower temperature for more deterministic output
-            "top_p": 0.95,       # High top_p for more focused output
-            "top_k": 40,         # Reasonable top_k
-            "max_output_tokens": 8192,  # Higher token limit for complex JSON responses
-        }
+    model = model or DEFAULT_MODEL
+    session = session_store.get(api_key, session_id) if session_id else None
+    response_parts = []
+    try:
+        if session is not None and session.render():
+            with llm_phase_duration.time("prompt_build", model):
+                combined_prompt, prompt_tokens = build_chat_prompt(topic, language, query, familiarity_level, conversation_mode, session)
+            async for text in _stream_chat_response(None, combined_prompt, prompt_tokens, model, api_key):
+                response_parts.append(text)
+                yield text
+        else:
+            cache_key = make_cache_key(topic, familiarity_level, conversation_mode, language, model, query)
+            partition_key = make_partition_key(topic, familiarity_level, conversation_mode, language, model)
+            cached_response = response_cache.get(cache_key)
+            if cached_response is None:
+                cached_response = semantic_cache.get(partition_key, query)
+                if cached_response is not None:
+                    response_cache.set(cache_key, cached_response)
+            if cached_response is not None:
+                response_parts.append(cached_response)
+                yield cached_response
+            else:
+                with llm_phase_duration.time("prompt_build", model):
+                    combined_prompt, prompt_tokens = build_chat_prompt(topic, language, query, familiarity_level, conversation_mode)
+                # Concurrent identical streams replay the chunks of a single upstream stream
+                async for text in llm_flight.stream(
+                    flight_key("chat-stream", api_key, cache_key),
+                    lambda: _stream_chat_response(cache_key, combined_prompt, prompt_tokens, model, api_key, partition_key, query),
+                    lookup=lambda: cached_chunks(cache_key)
+                ):
+                    response_parts.append(text)
+                    yield text
+    except Exception as e:
+        logging.error(f"Error while streaming LLM response: {str(e)}")
+        yield format_llm_error(e)
+        return
 
-        # Always use the most capable model for quiz generation
-        # Gemini 1.5 Pro is better at following structured output instructions
-        # Use the model passed from the API call, or default to gemini-1.5-pro
-        quiz_model = model if model in ["gemini-1.5-pro", "gemini-1.5-flash"] else "gemini-1.5-pro"
-        gemini_model = genai.GenerativeModel(
-            model_name=quiz_model,
-            generation_config=generation_config
-        )
+    if session is not None:
+        record_exchange(session, query, "".join(response_parts), api_key)
 
-        # Build the quiz generation prompt with clearer JSON formatting instructions
-        prompt = f"""Generate a quiz to test knowledge on the Python topic: {topic}
+def build_quiz_prompt(topic: str, language: str, familiarity_level: str) -> str:
+    # Output structure is enforced by QUIZ_RESPONSE_SCHEMA, so the prompt only
+    # has to describe the content
+    return f"""Generate a quiz to test knowledge on the Python topic: {topic}
 
 The quiz should be appropriate for a learner with {familiarity_level} level of Python familiarity.
 Create 5 multiple-choice questions with 4 options each.
@@ -190,188 +524,257 @@ For each question, provide:
 1. A clear explanation of why the correct answer is right
 2. 3-4 specific improvement suggestions in {language} for someone who got it wrong
 
-IMPORTANT FORMATTING INSTRUCTIONS:
-- Your response must be VALID JSON that can be parsed with json.loads()
-- Do not include any text before or after the JSON
-- Do not include markdown formatting like ```json or ```
-- Do not include any explanations outside the JSON structure
-- The correct_answer field must be a number (0, 1, 2, or 3) representing the index of the correct option
-
-Format your response as a JSON array of objects with the following structure:
-[
-  {{
-    "question": "Question text here",
-    "options": ["Option 1", "Option 2", "Option 3", "Option 4"],
-    "correct_answer": 0,
-    "explanation": "Detailed explanation of why this answer is correct",
-    "improvement_suggestions": [
-      "Suggestion 1 in {language}",
-      "Suggestion 2 in {language}",
-      "Suggestion 3 in {language}"
-    ]
-  }},
-  ...
+Ensure the questions are challenging but appropriate for the {familiarity_level} level.
+The quiz should be in {language} language.
+"""
+
+QUIZ_SYSTEM_PROMPT = "You are a Python quiz generator."
+
+# Structured output: the model must return a JSON array of QuizQuestion objects
+QUIZ_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": to_gemini_schema(QuizQuestion.model_json_schema())
+}
+
+# Generation parameters for structured quiz output
+QUIZ_GENERATION_CONFIG = {
+    "temperature": 0.2,  # Lower temperature for more deterministic output
+    "top_p": 0.95,       # High top_p for more focused output
+    "top_k": 40,         # Reasonable top_k
+    "max_output_tokens": 8192,  # Higher token limit for complex JSON responses
+    "response_mime_type": "application/json",
+    "response_schema": QUIZ_RESPONSE_SCHEMA,
+}
+
+# Safety settings adjusted for code generation
+QUIZ_SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_ONLY_HIGH"
+    },
 ]
 
+def build_batch_quiz_prompt(topics: List[str], language: str, familiarity_level: str, question_count: int) -> str:
+    topic_list = "\n".join(f"- {topic}" for topic in topics)
+    return f"""Generate a quiz to test knowledge on each of these Python topics:
+{topic_list}
+
+The quiz should be appropriate for a learner with {familiarity_level} level of Python familiarity.
+Create {question_count} multiple-choice questions with 4 options each for every topic, {question_count * len(topics)} questions in total.
+Set each question's topic to its topic exactly as listed above, and keep each topic's questions together.
+
+For each question, provide:
+1. A clear explanation of why the correct answer is right
+2. 3-4 specific improvement suggestions in {language} for someone who got it wrong
+
 Ensure the questions are challenging but appropriate for the {familiarity_level} level.
 The quiz should be in {language} language.
 """
 
-        # Generate content with a stronger system prompt
-        system_prompt = """You are a Python quiz generator that ALWAYS returns valid JSON.
-Your output must be parseable by Python's json.loads() function.
-Never include explanatory text outside the JSON structure.
-Never use markdown code blocks.
-Always ensure the correct_answer field is a number (0-3)."""
-
-        combined_prompt = f"{system_prompt}\n\n{prompt}"
-
-        # Generate content with safety settings adjusted for code generation
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_ONLY_HIGH"
-            },
-        ]
-
-        response = gemini_model.generate_content(
+# Batch output is the same flat question array, each question tagged with its topic
+_QUIZ_ITEM_SCHEMA = QUIZ_RESPONSE_SCHEMA["items"]
+BATCH_QUIZ_RESPONSE_SCHEMA = {
+    "type": "array",
+    "items": {
+        **_QUIZ_ITEM_SCHEMA,
+        "properties": {
+            "topic": {"type": "string", "description": "The topic this question tests, exactly as listed"},
+            **_QUIZ_ITEM_SCHEMA["properties"]
+        },
+        "required": ["topic"] + _QUIZ_ITEM_SCHEMA.get("required", [])
+    }
+}
+BATCH_QUIZ_GENERATION_CONFIG = {**QUIZ_GENERATION_CONFIG, "response_schema": BATCH_QUIZ_RESPONSE_SCHEMA}
+
+def count_quiz_prompt_tokens(topic: str, language: str, familiarity_level: str) -> int:
+    return count_prompt_tokens(QUIZ_SYSTEM_PROMPT, build_quiz_prompt(topic, language, familiarity_level))
+
+def count_batch_quiz_prompt_tokens(topics: List[str], language: str, familiarity_level: str, question_count: int) -> int:
+    return count_prompt_tokens(QUIZ_SYSTEM_PROMPT, build_batch_quiz_prompt(topics, language, familiarity_level, question_count))
+
+def quiz_model_for(model: str) -> str:
+    # Always use the most capable model for quiz generation
+    # Gemini 1.5 Pro is better at following structured output instructions
+    # Use the model passed from the API call, or default to gemini-1.5-pro.
+    # "auto" is routed among ROUTER_MODELS, which all support response_schema
+    return model if model in [AUTO_MODEL, "gemini-1.5-pro", "gemini-1.5-flash"] else "gemini-1.5-pro"
+
+def prepare_quiz_request(topic: str, language: str, model: str, familiarity_level: str) -> Tuple[str, str]:
+    """
+    Pick the quiz model and build the combined quiz prompt.
+    """
+    quiz_model = quiz_model_for(model)
+
+    # Build the quiz generation prompt
+    with llm_phase_duration.time("prompt_build", quiz_model):
+        prompt = build_quiz_prompt(topic, language, familiarity_level)
+        combined_prompt = f"{QUIZ_SYSTEM_PROMPT}\n\n{prompt}"
+    return quiz_model, combined_prompt
+
+def observe_quiz_parse(parser: QuizStreamParser, parse_seconds: float, quiz_model: str, content: str) -> None:
+    """
+    Record parse and validation time and log any dropped questions.
+    """
+    llm_phase_duration.observe(parse_seconds - parser.validate_seconds, "parse", quiz_model)
+    llm_phase_duration.observe(parser.validate_seconds, "validate", quiz_model)
+
+    if parser.dropped:
+        logging.warning(f"Dropped {parser.dropped} malformed quiz question(s) for {parser.topic}")
+        logging.warning(f"Raw response: {content[:500]}...")  # Log first 500 chars
+
+async def generate_quiz(topic: str, language: str, model: str, familiarity_level: str, api_key: str = None) -> List[QuizQuestion]:
+    try:
+        # Use provided API key or fallback to the one in config
+        api_key = api_key or GEMINI_API_KEY
+
+        if not api_key:
+            logging.error("No API key provided for quiz generation")
+            return []
+
+        quiz_model, combined_prompt = prepare_quiz_request(topic, language, model, familiarity_level)
+
+        response = await generate_upstream(
+            api_key,
+            quiz_model,
             combined_prompt,
-            safety_settings=safety_settings
+            deadline=LLM_QUIZ_DEADLINE_SECONDS,
+            router=quiz_router,
+            generation_config=QUIZ_GENERATION_CONFIG,
+            safety_settings=QUIZ_SAFETY_SETTINGS
         )
         content = response.text
 
-        # Count tokens and update usage
-        prompt_tokens = count_tokens_in_text(combined_prompt)
-        response_tokens = count_tokens_in_text(content)
-        total_tokens = prompt_tokens + response_tokens
-
         # Update token usage for this API key
-        update_token_usage(api_key, total_tokens)
-
-        # Parse the JSON response with improved error handling
-        try:
-            # Clean the response to ensure it's valid JSON
-            # Remove any markdown formatting or extra text
-            cleaned_content = content.strip()
-
-            # Remove markdown code blocks if present
-            if cleaned_content.startswith("```json"):
-                cleaned_content = cleaned_content.replace("```json", "", 1)
-            if cleaned_content.startswith("```"):
-                cleaned_content = cleaned_content.replace("```", "", 1)
-            if cleaned_content.endswith("```"):
-                cleaned_content = cleaned_content[:-3]
-
-            cleaned_content = cleaned_content.strip()
-
-            # Try to find JSON array in the response if there's extra text
-            if not cleaned_content.startswith("["):
-                start_idx = cleaned_content.find("[")
-                end_idx = cleaned_content.rfind("]")
-                if start_idx != -1 and end_idx != -1:
-                    cleaned_content = cleaned_content[start_idx:end_idx+1]
-
-            # Log the cleaned content for debugging
-            logging.info(f"Attempting to parse JSON: {cleaned_content[:100]}...")
-
-            # Parse the JSON
-            quiz_data = json.loads(cleaned_content)
-
-            if not quiz_data:
-                logging.error("Quiz generation failed: Empty quiz data")
-                return []
-
-            if len(quiz_data) < 3:  # Accept at least 3 questions instead of requiring 5
-                logging.error(f"Quiz generation failed: Only {len(quiz_data)} questions generated")
-                return []
-
-        except json.JSONDecodeError as e:
-            logging.error(f"Error parsing quiz response: {str(e)}")
-            logging.error(f"Raw response: {content[:500]}...")  # Log first 500 chars
-
-            # Try one more time with a different approach - extract JSON using regex
-            import re
-            try:
-                json_pattern = r'\[\s*\{.*\}\s*\]'
-                json_match = re.search(json_pattern, content, re.DOTALL)
-                if json_match:
-                    potential_json = json_match.group(0)
-                    quiz_data = json.loads(potential_json)
-                    logging.info("Successfully parsed JSON using regex approach")
-                else:
-                    return []
-            except Exception:
-                return []
-
-        questions = []
-        for q in quiz_data:
-            try:
-                # Validate and fix the correct_answer field if needed
-                correct_answer = q.get("correct_answer")
-
-                # Handle string values (convert to int)
-                if isinstance(correct_answer, str):
-                    try:
-                        correct_answer = int(correct_answer)
-                    except ValueError:
-                        # If it can't be converted, default to 0
-                        logging.warning(f"Invalid correct_answer format: {correct_answer}, defaulting to 0")
-                        correct_answer = 0
-
-                # Ensure correct_answer is within valid range
-                options = q.get("options", [])
-                if not options:
-                    logging.error("Question has no options")
-                    continue
-
-                if correct_answer is None or not isinstance(correct_answer, int) or correct_answer < 0 or correct_answer >= len(options):
-                    logging.warning(f"Invalid correct_answer: {correct_answer}, defaulting to 0")
-                    correct_answer = 0
-
-                # Ensure we have improvement suggestions
-                improvement_suggestions = q.get("improvement_suggestions", [])
-                if not improvement_suggestions:
-                    improvement_suggestions = [
-                        f"Review the concept of {topic} in more detail.",
-                        f"Practice with more examples to better understand {topic}.",
-                        f"Consider reviewing the documentation for {topic}."
-                    ]
-
-                # Create the question object
-                questions.append(QuizQuestion(
-                    question=q.get("question", "Question text not provided"),
-                    options=options,
-                    correct_answer=correct_answer,
-                    explanation=q.get("explanation", "Explanation not provided"),
-                    improvement_suggestions=improvement_suggestions
-                ))
-            except KeyError as e:
-                logging.error(f"Missing required field in quiz question: {str(e)}")
-                continue
-            except Exception as e:
-                logging.error(f"Error processing quiz question: {str(e)}")
-                continue
-
-        if not questions:
-            logging.error("No valid questions were generated")
+        record_token_usage(api_key, response.total_tokens, count_quiz_prompt_tokens(topic, language, familiarity_level), content)
+
+        # Parse and validate in one pass; a malformed question is dropped
+        # without taking the rest of the quiz with it
+        parse_started = time.perf_counter()
+        parser = QuizStreamParser(topic, max_questions=5)
+        parser.feed(content)
+        parser.close()
+        questions = parser.questions
+        observe_quiz_parse(parser, time.perf_counter() - parse_started, quiz_model, content)
+
+        if len(questions) < 3:  # Accept at least 3 questions instead of requiring 5
+            logging.error(f"Quiz generation failed: Only {len(questions)} valid questions generated")
             return []
 
-        # Limit to 5 questions maximum
-        return questions[:5]
+        return questions
     except Exception as e:
         error_details = traceback.format_exc()
         logging.error(f"Error while generating quiz: {str(e)}")
         logging.error(f"Detailed traceback: {error_details}")
         return []
+
+async def stream_quiz(topic: str, language: str, model: str, familiarity_level: str, api_key: str = None) -> AsyncIterator[QuizQuestion]:
+    """
+    Yield quiz questions one by one as their objects close in the model's
+    streamed output, so the first question can be shown while the rest are
+    still being generated. Upstream errors are raised to the caller.
+    """
+    api_key = api_key or GEMINI_API_KEY
+    if not api_key:
+        raise ValueError("No API key provided for quiz generation")
+
+    quiz_model, combined_prompt = prepare_quiz_request(topic, language, model, familiarity_level)
+    parser = QuizStreamParser(topic, max_questions=5)
+    response_parts = []
+    total_tokens = None
+    parse_seconds = 0.0
+    try:
+        async for chunk in stream_upstream(
+            api_key,
+            quiz_model,
+            combined_prompt,
+            deadline=LLM_QUIZ_DEADLINE_SECONDS,
+            router=quiz_router,
+            generation_config=QUIZ_GENERATION_CONFIG,
+            safety_settings=QUIZ_SAFETY_SETTINGS
+        ):
+            total_tokens = chunk.total_tokens or total_tokens
+            if not chunk.text:
+                continue
+            response_parts.append(chunk.text)
+            parse_started = time.perf_counter()
+            completed = parser.feed(chunk.text)
+            parse_seconds += time.perf_counter() - parse_started
+            for question in completed:
+                yield question
+        parser.close()
+        observe_quiz_parse(parser, parse_seconds, quiz_model, "".join(response_parts))
+    finally:
+        # Count whatever was produced, even if the stream failed part way
+        if response_parts:
+            record_token_usage(
+                api_key,
+                total_tokens,
+                count_quiz_prompt_tokens(topic, language, familiarity_level),
+                "".join(response_parts)
+            )
+
+async def stream_batch_quiz(
+    topics: List[str],
+    language: str,
+    model: str,
+    familiarity_level: str,
+    question_count: int,
+    api_key: str = None
+) -> AsyncIterator[Tuple[str, QuizQuestion]]:
+    """
+    Quiz several topics with one upstream generation, yielding
+    (topic, question) pairs as each question's object closes. Questions
+    for unrequested topics, or beyond question_count for a topic, are dropped.
+    """
+    api_key = api_key or GEMINI_API_KEY
+    if not api_key:
+        raise ValueError("No API key provided for quiz generation")
+
+    quiz_model = quiz_model_for(model)
+    with llm_phase_duration.time("prompt_build", quiz_model):
+        combined_prompt = f"{QUIZ_SYSTEM_PROMPT}\n\n{build_batch_quiz_prompt(topics, language, familiarity_level, question_count)}"
+    parser = BatchQuizParser(topics, question_count)
+    response_parts = []
+    total_tokens = None
+    parse_seconds = 0.0
+    try:
+        async for chunk in stream_upstream(
+            api_key,
+            quiz_model,
+            combined_prompt,
+            deadline=LLM_QUIZ_DEADLINE_SECONDS,
+            router=quiz_router,
+            generation_config=BATCH_QUIZ_GENERATION_CONFIG,
+            safety_settings=QUIZ_SAFETY_SETTINGS
+        ):
+            total_tokens = chunk.total_tokens or total_tokens
+            if not chunk.text:
+                continue
+            response_parts.append(chunk.text)
+            parse_started = time.perf_counter()
+            completed = parser.feed_tagged(chunk.text)
+            parse_seconds += time.perf_counter() - parse_started
+            for topic, question in completed:
+                yield topic, question
+        parser.close()
+        observe_quiz_parse(parser, parse_seconds, quiz_model, "".join(response_parts))
+    finally:
+        if response_parts:
+            record_token_usage(
+                api_key,
+                total_tokens,
+                count_batch_quiz_prompt_tokens(topics, language, familiarity_level, question_count),
+                "".join(response_parts)
+            )
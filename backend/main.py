@@ -1,19 +1,95 @@
-from fastapi import FastAPI
+import json
+import logging
+import time
+import traceback
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from models.chat import ChatRequest, ChatResponse, QuizResponse, QuotaRequest, QuotaResponse
-from llm_handler import get_llm_response, generate_quiz, check_api_key_quota
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from models.chat import (
+    ChatRequest,
+    ChatResponse,
+    QuizResponse,
+    QuizJobResponse,
+    BatchQuizRequest,
+    BatchQuizResponse,
+    TopicQuiz,
+    QuotaRequest,
+    QuotaResponse
+)
+from executor import shutdown_executor
+from response_cache import response_cache
+from semantic_cache import semantic_cache
+from singleflight import llm_flight
+from resilience import resilience
+from router import chat_router, quiz_router
+from sessions import session_store
+from llm_handler import (
+    get_llm_response,
+    stream_llm_response,
+    check_api_key_quota,
+    build_chat_prompt,
+    count_quiz_prompt_tokens,
+    count_batch_quiz_prompt_tokens,
+    usage_store,
+    DEFAULT_QUOTA_LIMIT
+)
+from admission import AdmissionController, AdmissionRejected
+from metrics import registry, http_request_duration, CallbackGauge
+from catalog import catalog_payload
+from quiz_bank import quiz_bank, quiz_bank_refiller, get_quiz_questions, stream_quiz_questions, stream_chapter_quiz
+from jobs import JOB_PRIORITIES, quiz_jobs
+from warmup import warmup_store, warmup_runner
+from websocket_channel import TutorChannel
+from trace_recorder import trace_recorder, TraceRecordingMiddleware
 from config import (
-    AVAILABLE_MODELS,
-    AVAILABLE_LANGUAGES,
-    AVAILABLE_TOPICS,
-    AVAILABLE_CHAPTERS,
-    CHAPTER_TOPICS,
-    FAMILIARITY_LEVELS,
-    CONVERSATION_MODES
+    GEMINI_API_KEY,
+    CONFIG_CACHE_MAX_AGE_SECONDS,
+    QUIZ_JOB_MAX_WAIT_SECONDS,
+    WARMUP_ON_STARTUP,
+    SERVER_HOST,
+    SERVER_PORT,
+    SERVER_WORKERS
 )
 
 app = FastAPI()
 
+class RequestTimingMiddleware:
+    """
+    Plain ASGI middleware (no BaseHTTPMiddleware task overhead) that records
+    request latency per endpoint, including the full body of streamed responses.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # The router stores the matched endpoint in the scope, which keeps
+            # the label set bounded regardless of the request path
+            endpoint = scope.get("endpoint")
+            name = getattr(endpoint, "__name__", "unmatched")
+            http_request_duration.observe(time.perf_counter() - started, name, f"{status[0] // 100}xx")
+
+app.add_middleware(RequestTimingMiddleware)
+
+# Opt-in request and upstream timing traces for offline replay
+if trace_recorder is not None:
+    app.add_middleware(TraceRecordingMiddleware, recorder=trace_recorder)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -23,39 +99,251 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# @app.get("/api/config")
+# Rate limits, quota projection and the upstream wait queue
+admission = AdmissionController(usage_store, DEFAULT_QUOTA_LIMIT, server_key=GEMINI_API_KEY)
+
+# Gauges are read from the components at scrape time
+registry.register(CallbackGauge("response_cache_entries", "Entries in the in-memory response cache", lambda: response_cache.stats()["entries"]))
+registry.register(CallbackGauge("response_cache_lookups", "Response cache lookups by result", lambda: {
+    "hit": response_cache.hits, "disk_hit": response_cache.disk_hits, "miss": response_cache.misses
+}, label_name="result"))
+registry.register(CallbackGauge("semantic_cache_lookups", "Semantic cache lookups by result", lambda: {
+    "hit": semantic_cache.hits, "miss": semantic_cache.misses
+}, label_name="result"))
+registry.register(CallbackGauge("quiz_bank_questions", "Questions stored in the quiz bank", lambda: quiz_bank.stats()["questions"]))
+registry.register(CallbackGauge("single_flight_calls", "Coalesced LLM calls by outcome", lambda: {
+    "upstream": llm_flight.calls, "deduplicated": llm_flight.deduplicated
+}, label_name="outcome"))
+registry.register(CallbackGauge("admission_queue", "Requests holding or waiting for an upstream slot", lambda: {
+    "in_flight": admission.in_flight, "waiting": admission.waiting
+}, label_name="state"))
+registry.register(CallbackGauge("llm_circuit_open", "1 if the model's circuit breaker is open or probing", lambda: {
+    model: int(breaker.state != "closed") for model, breaker in resilience.breakers.items()
+}, label_name="model"))
+registry.register(CallbackGauge("llm_retries", "Upstream attempts retried after a transient error", lambda: resilience.retries))
+registry.register(CallbackGauge("quiz_jobs", "Quiz jobs queued or running", lambda: {
+    "queued": quiz_jobs.stats()["queued"], "running": quiz_jobs.running
+}, label_name="state"))
+registry.register(CallbackGauge("admission_rejected", "Requests rejected with 429", lambda: admission.rejected))
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"error": exc.reason},
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+def admission_key(request: ChatRequest) -> str:
+    """
+    The key a request is admitted and charged under: the learner's own, or
+    the server's when chat falls back to it, which admission exempts from
+    the per-key quota and rate limits. Quiz endpoints require their own key
+    and check it before admitting.
+    """
+    return request.api_key or GEMINI_API_KEY
+
+def chat_prompt_tokens(request: ChatRequest) -> int:
+    prompt_tokens = build_chat_prompt(
+        request.topic,
+        request.language,
+        request.query,
+        request.familiarity_level,
+        request.conversation_mode
+    )[1]
+    return prompt_tokens + session_store.history_tokens(admission_key(request), request.session_id)
+
+@app.on_event("startup")
+async def on_startup():
+    quiz_bank_refiller.start()
+    quiz_jobs.start()
+    if WARMUP_ON_STARTUP:
+        # Fills the caches in the background; requests are served meanwhile
+        warmup_runner.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await quiz_bank_refiller.stop()
+    await quiz_jobs.stop()
+    await warmup_runner.stop()
+    warmup_store.close()
+    if trace_recorder is not None:
+        trace_recorder.close()
+    shutdown_executor()
+    usage_store.close()
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to my FastAPI app!"}
-async def get_config():
-    return {
-        "models": AVAILABLE_MODELS,
-        "languages": AVAILABLE_LANGUAGES,
-        "chapters": AVAILABLE_CHAPTERS,
-        "chapterTopics": CHAPTER_TOPICS,
-        "topics": AVAILABLE_TOPICS,  # Keep for backward compatibility
-        "familiarityLevels": FAMILIARITY_LEVELS,
-        "conversationModes": CONVERSATION_MODES
+
+@app.get("/api/config")
+async def get_config(request: Request):
+    headers = {
+        "Cache-Control": f"public, max-age={CONFIG_CACHE_MAX_AGE_SECONDS}",
+        "Vary": "Accept-Encoding"
     }
+    use_gzip = "gzip" in request.headers.get("accept-encoding", "")
+    headers["ETag"] = catalog_payload.gzip_etag if use_gzip else catalog_payload.etag
+
+    # Repeat loads revalidate and get an empty 304
+    if catalog_payload.matches(request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(catalog_payload.gzip_body, media_type="application/json", headers=headers)
+    return Response(catalog_payload.body, media_type="application/json", headers=headers)
 
 @app.post("/api/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
-    try:
-        response = await get_llm_response(
-            topic=request.topic,
-            language=request.language,
-            model=request.model,
-            query=request.query,
-            familiarity_level=request.familiarity_level,
-            conversation_mode=request.conversation_mode,
-            api_key=request.api_key
-        )
-        return ChatResponse(response=response)
-    except Exception as e:
-        return ChatResponse(response="", error=str(e))
+    warmup_store.record_request(request.topic)
+    async with admission.admit(admission_key(request), chat_prompt_tokens(request)):
+        try:
+            response = await get_llm_response(
+                topic=request.topic,
+                language=request.language,
+                model=request.model,
+                query=request.query,
+                familiarity_level=request.familiarity_level,
+                conversation_mode=request.conversation_mode,
+                api_key=request.api_key,
+                session_id=request.session_id
+            )
+            return ChatResponse(response=response)
+        except Exception as e:
+            return ChatResponse(response="", error=str(e))
+
+def sse_event(data: dict, event: str = None) -> str:
+    """
+    Format one Server-Sent Events message.
+    """
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatRequest):
+    warmup_store.record_request(request.topic)
+    # Quota and rate limits are checked before the response starts, so those
+    # rejections are still a real 429. The upstream slot is only taken once
+    # the stream is consumed: a client gone before then never held one.
+    admission.check(admission_key(request), chat_prompt_tokens(request))
+
+    async def event_source():
+        try:
+            async with admission.slot():
+                async for chunk in stream_llm_response(
+                    topic=request.topic,
+                    language=request.language,
+                    model=request.model,
+                    query=request.query,
+                    familiarity_level=request.familiarity_level,
+                    conversation_mode=request.conversation_mode,
+                    api_key=request.api_key,
+                    session_id=request.session_id
+                ):
+                    yield sse_event({"text": chunk})
+            yield sse_event({}, event="done")
+        except AdmissionRejected as e:
+            yield sse_event({"error": e.reason, "retry_after": e.retry_after}, event="error")
+        except Exception as e:
+            yield sse_event({"error": str(e)}, event="error")
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        # Stop reverse proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/api/quiz", response_model=QuizResponse)
-async def quiz(request: ChatRequest):
+async def quiz(
+    request: ChatRequest,
+    job: bool = False,
+    priority: str = Query(default="normal", pattern="^(" + "|".join(JOB_PRIORITIES) + ")$")
+):
+    warmup_store.record_request(request.topic)
+    projected_tokens = count_quiz_prompt_tokens(request.topic, request.language, request.familiarity_level)
+    if job:
+        return submit_quiz_job(request, projected_tokens, priority)
+    if not request.api_key:
+        return QuizResponse(
+            questions=[],
+            error="API key is required for quiz generation. Please enter your Google Gemini API key."
+        )
+    async with admission.admit(admission_key(request), projected_tokens):
+        return await generate_quiz_response(request)
+
+def submit_quiz_job(request: ChatRequest, projected_tokens: int, priority: str):
+    """
+    Queue the quiz and answer 202 with a job id straight away; the quiz
+    worker pool, not an admission slot, bounds the generation itself.
+    """
+    if not request.api_key:
+        return QuizResponse(
+            questions=[],
+            error="API key is required for quiz generation. Please enter your Google Gemini API key."
+        )
+    admission.check(admission_key(request), projected_tokens)
+    quiz_job = quiz_jobs.submit(
+        topic=request.topic,
+        language=request.language,
+        familiarity_level=request.familiarity_level,
+        api_key=request.api_key,
+        priority=priority
+    )
+    return JSONResponse(
+        status_code=202,
+        content=quiz_job.response().model_dump(),
+        headers={"Location": f"/api/quiz/jobs/{quiz_job.id}"}
+    )
+
+def find_quiz_job(job_id: str):
+    quiz_job = quiz_jobs.get(job_id)
+    if quiz_job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired quiz job")
+    return quiz_job
+
+@app.get("/api/quiz/jobs/{job_id}", response_model=QuizJobResponse)
+async def quiz_job_status(job_id: str, wait: float = Query(default=0, ge=0)):
+    quiz_job = find_quiz_job(job_id)
+    # Long poll: hold the request until the job finishes or `wait` runs out
+    deadline = time.monotonic() + min(wait, QUIZ_JOB_MAX_WAIT_SECONDS)
+    while not quiz_job.finished and time.monotonic() < deadline:
+        quiz_job = await quiz_jobs.wait_for_change(quiz_job, deadline - time.monotonic())
+    return quiz_job.response()
+
+@app.get("/api/quiz/jobs/{job_id}/events")
+async def quiz_job_events(job_id: str):
+    found = find_quiz_job(job_id)
+
+    async def event_source():
+        # Same events as /api/quiz/stream, plus a status event per transition
+        quiz_job = found
+        status = None
+        while True:
+            if quiz_job.status != status:
+                status = quiz_job.status
+                yield sse_event({"status": status}, event="status")
+            if quiz_job.finished:
+                break
+            quiz_job = await quiz_jobs.wait_for_change(quiz_job, QUIZ_JOB_MAX_WAIT_SECONDS)
+            if quiz_job.status == status:
+                # Keeps proxies from closing an idle connection
+                yield ": keep-alive\n\n"
+
+        if quiz_job.error:
+            yield sse_event({"error": quiz_job.error}, event="error")
+            return
+        for question in quiz_job.questions:
+            yield sse_event({"question": question.model_dump()})
+        yield sse_event({"count": len(quiz_job.questions)}, event="done")
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def generate_quiz_response(request: ChatRequest) -> QuizResponse:
     try:
         # Validate API key
         if not request.api_key:
@@ -64,12 +352,11 @@ async def quiz(request: ChatRequest):
                 error="API key is required for quiz generation. Please enter your Google Gemini API key."
             )
 
-        # Use Gemini 1.5 Pro for quiz generation regardless of the selected model
-        # This ensures the most capable model is used for structured output
-        questions = await generate_quiz(
+        # Draw from the pre-generated question bank; falls back to a live
+        # generation on the fastest healthy model when the bucket is too small
+        questions = await get_quiz_questions(
             topic=request.topic,
             language=request.language,
-            model="gemini-1.5-flash",  # Force using the most capable model
             familiarity_level=request.familiarity_level,
             api_key=request.api_key
         )
@@ -82,14 +369,131 @@ async def quiz(request: ChatRequest):
 
         return QuizResponse(questions=questions)
     except Exception as e:
-        import traceback
-        error_details = traceback.format_exc()
-        print(f"Quiz generation error: {error_details}")
+        logging.error(f"Quiz generation error: {str(e)}")
+        logging.error(f"Detailed traceback: {traceback.format_exc()}")
         return QuizResponse(
             questions=[],
             error=f"An error occurred while generating the quiz: {str(e)}"
         )
 
+@app.post("/api/quiz/stream")
+async def quiz_stream(request: ChatRequest):
+    warmup_store.record_request(request.topic)
+    if request.api_key:
+        # As in chat_stream: limits before the response, the slot inside it
+        admission.check(admission_key(request), count_quiz_prompt_tokens(request.topic, request.language, request.familiarity_level))
+
+    async def event_source():
+        if not request.api_key:
+            yield sse_event({"error": "API key is required for quiz generation. Please enter your Google Gemini API key."}, event="error")
+            return
+
+        try:
+            count = 0
+            async with admission.slot():
+                # One event per question, sent as soon as its JSON object closes
+                async for question in stream_quiz_questions(
+                    topic=request.topic,
+                    language=request.language,
+                    familiarity_level=request.familiarity_level,
+                    api_key=request.api_key
+                ):
+                    count += 1
+                    yield sse_event({"question": question.model_dump()})
+
+            if count == 0:
+                yield sse_event({"error": "Failed to generate quiz questions. Please try again with a different topic."}, event="error")
+            else:
+                yield sse_event({"count": count}, event="done")
+        except AdmissionRejected as e:
+            yield sse_event({"error": e.reason, "retry_after": e.retry_after}, event="error")
+        except Exception as e:
+            logging.error(f"Error while streaming quiz: {str(e)}")
+            yield sse_event({"error": f"An error occurred while generating the quiz: {str(e)}"}, event="error")
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def admit_batch_quiz(request: BatchQuizRequest) -> None:
+    """
+    Charge the quota and rate limits once for the whole batch; each
+    upstream generation then takes its own upstream slot.
+    """
+    projected_tokens = count_batch_quiz_prompt_tokens(
+        request.topics,
+        request.language,
+        request.familiarity_level,
+        request.question_count
+    )
+    admission.check(request.api_key, projected_tokens)
+    for topic in request.topics:
+        warmup_store.record_request(topic)
+
+def chapter_quiz(request: BatchQuizRequest):
+    return stream_chapter_quiz(
+        topics=request.topics,
+        language=request.language,
+        familiarity_level=request.familiarity_level,
+        question_count=request.question_count,
+        api_key=request.api_key,
+        slot=admission.slot
+    )
+
+@app.post("/api/quiz/batch", response_model=BatchQuizResponse)
+async def quiz_batch(request: BatchQuizRequest):
+    if not request.api_key:
+        return BatchQuizResponse(
+            quizzes=[],
+            error="API key is required for quiz generation. Please enter your Google Gemini API key."
+        )
+    admit_batch_quiz(request)
+
+    by_topic = {topic: [] for topic in request.topics}
+    async for topic, question in chapter_quiz(request):
+        by_topic[topic].append(question)
+    return BatchQuizResponse(quizzes=[
+        TopicQuiz(
+            topic=topic,
+            questions=questions,
+            error=None if questions else "Failed to generate quiz questions for this topic. Please try again."
+        )
+        for topic, questions in by_topic.items()
+    ])
+
+@app.post("/api/quiz/batch/stream")
+async def quiz_batch_stream(request: BatchQuizRequest):
+    if request.api_key:
+        admit_batch_quiz(request)
+
+    async def event_source():
+        if not request.api_key:
+            yield sse_event({"error": "API key is required for quiz generation. Please enter your Google Gemini API key."}, event="error")
+            return
+
+        counts = {topic: 0 for topic in request.topics}
+        try:
+            # Questions of different topics interleave as the batches progress
+            async for topic, question in chapter_quiz(request):
+                counts[topic] += 1
+                yield sse_event({"topic": topic, "question": question.model_dump()})
+        except Exception as e:
+            logging.error(f"Error while streaming batch quiz: {str(e)}")
+            yield sse_event({"error": f"An error occurred while generating the quiz: {str(e)}"}, event="error")
+            return
+        for topic, count in counts.items():
+            if count == 0:
+                yield sse_event({"topic": topic, "error": "Failed to generate quiz questions for this topic. Please try again."}, event="error")
+        yield sse_event({"counts": counts}, event="done")
+
+    return StreamingResponse(
+        event_source(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.post("/api/check-quota", response_model=QuotaResponse)
 async def check_quota(request: QuotaRequest):
     try:
@@ -102,6 +506,84 @@ async def check_quota(request: QuotaRequest):
     except Exception as e:
         return QuotaResponse(used=0, limit=0, error=str(e))
 
+async def ws_chat(message: dict):
+    request = ChatRequest(**message)
+    warmup_store.record_request(request.topic)
+    await admission.acquire(admission_key(request), chat_prompt_tokens(request))
+    try:
+        async for chunk in stream_llm_response(
+            topic=request.topic,
+            language=request.language,
+            model=request.model,
+            query=request.query,
+            familiarity_level=request.familiarity_level,
+            conversation_mode=request.conversation_mode,
+            api_key=request.api_key,
+            session_id=request.session_id
+        ):
+            yield {"type": "chunk", "text": chunk}
+        yield {"type": "done"}
+    finally:
+        admission.release()
+
+async def ws_quiz(message: dict):
+    request = ChatRequest(**message)
+    if not request.api_key:
+        yield {"type": "error", "error": "API key is required for quiz generation. Please enter your Google Gemini API key."}
+        return
+    warmup_store.record_request(request.topic)
+    await admission.acquire(admission_key(request), count_quiz_prompt_tokens(request.topic, request.language, request.familiarity_level))
+    try:
+        count = 0
+        async for question in stream_quiz_questions(
+            topic=request.topic,
+            language=request.language,
+            familiarity_level=request.familiarity_level,
+            api_key=request.api_key
+        ):
+            count += 1
+            yield {"type": "question", "question": question.model_dump()}
+        if count == 0:
+            yield {"type": "error", "error": "Failed to generate quiz questions. Please try again with a different topic."}
+        else:
+            yield {"type": "done", "count": count}
+    finally:
+        admission.release()
+
+async def ws_quota(message: dict):
+    request = QuotaRequest(**message)
+    quota = await check_quota(request)
+    yield {"type": "quota", **quota.model_dump()}
+
+@app.websocket("/api/ws")
+async def tutor_websocket(websocket: WebSocket):
+    """
+    Chat turns, quizzes and quota checks multiplexed over one connection;
+    see TutorChannel for the message format.
+    """
+    await TutorChannel(websocket, {"chat": ws_chat, "quiz": ws_quiz, "quota": ws_quota}).serve()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/stats")
+async def stats():
+    return {
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats(),
+        "quiz_bank": quiz_bank.stats(),
+        "single_flight": llm_flight.stats(),
+        "admission": admission.stats(),
+        "resilience": resilience.stats(),
+        "router": {"chat": chat_router.stats(), "quiz": quiz_router.stats()},
+        "sessions": session_store.stats(),
+        "quiz_jobs": quiz_jobs.stats(),
+        "warmup": warmup_runner.stats(),
+        "trace": trace_recorder.stats() if trace_recorder is not None else None
+    }
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Several workers need the app as an import string, so each process builds its own
+    uvicorn.run("main:app", host=SERVER_HOST, port=SERVER_PORT, workers=SERVER_WORKERS)
@@ -0,0 +1,155 @@
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets in seconds, from cache hits up to slow quiz generations
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Cap on distinct label sets per metric, so per-key series can't grow without bound
+MAX_SERIES = 1000
+OVERFLOW_LABEL = "other"
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+
+    def _key(self, labels: Tuple[str, ...], series: Dict) -> Tuple[str, ...]:
+        if labels in series or len(series) < MAX_SERIES:
+            return labels
+        return (OVERFLOW_LABEL,) * len(self.label_names)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = ()):
+        super().__init__(name, help_text, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        key = self._key(labels, self._values)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, value in list(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, label_names: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket..., +Inf count, sum]
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        key = self._key(labels, self._series)
+        series = self._series.get(key)
+        if series is None:
+            series = [0.0] * (len(self.buckets) + 2)
+            self._series[key] = series
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, series in list(self._series.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                bucket_labels = _format_labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            cumulative += series[len(self.buckets)]
+            bucket_labels = _format_labels(self.label_names, labels, 'le="+Inf"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+class CallbackGauge(_Metric):
+    """
+    A gauge whose value is read at scrape time, so the hot path pays nothing.
+    The callback returns either a number or a {label_value: number} dict.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, callback: Callable[[], object], label_name: Optional[str] = None):
+        super().__init__(name, help_text, (label_name,) if label_name else ())
+        self.callback = callback
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        value = self.callback()
+        if isinstance(value, dict):
+            for label, item in value.items():
+                lines.append(f"{self.name}{_format_labels(self.label_names, (label,))} {float(item)}")
+        else:
+            lines.append(f"{self.name} {float(value)}")
+        return lines
+
+class Registry:
+    """
+    Holds every metric and renders them in the Prometheus text format.
+
+    Metrics are updated from the event loop without locks: each update is a
+    couple of dict and list operations, a few microseconds at most.
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "HTTP request latency by endpoint and status class", ("endpoint", "status")
+))
+llm_phase_duration = registry.register(Histogram(
+    "llm_phase_duration_seconds", "Time spent in each phase of an LLM request", ("phase", "model")
+))
+llm_upstream_errors = registry.register(Counter(
+    "llm_upstream_errors_total", "Upstream LLM errors by category", ("category",)
+))
+llm_abandoned_calls = registry.register(Counter(
+    "llm_abandoned_calls_total", "Upstream calls charged after finishing for a caller that gave up on them", ("model",)
+))
+llm_tokens = registry.register(Counter(
+    "llm_tokens_total", "Tokens charged per API key (hashed)", ("key",)
+))
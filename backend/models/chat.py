@@ -1,5 +1,7 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator, model_validator
 from typing import Optional, List
+from catalog import canonical_topic, canonical_chapter
+from config import CHAPTER_TOPICS, QUIZ_QUESTION_COUNT, QUIZ_BATCH_MAX_TOPICS, QUIZ_BATCH_MAX_QUESTIONS_PER_TOPIC
 
 class ChatRequest(BaseModel):
     topic: str
@@ -9,6 +11,17 @@ class ChatRequest(BaseModel):
     familiarity_level: str
     conversation_mode: str
     api_key: Optional[str] = None
+    # Client-generated id that turns /api/chat calls into one conversation
+    session_id: Optional[str] = Field(default=None, max_length=64)
+
+    @field_validator("topic")
+    @classmethod
+    def known_topic(cls, topic: str) -> str:
+        # Normalizing to the catalog spelling also keeps cache keys consistent
+        canonical = canonical_topic(topic)
+        if canonical is None:
+            raise ValueError("Unknown topic; see /api/config for the available topics")
+        return canonical
 
 class ChatResponse(BaseModel):
     response: str
@@ -16,16 +29,63 @@ class ChatResponse(BaseModel):
     # sections: Optional[dict] = None  # New field for structured content
 
 class QuizQuestion(BaseModel):
-    question: str
-    options: List[str]
-    correct_answer: int  # Index of the correct answer in options
-    explanation: str
-    improvement_suggestions: List[str]
+    # Descriptions are sent to the model as part of the quiz response schema
+    question: str = Field(description="The question text")
+    options: List[str] = Field(description="Exactly 4 answer options")
+    correct_answer: int = Field(description="Index (0-3) of the correct answer in options")
+    explanation: str = Field(description="Why the correct answer is right")
+    improvement_suggestions: List[str] = Field(description="3-4 specific suggestions for a learner who got it wrong")
 
 class QuizResponse(BaseModel):
     questions: List[QuizQuestion]
     error: Optional[str] = None
 
+class BatchQuizRequest(BaseModel):
+    # A chapter, a list of topics, or both; the chapter stands for all its topics
+    chapter: Optional[str] = None
+    topics: List[str] = []
+    language: str
+    familiarity_level: str
+    question_count: int = Field(default=QUIZ_QUESTION_COUNT, ge=1, le=QUIZ_BATCH_MAX_QUESTIONS_PER_TOPIC)
+    api_key: Optional[str] = None
+
+    @model_validator(mode="after")
+    def resolve_topics(self) -> "BatchQuizRequest":
+        requested = []
+        if self.chapter is not None:
+            chapter = canonical_chapter(self.chapter)
+            if chapter is None:
+                raise ValueError("Unknown chapter; see /api/config for the available chapters")
+            self.chapter = chapter
+            requested.extend(CHAPTER_TOPICS[chapter])
+        for topic in self.topics:
+            canonical = canonical_topic(topic)
+            if canonical is None:
+                raise ValueError(f"Unknown topic '{topic}'; see /api/config for the available topics")
+            requested.append(canonical)
+        # Each topic once, in the order asked for
+        self.topics = list(dict.fromkeys(requested))
+        if not self.topics:
+            raise ValueError("Give a chapter or at least one topic")
+        if len(self.topics) > QUIZ_BATCH_MAX_TOPICS:
+            raise ValueError(f"At most {QUIZ_BATCH_MAX_TOPICS} topics per request")
+        return self
+
+class TopicQuiz(BaseModel):
+    topic: str
+    questions: List[QuizQuestion]
+    error: Optional[str] = None
+
+class BatchQuizResponse(BaseModel):
+    quizzes: List[TopicQuiz]
+    error: Optional[str] = None
+
+class QuizJobResponse(BaseModel):
+    job_id: str
+    status: str  # queued, running, done or failed
+    questions: List[QuizQuestion] = []
+    error: Optional[str] = None
+
 class QuotaRequest(BaseModel):
     api_key: str
 
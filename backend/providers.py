@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import random
+import re
+import time
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+from google.api_core import exceptions as google_exceptions
+from executor import run_blocking, iterate_blocking
+from client_pool import client_pool
+from token_counter import usage_from_response
+from config import (
+    LLM_PROVIDER,
+    FAKE_LLM_LATENCY_SECONDS,
+    FAKE_LLM_CHUNK_DELAY_SECONDS,
+    FAKE_LLM_CHUNK_CHARS,
+    FAKE_LLM_QUIZ_VARIANT,
+    FAKE_LLM_BLOCKING,
+    FAKE_LLM_ERROR_RATE
+)
+
+class ProviderResponse:
+    """
+    Text from one generation (or one stream chunk), plus the total token
+    count when the provider reports it.
+    """
+    __slots__ = ("text", "total_tokens")
+
+    def __init__(self, text: str, total_tokens: Optional[int] = None):
+        self.text = text
+        self.total_tokens = total_tokens
+
+# Called with the response of a generation that finished after its caller was cancelled
+AbandonedCallback = Callable[[ProviderResponse], None]
+
+class LLMProvider(ABC):
+    """
+    Everything the handlers need from an LLM backend. `timeout` is the
+    time left on the caller's deadline, for providers that can pass it on.
+
+    A cancelled generate() may leave its upstream call running (and billed);
+    providers that can tell pass its response to `on_abandoned` when it ends.
+    """
+
+    @abstractmethod
+    async def generate(
+        self,
+        api_key: str,
+        model: str,
+        prompt: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+        safety_settings: Optional[List[Dict[str, str]]] = None,
+        timeout: Optional[float] = None,
+        on_abandoned: Optional[AbandonedCallback] = None
+    ) -> ProviderResponse:
+        ...
+
+    @abstractmethod
+    def stream(
+        self,
+        api_key: str,
+        model: str,
+        prompt: str,
+        generation_config: Optional[Dict[str, Any]] = None,
+        safety_settings: Optional[List[Dict[str, str]]] = None,
+        timeout: Optional[float] = None
+    ) -> AsyncIterator[ProviderResponse]:
+        ...
+
+# JSON Schema keywords that Gemini's response_schema understands
+_GEMINI_SCHEMA_KEYS = ("type", "format", "description", "nullable", "enum", "items", "properties", "required")
+
+def to_gemini_schema(json_schema: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reduce a Pydantic JSON schema to the OpenAPI subset Gemini accepts for
+    response_schema (no titles, defaults or $refs).
+    """
+    schema = {key: json_schema[key] for key in _GEMINI_SCHEMA_KEYS if key in json_schema}
+    if "items" in schema:
+        schema["items"] = to_gemini_schema(schema["items"])
+    if "properties" in schema:
+        schema["properties"] = {name: to_gemini_schema(value) for name, value in schema["properties"].items()}
+    return schema
+
+def _request_options(timeout: Optional[float]) -> Optional[Dict[str, float]]:
+    return {"timeout": max(timeout, 1.0)} if timeout is not None else None
+
+class GeminiProvider(LLMProvider):
+    """
+    Google Gemini through per-key pooled clients, with the blocking SDK
+    calls run on the LLM thread pool.
+    """
+
+    async def generate(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None, on_abandoned=None) -> ProviderResponse:
+        gemini_model = client_pool.get_model(api_key, model, generation_config)
+        # The gRPC deadline frees the pool thread too; cancelling the awaiting task can't
+        response = await run_blocking(
+            gemini_model.generate_content,
+            prompt,
+            safety_settings=safety_settings,
+            request_options=_request_options(timeout),
+            on_abandoned=(lambda late: on_abandoned(self._to_response(late))) if on_abandoned else None
+        )
+        return self._to_response(response)
+
+    @staticmethod
+    def _to_response(response) -> ProviderResponse:
+        return ProviderResponse(response.text, usage_from_response(response))
+
+    async def stream(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None) -> AsyncIterator[ProviderResponse]:
+        gemini_model = client_pool.get_model(api_key, model, generation_config)
+        chunks = await run_blocking(
+            gemini_model.generate_content,
+            prompt,
+            safety_settings=safety_settings,
+            stream=True,
+            request_options=_request_options(timeout)
+        )
+        async for chunk in iterate_blocking(chunks):
+            # Usage metadata on a chunk is cumulative, so the last one holds the total
+            yield ProviderResponse(chunk.text, usage_from_response(chunk))
+
+FAKE_QUIZ_VARIANTS = ["valid", "fenced", "prose", "trailing_comma", "truncated", "string_answer", "broken_item"]
+
+def _fake_question(topic: str, i: int) -> Dict[str, Any]:
+    return {
+        "question": f"Question {i + 1} about {topic}?",
+        "options": [f"Option {chr(65 + j)}" for j in range(4)],
+        "correct_answer": i % 4,
+        "explanation": f"Option {chr(65 + i % 4)} is correct because of how {topic} works.",
+        "improvement_suggestions": [
+            f"Review the basics of {topic}.",
+            f"Write a small program that uses {topic}.",
+            "Compare your answer with the explanation."
+        ]
+    }
+
+def fake_quiz_output(topic: str, variant: str = "valid", count: int = 5, batch_topics: Optional[List[str]] = None) -> str:
+    """
+    Canned quiz JSON in the shapes real models actually return, good and bad.
+    With batch_topics, `count` questions per topic, each tagged with its topic.
+    """
+    if batch_topics:
+        questions = [{"topic": batch_topic, **_fake_question(batch_topic, i)} for batch_topic in batch_topics for i in range(count)]
+        topic = batch_topics[0]
+    else:
+        questions = [_fake_question(topic, i) for i in range(count)]
+    if variant == "string_answer":
+        for question in questions:
+            question["correct_answer"] = str(question["correct_answer"])
+    text = json.dumps(questions, indent=2, ensure_ascii=False)
+
+    if variant == "fenced":
+        return f"```json\n{text}\n```"
+    if variant == "prose":
+        return f"Here is your quiz on {topic}:\n\n{text}\n\nGood luck!"
+    if variant == "trailing_comma":
+        return text[:-1].rstrip() + ",\n]"
+    if variant == "truncated":
+        return text[:int(len(text) * 0.8)]
+    if variant == "broken_item":
+        # Drop the closing quote of one string so that element alone is invalid
+        return text.replace(f'"Question 2 about {topic}?"', f'"Question 2 about {topic}?', 1)
+    return text
+
+class FakeProvider(LLMProvider):
+    """
+    Offline stand-in for Gemini with configurable timing, for benchmarks
+    and load tests that must not spend quota.
+
+    By default it sleeps on the LLM thread pool, like the blocking Gemini
+    SDK, so pool sizing and event-loop behaviour are exercised realistically.
+    """
+
+    def __init__(
+        self,
+        latency: float = FAKE_LLM_LATENCY_SECONDS,
+        chunk_delay: float = FAKE_LLM_CHUNK_DELAY_SECONDS,
+        chunk_chars: int = FAKE_LLM_CHUNK_CHARS,
+        quiz_variant: str = FAKE_LLM_QUIZ_VARIANT,
+        blocking: bool = FAKE_LLM_BLOCKING,
+        error_rate: float = FAKE_LLM_ERROR_RATE
+    ):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.chunk_chars = chunk_chars
+        self.quiz_variant = quiz_variant
+        self.blocking = blocking
+        self.error_rate = error_rate
+        self.calls = 0
+
+    async def _sleep(self, seconds: float, on_abandoned: Optional[Callable[[], None]] = None) -> None:
+        if seconds <= 0:
+            return
+        if self.blocking:
+            # Like a real SDK call, an abandoned sleep runs to the end
+            await run_blocking(time.sleep, seconds, on_abandoned=(lambda _: on_abandoned()) if on_abandoned else None)
+        else:
+            await asyncio.sleep(seconds)
+
+    def _maybe_fail(self) -> None:
+        if self.error_rate and random.random() < self.error_rate:
+            raise google_exceptions.ServiceUnavailable("Fake provider outage")
+
+    def _respond(self, prompt: str) -> str:
+        first_line = prompt.split("\n", 1)[0]
+        if "quiz" in first_line.lower():
+            variant = random.choice(FAKE_QUIZ_VARIANTS) if self.quiz_variant == "random" else self.quiz_variant
+            if "Python topics:" in prompt:
+                topics = re.findall(r"^- (.+)$", prompt, re.MULTILINE)
+                count = int(re.search(r"Create (\d+) multiple-choice", prompt).group(1))
+                return fake_quiz_output(topics[0], variant, count, batch_topics=topics)
+            topic = prompt.split("Python topic:", 1)[-1].split("\n", 1)[0].strip() or "Python"
+            return fake_quiz_output(topic, variant)
+        paragraph = "This is a canned explanation from the fake provider, used for offline load testing. "
+        return "## Explanation\n\n" + paragraph * 20 + "\n\n```python\nprint('hello world')\n```\n"
+
+    async def generate(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None, on_abandoned=None) -> ProviderResponse:
+        self.calls += 1
+        text = self._respond(prompt)
+        chunk_count = max(1, len(text) // self.chunk_chars)
+        await self._sleep(
+            self.latency + self.chunk_delay * chunk_count,
+            (lambda: on_abandoned(ProviderResponse(text))) if on_abandoned else None
+        )
+        self._maybe_fail()
+        return ProviderResponse(text)
+
+    async def stream(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None) -> AsyncIterator[ProviderResponse]:
+        self.calls += 1
+        text = self._respond(prompt)
+        await self._sleep(self.latency)
+        self._maybe_fail()
+        for start in range(0, len(text), self.chunk_chars):
+            if start:
+                await self._sleep(self.chunk_delay)
+            yield ProviderResponse(text[start:start + self.chunk_chars])
+
+def create_provider(name: str = LLM_PROVIDER) -> LLMProvider:
+    if name == "fake":
+        logging.info("Using the fake LLM provider; no requests will reach Gemini")
+        return FakeProvider()
+    if name != "gemini":
+        logging.warning(f"Unknown LLM_PROVIDER '{name}', using Gemini")
+    return GeminiProvider()
+
+provider = create_provider()
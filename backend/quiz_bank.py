@@ -0,0 +1,378 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import sqlite3
+import threading
+import time
+from typing import AsyncContextManager, AsyncIterator, Callable, Dict, Iterator, List, Optional, Set, Tuple
+from models.chat import QuizQuestion
+from llm_handler import generate_quiz, stream_quiz, stream_batch_quiz, QUIZ_GENERATION_CONFIG
+from singleflight import llm_flight, flight_key
+from leases import flight_leases
+from executor import run_in_background
+from config import (
+    GEMINI_API_KEY,
+    SHARED_STATE,
+    SHARED_STATE_REFRESH_SECONDS,
+    AUTO_MODEL,
+    AVAILABLE_TOPICS,
+    FAMILIARITY_LEVELS,
+    QUIZ_BANK_PATH,
+    QUIZ_QUESTION_COUNT,
+    QUIZ_BANK_LOW_WATER,
+    QUIZ_BANK_TARGET,
+    QUIZ_BANK_REFILL_INTERVAL_SECONDS,
+    QUIZ_BANK_PREFILL,
+    QUIZ_BANK_LANGUAGES,
+    QUIZ_BATCH_TOKENS_PER_QUESTION
+)
+
+# Quizzes are generated with whichever model the quiz router finds fastest, see /api/quiz
+QUIZ_MODEL = AUTO_MODEL
+
+Bucket = Tuple[str, str, str]  # (topic, familiarity_level, language)
+
+def _fingerprint(question: QuizQuestion) -> str:
+    return hashlib.sha256(" ".join(question.question.split()).casefold().encode("utf-8")).hexdigest()
+
+class QuizBank:
+    """
+    Persistent pool of pre-generated quiz questions, bucketed by
+    (topic, familiarity_level, language).
+
+    Bucket sizes are mirrored in memory so low-water checks never hit the
+    database. Duplicate questions (same normalized text) are stored once.
+    When worker processes share the file, the mirror is reloaded after
+    refresh_seconds so questions banked by other workers are seen.
+    """
+
+    def __init__(self, path: str = QUIZ_BANK_PATH, refresh_seconds: Optional[float] = SHARED_STATE_REFRESH_SECONDS if SHARED_STATE else None):
+        self.refresh_seconds = refresh_seconds
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS quiz_questions (
+                id INTEGER PRIMARY KEY,
+                topic TEXT NOT NULL,
+                familiarity_level TEXT NOT NULL,
+                language TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                question_json TEXT NOT NULL,
+                UNIQUE (topic, familiarity_level, language, fingerprint)
+            )
+        """)
+        self._db.commit()
+        self._counts: Dict[Bucket, int] = {}
+        self._counted_at = 0.0
+        self._load_counts()
+
+    def _load_counts(self) -> None:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT topic, familiarity_level, language, COUNT(*) FROM quiz_questions GROUP BY topic, familiarity_level, language"
+            ).fetchall()
+        self._counts = {(topic, familiarity_level, language): count for topic, familiarity_level, language, count in rows}
+        self._counted_at = time.monotonic()
+
+    def count(self, topic: str, familiarity_level: str, language: str) -> int:
+        if self.refresh_seconds is not None and time.monotonic() - self._counted_at >= self.refresh_seconds:
+            self._load_counts()
+        return self._counts.get((topic, familiarity_level, language), 0)
+
+    def draw(self, topic: str, familiarity_level: str, language: str, count: int = QUIZ_QUESTION_COUNT) -> List[QuizQuestion]:
+        """
+        Return a random selection of up to `count` questions from the bucket.
+        """
+        # A shared bank may have been filled by another worker since the last count
+        if self.refresh_seconds is None and self.count(topic, familiarity_level, language) == 0:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT question_json FROM quiz_questions WHERE topic = ? AND familiarity_level = ? AND language = ? ORDER BY RANDOM() LIMIT ?",
+                (topic, familiarity_level, language, count)
+            ).fetchall()
+        return [QuizQuestion.model_validate_json(row[0]) for row in rows]
+
+    def add(self, topic: str, familiarity_level: str, language: str, questions: List[QuizQuestion]) -> int:
+        """
+        Store freshly generated questions. Returns how many were new.
+        """
+        rows = [
+            (topic, familiarity_level, language, _fingerprint(question), question.model_dump_json())
+            for question in questions
+        ]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO quiz_questions (topic, familiarity_level, language, fingerprint, question_json) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._db.commit()
+            added = self._db.total_changes - before
+        bucket = (topic, familiarity_level, language)
+        self._counts[bucket] = self._counts.get(bucket, 0) + added
+        return added
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "buckets": len(self._counts),
+            "questions": sum(self._counts.values()),
+            "buckets_below_low_water": sum(1 for count in self._counts.values() if count < QUIZ_BANK_LOW_WATER)
+        }
+
+class QuizBankRefiller:
+    """
+    Background worker that tops up buckets below the low-water mark.
+
+    Buckets that learners actually asked for are refilled first; if
+    QUIZ_BANK_PREFILL is set the worker then walks the whole
+    AVAILABLE_TOPICS x FAMILIARITY_LEVELS x QUIZ_BANK_LANGUAGES matrix.
+    Refills are paid for with the server's GEMINI_API_KEY, never a learner's key.
+    """
+
+    def __init__(self, bank: QuizBank, api_key: Optional[str] = GEMINI_API_KEY):
+        self.bank = bank
+        self.api_key = api_key
+        self._demand: "asyncio.Queue[Bucket]" = asyncio.Queue()
+        self._queued: Set[Bucket] = set()
+        self._matrix = self._walk_matrix() if QUIZ_BANK_PREFILL else iter(())
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _walk_matrix() -> Iterator[Bucket]:
+        for language in QUIZ_BANK_LANGUAGES:
+            for familiarity_level in FAMILIARITY_LEVELS:
+                for topic in AVAILABLE_TOPICS:
+                    yield (topic, familiarity_level, language)
+
+    def request_refill(self, topic: str, familiarity_level: str, language: str) -> None:
+        bucket = (topic, familiarity_level, language)
+        if self.bank.count(*bucket) >= QUIZ_BANK_LOW_WATER or bucket in self._queued:
+            return
+        self._queued.add(bucket)
+        self._demand.put_nowait(bucket)
+
+    def _next_bucket(self) -> Optional[Bucket]:
+        if not self._demand.empty():
+            bucket = self._demand.get_nowait()
+            self._queued.discard(bucket)
+            return bucket
+        for bucket in self._matrix:
+            if self.bank.count(*bucket) < QUIZ_BANK_LOW_WATER:
+                return bucket
+        return None
+
+    async def _refill(self, bucket: Bucket) -> None:
+        # Every worker runs a refiller; only one of them tops up a given bucket
+        lease = "refill:" + "|".join(bucket)
+        if flight_leases is not None and not flight_leases.try_acquire(lease):
+            return
+        try:
+            await self._refill_bucket(bucket)
+        finally:
+            if flight_leases is not None:
+                flight_leases.release(lease)
+
+    async def _refill_bucket(self, bucket: Bucket) -> None:
+        topic, familiarity_level, language = bucket
+        while self.bank.count(*bucket) < QUIZ_BANK_TARGET:
+            questions = await generate_quiz(
+                topic=topic,
+                language=language,
+                model=QUIZ_MODEL,
+                familiarity_level=familiarity_level,
+                api_key=self.api_key
+            )
+            # Stop when generation fails or only produces duplicates
+            if not questions or self.bank.add(topic, familiarity_level, language, questions) == 0:
+                logging.warning(f"Quiz bank refill stalled for {bucket}")
+                return
+
+    async def run(self) -> None:
+        while True:
+            bucket = self._next_bucket()
+            if bucket is None:
+                await asyncio.sleep(QUIZ_BANK_REFILL_INTERVAL_SECONDS)
+                continue
+            try:
+                await self._refill(bucket)
+            except Exception as e:
+                logging.error(f"Quiz bank refill failed for {bucket}: {str(e)}")
+                await asyncio.sleep(QUIZ_BANK_REFILL_INTERVAL_SECONDS)
+
+    def start(self) -> None:
+        if not self.api_key:
+            logging.info("GEMINI_API_KEY not set; quiz bank background refill disabled")
+            return
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+quiz_bank = QuizBank()
+quiz_bank_refiller = QuizBankRefiller(quiz_bank)
+
+async def _generate_and_bank(topic: str, language: str, familiarity_level: str, api_key: str) -> List[QuizQuestion]:
+    # Banked before the flight ends, so waiting workers find the quiz in the bank
+    generated = await generate_quiz(
+        topic=topic,
+        language=language,
+        model=QUIZ_MODEL,
+        familiarity_level=familiarity_level,
+        api_key=api_key
+    )
+    if generated:
+        quiz_bank.add(topic, familiarity_level, language, generated)
+    return generated
+
+def banked_quiz(topic: str, language: str, familiarity_level: str) -> Optional[List[QuizQuestion]]:
+    # A whole quiz banked meanwhile, e.g. by a generation in another worker
+    questions = quiz_bank.draw(topic, familiarity_level, language)
+    return questions if len(questions) >= QUIZ_QUESTION_COUNT else None
+
+async def get_quiz_questions(topic: str, language: str, familiarity_level: str, api_key: str = None) -> List[QuizQuestion]:
+    """
+    Serve a quiz from the bank, generating one live only when the bucket
+    can't fill a whole quiz. Live results are banked for later learners.
+    """
+    questions = quiz_bank.draw(topic, familiarity_level, language)
+    if len(questions) < QUIZ_QUESTION_COUNT:
+        # Repeated requests on one key share a generation; other keys draw it from the bank
+        generated = await llm_flight.do(
+            flight_key("quiz", api_key, topic, familiarity_level, language),
+            lambda: _generate_and_bank(topic, language, familiarity_level, api_key),
+            lookup=lambda: banked_quiz(topic, language, familiarity_level)
+        )
+        if generated:
+            questions = generated
+    quiz_bank_refiller.request_refill(topic, familiarity_level, language)
+    return questions
+
+async def _stream_and_bank(topic: str, language: str, familiarity_level: str, api_key: str) -> AsyncIterator[QuizQuestion]:
+    generated = []
+    async for question in stream_quiz(
+        topic=topic,
+        language=language,
+        model=QUIZ_MODEL,
+        familiarity_level=familiarity_level,
+        api_key=api_key
+    ):
+        generated.append(question)
+        yield question
+    # Same acceptance rule as generate_quiz before anything is banked
+    if len(generated) >= 3:
+        quiz_bank.add(topic, familiarity_level, language, generated)
+
+async def stream_quiz_questions(topic: str, language: str, familiarity_level: str, api_key: str = None) -> AsyncIterator[QuizQuestion]:
+    """
+    Streaming counterpart of get_quiz_questions: banked quizzes are yielded
+    at once, live ones question by question as the model completes them.
+    """
+    questions = quiz_bank.draw(topic, familiarity_level, language)
+    if len(questions) >= QUIZ_QUESTION_COUNT:
+        for question in questions:
+            yield question
+    else:
+        # Concurrent requests on one key replay one upstream stream, which banks the result once
+        async for question in llm_flight.stream(
+            flight_key("quiz-stream", api_key, topic, familiarity_level, language),
+            lambda: _stream_and_bank(topic, language, familiarity_level, api_key),
+            lookup=lambda: banked_quiz(topic, language, familiarity_level)
+        ):
+            yield question
+    quiz_bank_refiller.request_refill(topic, familiarity_level, language)
+
+def plan_quiz_batches(topics: List[str], question_count: int) -> List[List[str]]:
+    """
+    Pack topics into as few generations as fit the quiz output token budget,
+    spread evenly so no generation runs much longer than the others.
+    """
+    max_questions = QUIZ_GENERATION_CONFIG["max_output_tokens"] // QUIZ_BATCH_TOKENS_PER_QUESTION
+    per_batch = max(1, max_questions // question_count)
+    size = math.ceil(len(topics) / math.ceil(len(topics) / per_batch))
+    return [topics[start:start + size] for start in range(0, len(topics), size)]
+
+async def _stream_batch_and_bank(
+    topics: List[str],
+    language: str,
+    familiarity_level: str,
+    question_count: int,
+    api_key: str,
+    slot: Callable[[], AsyncContextManager[None]]
+) -> AsyncIterator[Tuple[str, QuizQuestion]]:
+    generated: Dict[str, List[QuizQuestion]] = {topic: [] for topic in topics}
+    try:
+        async with slot():
+            async for topic, question in stream_batch_quiz(topics, language, QUIZ_MODEL, familiarity_level, question_count, api_key):
+                generated[topic].append(question)
+                yield topic, question
+    finally:
+        # Same acceptance rule as a single-topic quiz, applied per topic
+        for topic, questions in generated.items():
+            if len(questions) >= min(3, question_count):
+                quiz_bank.add(topic, familiarity_level, language, questions)
+
+async def stream_chapter_quiz(
+    topics: List[str],
+    language: str,
+    familiarity_level: str,
+    question_count: int,
+    api_key: str,
+    slot: Callable[[], AsyncContextManager[None]]
+) -> AsyncIterator[Tuple[str, QuizQuestion]]:
+    """
+    Quiz many topics at once, yielding (topic, question) pairs as they are
+    ready. Topics the bank can serve come first; the rest are packed into
+    batched generations that run concurrently, each holding an upstream
+    slot from `slot`. A batch that fails only loses its own topics.
+    """
+    missing = []
+    for topic in topics:
+        banked = quiz_bank.draw(topic, familiarity_level, language, question_count)
+        if len(banked) >= question_count:
+            for question in banked:
+                yield topic, question
+        else:
+            missing.append(topic)
+
+    results: "asyncio.Queue[Optional[Tuple[str, QuizQuestion]]]" = asyncio.Queue()
+
+    async def read(batch: List[str]) -> None:
+        try:
+            # A teacher's repeated request for the same chapter shares each generation
+            key = flight_key("quiz-batch", api_key, json.dumps([batch, familiarity_level, language, question_count]))
+            async for item in llm_flight.stream(
+                key,
+                lambda: _stream_batch_and_bank(batch, language, familiarity_level, question_count, api_key, slot)
+            ):
+                results.put_nowait(item)
+        except Exception as e:
+            logging.error(f"Batch quiz generation failed for {batch}: {str(e)}")
+        finally:
+            results.put_nowait(None)
+
+    readers = [run_in_background(read(batch)) for batch in plan_quiz_batches(missing, question_count)] if missing else []
+    try:
+        running = len(readers)
+        while running:
+            item = await results.get()
+            if item is None:
+                running -= 1
+            else:
+                yield item
+    finally:
+        # The readers are left to run: a shared stream is cancelled once its
+        # last reader goes, and these generations are already paid for, so a
+        # client that disconnects still gets its batches finished and banked
+        for topic in topics:
+            quiz_bank_refiller.request_refill(topic, familiarity_level, language)
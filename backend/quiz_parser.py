@@ -0,0 +1,276 @@
+import json
+import logging
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+from models.chat import QuizQuestion
+
+# What the scanner needs to look at in each state; everything else is
+# skipped by the regex engine instead of a Python loop
+_BETWEEN_OBJECTS = re.compile(r"[\[{\]]")
+_IN_OBJECT = re.compile(r'[{}"]')
+_IN_STRING = re.compile(r'["\\\n]')
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+def coerce_question(item: Any, topic: str) -> Optional[QuizQuestion]:
+    """
+    Validate one decoded quiz item into a QuizQuestion, repairing the
+    mistakes models commonly make. Returns None if it can't be salvaged.
+    """
+    if not isinstance(item, dict):
+        logging.error("Quiz item is not an object")
+        return None
+
+    options = item.get("options")
+    if not options or not isinstance(options, list):
+        logging.error("Question has no options")
+        return None
+
+    # Handle string values (convert to int)
+    correct_answer = item.get("correct_answer")
+    if isinstance(correct_answer, str):
+        try:
+            correct_answer = int(correct_answer.strip())
+        except ValueError:
+            logging.warning(f"Invalid correct_answer format: {correct_answer}, defaulting to 0")
+            correct_answer = 0
+
+    # Ensure correct_answer is within valid range
+    if not isinstance(correct_answer, int) or isinstance(correct_answer, bool) or not 0 <= correct_answer < len(options):
+        logging.warning(f"Invalid correct_answer: {correct_answer}, defaulting to 0")
+        correct_answer = 0
+
+    # Ensure we have improvement suggestions
+    improvement_suggestions = item.get("improvement_suggestions") or [
+        f"Review the concept of {topic} in more detail.",
+        f"Practice with more examples to better understand {topic}.",
+        f"Consider reviewing the documentation for {topic}."
+    ]
+
+    try:
+        return QuizQuestion(
+            question=item.get("question") or "Question text not provided",
+            options=[str(option) for option in options],
+            correct_answer=correct_answer,
+            explanation=item.get("explanation") or "Explanation not provided",
+            improvement_suggestions=improvement_suggestions
+        )
+    except Exception as e:
+        logging.error(f"Error processing quiz question: {str(e)}")
+        return None
+
+class QuizStreamParser:
+    """
+    Tolerant, incremental parser for model quiz output.
+
+    Text can be fed in arbitrary chunks. The scanner makes a single pass:
+    it skips code fences and prose up to the question array and decodes
+    each question object in place as soon as it starts. Objects that are
+    still incomplete or malformed are tracked by brace depth and string
+    state until they close. Each object is validated straight into a
+    QuizQuestion. A malformed object is dropped on its own, so its
+    neighbours still make it into the quiz. A string cut off by a raw
+    newline is treated as unterminated, which keeps the scanner in sync
+    for the following objects.
+    """
+
+    def __init__(self, topic: str, max_questions: Optional[int] = None):
+        self.topic = topic
+        self.max_questions = max_questions
+        self.questions: List[QuizQuestion] = []
+        self.dropped = 0
+        self.validate_seconds = 0.0
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._object_start = -1
+        self._object_broken = False
+        self._in_array = False
+        self._done = False
+
+    @property
+    def done(self) -> bool:
+        return self._done
+
+    def feed(self, chunk: str) -> List[QuizQuestion]:
+        """
+        Consume more model output and return the questions it completed.
+        """
+        if self._done or not chunk:
+            return []
+
+        # Between objects nothing before the scan position is needed again
+        if self._depth == 0 and self._pos:
+            self._buffer = self._buffer[self._pos:]
+            self._pos = 0
+        self._buffer += chunk
+
+        completed: List[QuizQuestion] = []
+        buffer = self._buffer
+        pos = self._pos
+        end = len(buffer)
+        while pos < end and not self._done:
+            if self._in_string:
+                match = _IN_STRING.search(buffer, pos)
+                if match is None:
+                    pos = end
+                    break
+                index = match.start()
+                char = buffer[index]
+                if char == "\\":
+                    if index + 1 >= end:
+                        # The escaped character hasn't arrived yet
+                        pos = index
+                        break
+                    pos = index + 2
+                    continue
+                if char == "\n":
+                    # JSON strings can't contain raw newlines: the closing quote is missing
+                    self._object_broken = True
+                self._in_string = False
+                pos = index + 1
+            elif self._depth > 0:
+                match = _IN_OBJECT.search(buffer, pos)
+                if match is None:
+                    pos = end
+                    break
+                index = match.start()
+                char = buffer[index]
+                pos = index + 1
+                if char == '"':
+                    self._in_string = True
+                elif char == "{":
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        question = self._finish_object(buffer, self._object_start, pos)
+                        if question is not None:
+                            completed.append(question)
+            else:
+                match = _BETWEEN_OBJECTS.search(buffer, pos)
+                if match is None:
+                    pos = end
+                    break
+                index = match.start()
+                char = buffer[index]
+                pos = index + 1
+                if char == "{":
+                    # Fast path: a complete, valid object decodes in one C-level call
+                    try:
+                        item, pos = self._decoder.raw_decode(buffer, index)
+                    except json.JSONDecodeError:
+                        # Incomplete so far, or malformed: scan for its end instead
+                        self._depth = 1
+                        self._object_start = index
+                        self._object_broken = False
+                    else:
+                        question = self._accept(item)
+                        if question is not None:
+                            completed.append(question)
+                elif char == "[":
+                    self._in_array = True
+                elif self._in_array:
+                    self._done = True
+
+        self._pos = pos
+        return completed
+
+    def close(self) -> List[QuizQuestion]:
+        """
+        Signal the end of output. An object still open here was truncated
+        and is counted as dropped.
+        """
+        if self._depth > 0:
+            self.dropped += 1
+            logging.warning("Quiz output ended inside a question; dropping it")
+            self._depth = 0
+        self._done = True
+        return []
+
+    def _finish_object(self, buffer: str, start: int, end: int) -> Optional[QuizQuestion]:
+        item = None
+        if not self._object_broken:
+            try:
+                item, item_end = self._decoder.raw_decode(buffer, start)
+                if item_end != end:
+                    item = None
+            except json.JSONDecodeError:
+                item = None
+        if item is None:
+            # Trailing commas are the one defect that is safe to repair
+            try:
+                item = json.loads(_TRAILING_COMMA.sub(r"\1", buffer[start:end]))
+            except json.JSONDecodeError as e:
+                self.dropped += 1
+                logging.error(f"Dropping malformed quiz question: {str(e)}")
+                return None
+        return self._accept(item)
+
+    def _accept(self, item: Any) -> Optional[QuizQuestion]:
+        if self.max_questions is not None and len(self.questions) >= self.max_questions:
+            self._done = True
+            return None
+
+        started = time.perf_counter()
+        question = coerce_question(item, self.topic)
+        self.validate_seconds += time.perf_counter() - started
+        if question is None:
+            self.dropped += 1
+            return None
+        self.questions.append(question)
+        return question
+
+class BatchQuizParser(QuizStreamParser):
+    """
+    QuizStreamParser for several topics in one response. Each question
+    carries a "topic" field naming one of the requested topics; questions
+    are validated against that topic and capped per topic.
+    """
+
+    def __init__(self, topics: List[str], per_topic: int):
+        super().__init__(", ".join(topics))
+        self.per_topic = per_topic
+        self.by_topic: Dict[str, List[QuizQuestion]] = {topic: [] for topic in topics}
+        self._topic_keys = {" ".join(topic.split()).casefold(): topic for topic in topics}
+        self._completed: List[Tuple[str, QuizQuestion]] = []
+
+    def feed_tagged(self, chunk: str) -> List[Tuple[str, QuizQuestion]]:
+        """
+        Like feed(), returning (topic, question) pairs.
+        """
+        self.feed(chunk)
+        completed, self._completed = self._completed, []
+        return completed
+
+    def _accept(self, item: Any) -> Optional[QuizQuestion]:
+        label = item.get("topic") if isinstance(item, dict) else None
+        topic = self._topic_keys.get(" ".join(str(label or "").split()).casefold())
+        if topic is None:
+            self.dropped += 1
+            logging.error(f"Dropping quiz question for unrequested topic: {label}")
+            return None
+        if len(self.by_topic[topic]) >= self.per_topic:
+            return None
+
+        started = time.perf_counter()
+        question = coerce_question(item, topic)
+        self.validate_seconds += time.perf_counter() - started
+        if question is None:
+            self.dropped += 1
+            return None
+        self.questions.append(question)
+        self.by_topic[topic].append(question)
+        self._completed.append((topic, question))
+        return question
+
+def parse_quiz(text: str, topic: str, max_questions: Optional[int] = None) -> List[QuizQuestion]:
+    """
+    Parse a complete model response into validated questions.
+    """
+    parser = QuizStreamParser(topic, max_questions)
+    parser.feed(text)
+    parser.close()
+    return parser.questions
@@ -0,0 +1,264 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from google.api_core import exceptions as google_exceptions
+from config import (
+    AUTO_MODEL,
+    AVAILABLE_MODELS,
+    LLM_MAX_RETRIES,
+    LLM_RETRY_BASE_SECONDS,
+    LLM_RETRY_MAX_SECONDS,
+    LLM_STREAM_IDLE_TIMEOUT_SECONDS,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RECOVERY_SECONDS,
+    LLM_FAILOVER_MODELS
+)
+
+class CircuitOpen(Exception):
+    """
+    Raised without calling upstream when every candidate model's breaker is open.
+    """
+
+    def __init__(self, model: str, retry_after: float):
+        super().__init__(f"Model {model} is temporarily unavailable")
+        self.model = model
+        self.retry_after = retry_after
+
+def is_transient(e: BaseException) -> bool:
+    """
+    Errors worth retrying: timeouts, dropped connections, 5xx and 429.
+    Bad keys, bad requests and safety blocks fail the same way every time.
+    """
+    return isinstance(e, (
+        asyncio.TimeoutError,
+        ConnectionError,
+        google_exceptions.ServerError,
+        google_exceptions.TooManyRequests,
+        google_exceptions.ResourceExhausted
+    ))
+
+def counts_against_model(e: BaseException) -> bool:
+    # A 429 is about the caller's key, not the model's health
+    return is_transient(e) and not isinstance(e, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted))
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Full-jitter exponential backoff: uniform in [0, min(cap, base * 2^attempt)].
+    """
+    return random.uniform(0, min(LLM_RETRY_MAX_SECONDS, LLM_RETRY_BASE_SECONDS * 2 ** attempt))
+
+class CircuitBreaker:
+    """
+    Per-model breaker. Closed: calls flow. After `failure_threshold`
+    consecutive failures it opens and calls fail fast for `recovery_seconds`.
+    Then a single probe call is let through (half-open): success closes the
+    breaker, failure opens it again.
+    """
+
+    def __init__(self, model: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, recovery_seconds: float = CIRCUIT_RECOVERY_SECONDS):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.recovery_seconds:
+            return "open"
+        return "half_open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.recovery_seconds - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self.probing:
+                self.trips += 1
+                logging.warning(f"Circuit breaker opened for {self.model} after {self.failures} failures")
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release_probe(self) -> None:
+        # The probe ended without telling us anything about the model
+        self.probing = False
+
+class ResilienceLayer:
+    """
+    Deadlines, bounded retries and per-model circuit breakers around upstream calls.
+    """
+
+    def __init__(self, failover_models: List[str] = LLM_FAILOVER_MODELS, max_retries: int = LLM_MAX_RETRIES):
+        self.failover_models = failover_models
+        self.max_retries = max_retries
+        self.breakers: Dict[str, CircuitBreaker] = {model: CircuitBreaker(model) for model in AVAILABLE_MODELS if model != AUTO_MODEL}
+        self.retries = 0
+        self.failovers = 0
+        self.short_circuited = 0
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker(model)
+        return breaker
+
+    def pick_model(self, model: str) -> str:
+        """
+        The requested model if its breaker lets the call through, otherwise
+        the first healthy failover model. Raises CircuitOpen if there is none.
+        """
+        for candidate in [model] + [m for m in self.failover_models if m != model]:
+            if self.breaker(candidate).allow():
+                if candidate != model:
+                    self.failovers += 1
+                    logging.warning(f"Failing over from {model} to {candidate}")
+                return candidate
+        self.short_circuited += 1
+        raise CircuitOpen(model, self.breaker(model).retry_after())
+
+    def _record(self, model: str, e: Optional[BaseException]) -> None:
+        breaker = self.breaker(model)
+        if e is None:
+            breaker.record_success()
+        elif counts_against_model(e):
+            breaker.record_failure()
+        else:
+            breaker.release_probe()
+
+    async def _backoff(self, attempt: int, e: BaseException, deadline_at: float) -> None:
+        """
+        Sleep before the next attempt, or re-raise if retrying can't help.
+        """
+        if not is_transient(e) or attempt >= self.max_retries:
+            raise e
+        delay = backoff_delay(attempt)
+        if time.monotonic() + delay >= deadline_at:
+            raise e
+        self.retries += 1
+        logging.warning(f"Transient upstream error, retrying in {delay:.2f}s: {str(e)}")
+        await asyncio.sleep(delay)
+
+    async def call(self, model: str, fn: Callable[[str, float], Awaitable[Any]], deadline: float) -> Any:
+        """
+        Run fn(model, timeout) within `deadline` seconds overall, retrying
+        transient failures and failing over when the model's breaker is open.
+        """
+        deadline_at = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            attempt_model = self.pick_model(model)
+            remaining = deadline_at - time.monotonic()
+            try:
+                result = await asyncio.wait_for(fn(attempt_model, remaining), remaining)
+            except Exception as e:
+                self._record(attempt_model, e)
+                await self._backoff(attempt, e, deadline_at)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker(attempt_model).release_probe()
+                raise
+            self._record(attempt_model, None)
+            return result
+
+    async def stream(
+        self,
+        model: str,
+        fn: Callable[[str, float], AsyncIterator[Any]],
+        first_chunk_timeout: float,
+        deadline: float,
+        idle_timeout: float = LLM_STREAM_IDLE_TIMEOUT_SECONDS
+    ) -> AsyncIterator[Any]:
+        """
+        Streaming counterpart of call(). Attempts are retried only until the
+        first chunk arrives; after that a failure would duplicate output
+        already sent, so it is raised. Each later chunk must arrive within
+        `idle_timeout`, and the whole stream within `deadline`.
+        """
+        deadline_at = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            attempt_model = self.pick_model(model)
+            chunks = fn(attempt_model, deadline_at - time.monotonic()).__aiter__()
+            try:
+                timeout = min(first_chunk_timeout, deadline_at - time.monotonic())
+                first_chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+            except StopAsyncIteration:
+                self._record(attempt_model, None)
+                return
+            except Exception as e:
+                self._record(attempt_model, e)
+                await _close(chunks)
+                await self._backoff(attempt, e, deadline_at)
+                attempt += 1
+                continue
+            except BaseException:
+                self.breaker(attempt_model).release_probe()
+                await _close(chunks)
+                raise
+            break
+
+        failure: Optional[BaseException] = None
+        try:
+            yield first_chunk
+            while True:
+                timeout = min(idle_timeout, deadline_at - time.monotonic())
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), timeout)
+                except StopAsyncIteration:
+                    break
+                yield chunk
+        except Exception as e:
+            failure = e
+            raise
+        finally:
+            await _close(chunks)
+            if failure is not None:
+                self._record(attempt_model, failure)
+            else:
+                # Finished, or the reader went away; either way the model answered
+                self._record(attempt_model, None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "retries": self.retries,
+            "failovers": self.failovers,
+            "short_circuited": self.short_circuited,
+            "breakers": {
+                model: {"state": breaker.state, "failures": breaker.failures, "trips": breaker.trips}
+                for model, breaker in self.breakers.items()
+            }
+        }
+
+async def _close(chunks: AsyncIterator[Any]) -> None:
+    aclose = getattr(chunks, "aclose", None)
+    if aclose is not None:
+        try:
+            await aclose()
+        except Exception:
+            pass
+
+resilience = ResilienceLayer()
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+from config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_PATH
+
+def normalize_text(text: Optional[str]) -> str:
+    """
+    Case-fold and collapse whitespace so trivially different inputs share a key.
+    """
+    return " ".join((text or "").split()).casefold()
+
+def make_cache_key(topic: str, familiarity_level: str, conversation_mode: str, language: str, model: str, query: str) -> str:
+    """
+    Build a stable cache key from the build_user_message inputs and the model.
+    """
+    parts = [topic, familiarity_level, conversation_mode, language, model, query]
+    normalized = json.dumps([normalize_text(part) for part in parts], ensure_ascii=False)
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Two-tier cache for deterministic tutor responses.
+
+    The memory tier is a bounded LRU. The optional disk tier is a SQLite file,
+    so entries survive restarts; disk hits are promoted into memory. Every
+    entry expires ttl_seconds after it was written.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES, ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS, path: Optional[str] = RESPONSE_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value, from_disk = self._lookup(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.disk_hits += from_disk
+            return value
+
+    def peek(self, key: str) -> Optional[str]:
+        """
+        get() without counting a hit or miss, for callers polling for a
+        response another worker is still generating.
+        """
+        with self._lock:
+            return self._lookup(key)[0]
+
+    def _lookup(self, key: str) -> Tuple[Optional[str], bool]:
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                return value, False
+            del self._memory[key]
+
+        if self._db is not None:
+            try:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+                ).fetchone()
+            except sqlite3.Error as e:
+                logging.error(f"Response cache disk read failed: {str(e)}")
+                row = None
+            if row is not None and row[1] > now:
+                self._remember(key, row[0], row[1])
+                return row[0], True
+        return None, False
+
+    def set(self, key: str, value: str) -> None:
+        expires_at = time.time() + self.ttl_seconds
+        with self._lock:
+            self._remember(key, value, expires_at)
+            if self._db is not None:
+                try:
+                    self._db.execute(
+                        "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                        (key, value, expires_at)
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logging.error(f"Response cache disk write failed: {str(e)}")
+
+    def _remember(self, key: str, value: str, expires_at: float) -> None:
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._memory),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "disk_enabled": self._db is not None
+        }
+
+response_cache = ResponseCache()
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import random
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterable, List, Optional
+from resilience import resilience
+from config import (
+    ROUTER_MODELS,
+    ROUTER_EWMA_ALPHA,
+    ROUTER_EXPLORE_RATIO,
+    ROUTER_MIN_SAMPLES,
+    ROUTER_LATENCY_WINDOW,
+    ROUTER_HEDGE_ENABLED,
+    ROUTER_HEDGE_DEFAULT_SECONDS,
+    ROUTER_HEDGE_MAX_RATIO
+)
+
+class ModelStats:
+    """
+    Live latency and error estimates for one model: EWMAs for routing and a
+    window of recent latencies for the p95 hedge threshold.
+    """
+
+    def __init__(self):
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.recent: Deque[float] = deque(maxlen=ROUTER_LATENCY_WINDOW)
+
+    def observe_latency(self, seconds: float) -> None:
+        self.samples += 1
+        self.recent.append(seconds)
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += ROUTER_EWMA_ALPHA * (seconds - self.latency)
+
+    def observe_outcome(self, failed: bool) -> None:
+        self.error_rate += ROUTER_EWMA_ALPHA * (float(failed) - self.error_rate)
+
+    def p95(self) -> Optional[float]:
+        if len(self.recent) < ROUTER_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def expected_seconds(self) -> float:
+        # Expected time to a good answer if failures are retried: latency / P(success)
+        return self.latency / max(0.05, 1.0 - self.error_rate)
+
+class ModelRouter:
+    """
+    Resolve model="auto" to a concrete model using live per-model stats.
+
+    Models that haven't been sampled enough are tried first, a small share of
+    requests goes to a random candidate so a model that recovers is noticed,
+    and the rest go to the model with the lowest expected latency. Models
+    whose circuit breaker is open are skipped.
+    """
+
+    def __init__(self, name: str, models: List[str] = ROUTER_MODELS):
+        self.name = name
+        self.models = models
+        self._by_model: Dict[str, ModelStats] = {model: ModelStats() for model in models}
+        self.routed = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _stats(self, model: str) -> ModelStats:
+        stats = self._by_model.get(model)
+        if stats is None:
+            stats = self._by_model[model] = ModelStats()
+        return stats
+
+    def observe(self, model: str, seconds: Optional[float] = None, failed: Optional[bool] = None) -> None:
+        """
+        Record a latency sample and/or whether a call failed because of the model.
+        """
+        stats = self._stats(model)
+        if seconds is not None:
+            stats.observe_latency(seconds)
+        if failed is not None:
+            stats.observe_outcome(failed)
+
+    def choose(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        excluded = set(exclude)
+        candidates = [m for m in self.models if m not in excluded and resilience.breaker(m).state != "open"]
+        if not candidates:
+            # Let the resilience layer fail over or fail fast
+            candidates = [m for m in self.models if m not in excluded]
+            if not candidates:
+                return None
+        if not excluded:
+            self.routed += 1
+
+        unexplored = [m for m in candidates if self._stats(m).samples < ROUTER_MIN_SAMPLES]
+        if unexplored:
+            return min(unexplored, key=lambda m: self._stats(m).samples)
+        if random.random() < ROUTER_EXPLORE_RATIO:
+            return random.choice(candidates)
+        return min(candidates, key=lambda m: self._stats(m).expected_seconds())
+
+    def hedge_delay(self, model: str) -> float:
+        p95 = self._stats(model).p95()
+        return p95 if p95 is not None else ROUTER_HEDGE_DEFAULT_SECONDS
+
+    def _may_hedge(self) -> bool:
+        # Hedging adds upstream load, so it is capped at a share of routed requests
+        return ROUTER_HEDGE_ENABLED and self.hedges < ROUTER_HEDGE_MAX_RATIO * self.routed
+
+    async def hedged(self, fn: Callable[[str], Awaitable[Any]]) -> Any:
+        """
+        Run fn(model) on the best model. If it hasn't answered by that
+        model's p95 latency, run it on the next best model as well, return
+        the first successful result and cancel the other call. A cancelled
+        call that already reached the provider still finishes upstream and
+        is charged to the key when it does (see run_blocking).
+        """
+        primary = self.choose()
+        first = asyncio.ensure_future(fn(primary))
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay(primary))
+            if done or not self._may_hedge():
+                return await first
+            secondary = self.choose(exclude=(primary,))
+            if secondary is None:
+                return await first
+
+            self.hedges += 1
+            logging.info(f"Hedging {primary} with {secondary} after {self.hedge_delay(primary):.2f}s")
+            second = asyncio.ensure_future(fn(secondary))
+            tasks.append(second)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # Both failed; report the original request's error
+            return first.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "routed": self.routed,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "models": {
+                model: {
+                    "ewma_latency": round(stats.latency, 3) if stats.latency is not None else None,
+                    "p95_latency": round(stats.p95(), 3) if stats.p95() is not None else None,
+                    "error_rate": round(stats.error_rate, 3),
+                    "samples": stats.samples
+                }
+                for model, stats in self._by_model.items()
+            }
+        }
+
+# Chat answers and quizzes differ a lot in length, so they are tracked separately
+chat_router = ModelRouter("chat")
+quiz_router = ModelRouter("quiz")
@@ -0,0 +1,240 @@
+import json
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from response_cache import normalize_text
+from config import (
+    SEMANTIC_CACHE_ENABLED,
+    SEMANTIC_CACHE_THRESHOLD,
+    SEMANTIC_CACHE_DIM,
+    SEMANTIC_CACHE_MAX_PER_PARTITION,
+    SEMANTIC_CACHE_MAX_PARTITIONS,
+    RESPONSE_CACHE_TTL_SECONDS
+)
+
+# Words (with any apostrophe kept inside them) and runs of operator or
+# punctuation characters, so "x == 5" and "x = 5" tokenize differently
+_TOKEN = re.compile(r"\w+(?:'\w+)*|[^\w\s]+")
+
+# Sentence punctuation, dropped from the end of operator tokens
+_PUNCTUATION = "?!.,;:'\"`"
+
+# Filler words that paraphrases add or drop. Python keywords (for, while,
+# in, not, and, or, with, ...) are deliberately kept: they carry the meaning.
+_STOP_WORDS = frozenset("""
+a an the what whats how do does did i me my please explain tell about can could would you
+show give describe understand work works working mean means meaning to of on some use using
+are is was be help regarding difference between vs versus example examples
+""".split())
+
+def _stem(word: str) -> str:
+    """
+    Strip plural and -ing endings so that a word and its inflections meet
+    at the same stem ("variable" and "variables", "loop" and "looping").
+    """
+    if len(word) > 4 and word.endswith("ies"):
+        word = word[:-3] + "y"
+    elif len(word) > 4 and word.endswith("es") and word[:-2].endswith(("sh", "ch", "ss", "x", "z")):
+        word = word[:-2]
+    elif len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        word = word[:-1]
+    # Only when a real stem is left, so "string" stays "string"
+    if len(word) > 6 and word.endswith("ing"):
+        word = word[:-3]
+    return word
+
+def _terms(query: str) -> List[str]:
+    """
+    Content words, stemmed, plus numbers and operators, in query order.
+    """
+    terms = []
+    for token in _TOKEN.findall(query.casefold()):
+        if token[0].isalnum() or token[0] == "_":
+            word = token.replace("'", "")
+            if word not in _STOP_WORDS:
+                terms.append(word if word.isdigit() else _stem(word))
+        else:
+            # "?" or ")." end a sentence, but "!=" is an operator
+            operator = token.rstrip(_PUNCTUATION)
+            if operator:
+                terms.append(operator)
+    return terms
+
+def query_signature(query: str) -> str:
+    """
+    The numbers and operators of a query, in order. Only queries with the
+    same signature are compared, since no similarity score can tell
+    "x = 5" from "x == 5" or range(1, 10) from range(10, 1) reliably.
+    """
+    return " ".join(term for term in _terms(query) if term.isdigit() or not (term[0].isalnum() or term[0] == "_"))
+
+def _signature_hash(query: str) -> int:
+    return zlib.crc32(query_signature(query).encode("utf-8"))
+
+def _slot(feature: str, dim: int) -> int:
+    # crc32 rather than hash(), which is salted per process
+    return zlib.crc32(feature.encode("utf-8")) % dim
+
+def embed_query(query: str, dim: int = SEMANTIC_CACHE_DIM) -> Optional[np.ndarray]:
+    """
+    Hashed terms, character trigrams of words and ordered term bigrams,
+    L2-normalised so a dot product is the cosine similarity. Bigrams weigh
+    as much as terms, so the same words in another order ("int to float",
+    "float to int") stay apart. Returns None when the query has no terms.
+    """
+    terms = _terms(query)
+    if not terms:
+        return None
+
+    vector = np.zeros(dim, dtype=np.float32)
+    for term in terms:
+        vector[_slot("w:" + term, dim)] += 1.0
+        if not term.isalpha():
+            continue
+        # Trigrams catch inflections and typos the stemmer misses
+        padded = f"<{term}>"
+        grams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+        for gram in grams:
+            vector[_slot("g:" + gram, dim)] += 1.0 / len(grams)
+    for first, second in zip(terms, terms[1:]):
+        vector[_slot(f"b:{first} {second}", dim)] += 1.0
+
+    return vector / np.linalg.norm(vector)
+
+def make_partition_key(topic: str, familiarity_level: str, conversation_mode: str, language: str, model: str) -> str:
+    """
+    Everything but the query that shapes a tutor response; only queries
+    within the same partition are ever compared.
+    """
+    parts = [topic, familiarity_level, conversation_mode, language, model]
+    return json.dumps([normalize_text(part) for part in parts], ensure_ascii=False)
+
+class _Partition:
+    """
+    Vector matrix for one partition, grown by doubling up to `capacity`.
+    Full partitions reuse the slot of their least recently hit entry. Each
+    entry also keeps a hash of its query signature, which a match must share.
+    """
+
+    def __init__(self, capacity: int, dim: int):
+        self.capacity = capacity
+        initial = min(capacity, 8)
+        self.vectors = np.zeros((initial, dim), dtype=np.float32)
+        self.last_used = np.zeros(initial, dtype=np.float64)
+        self.expires_at = np.zeros(initial, dtype=np.float64)
+        self.signatures = np.zeros(initial, dtype=np.uint32)
+        self.responses: List[Optional[str]] = [None] * initial
+        self.size = 0
+
+    def search(self, vector: np.ndarray, signature: int, now: float) -> Optional[Tuple[int, float]]:
+        if self.size == 0:
+            return None
+        similarities = self.vectors[:self.size] @ vector
+        # Expired entries and queries with other numbers or operators can't match
+        similarities[(self.expires_at[:self.size] <= now) | (self.signatures[:self.size] != signature)] = -1.0
+        best = int(np.argmax(similarities))
+        return best, float(similarities[best])
+
+    def _grow(self) -> None:
+        rows = min(self.capacity, 2 * len(self.responses))
+        extra = rows - len(self.responses)
+        self.vectors = np.concatenate([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.last_used = np.concatenate([self.last_used, np.zeros(extra)])
+        self.expires_at = np.concatenate([self.expires_at, np.zeros(extra)])
+        self.signatures = np.concatenate([self.signatures, np.zeros(extra, dtype=np.uint32)])
+        self.responses.extend([None] * extra)
+
+    def insert(self, vector: np.ndarray, signature: int, response: str, now: float, ttl_seconds: float) -> None:
+        if self.size == len(self.responses) and self.size < self.capacity:
+            self._grow()
+        if self.size < len(self.responses):
+            slot = self.size
+            self.size += 1
+        else:
+            slot = int(np.argmin(self.last_used))
+        self.vectors[slot] = vector
+        self.responses[slot] = response
+        self.last_used[slot] = now
+        self.expires_at[slot] = now + ttl_seconds
+        self.signatures[slot] = signature
+
+class SemanticCache:
+    """
+    Near-duplicate cache for free-form tutor queries, so "what is a for loop"
+    and "explain for loops please" on the same topic share one response.
+
+    Queries are embedded locally (no model call) and compared with a single
+    matrix-vector product against the other queries in their partition.
+    Memory is bounded by entries per partition and an LRU over partitions.
+    """
+
+    def __init__(
+        self,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        dim: int = SEMANTIC_CACHE_DIM,
+        max_per_partition: int = SEMANTIC_CACHE_MAX_PER_PARTITION,
+        max_partitions: int = SEMANTIC_CACHE_MAX_PARTITIONS,
+        ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS,
+        enabled: bool = SEMANTIC_CACHE_ENABLED
+    ):
+        self.threshold = threshold
+        self.dim = dim
+        self.max_per_partition = max_per_partition
+        self.max_partitions = max_partitions
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self._partitions: "OrderedDict[str, _Partition]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, partition_key: str, query: str) -> Optional[str]:
+        if not self.enabled:
+            return None
+        vector = embed_query(query, self.dim)
+        if vector is None:
+            return None
+        now = time.time()
+        with self._lock:
+            partition = self._partitions.get(partition_key)
+            match = partition.search(vector, _signature_hash(query), now) if partition is not None else None
+            if match is None or match[1] < self.threshold:
+                self.misses += 1
+                return None
+            self._partitions.move_to_end(partition_key)
+            partition.last_used[match[0]] = now
+            self.hits += 1
+            return partition.responses[match[0]]
+
+    def set(self, partition_key: str, query: str, response: str) -> None:
+        if not self.enabled:
+            return
+        vector = embed_query(query, self.dim)
+        if vector is None:
+            return
+        with self._lock:
+            partition = self._partitions.get(partition_key)
+            if partition is None:
+                partition = self._partitions[partition_key] = _Partition(self.max_per_partition, self.dim)
+                while len(self._partitions) > self.max_partitions:
+                    self._partitions.popitem(last=False)
+            else:
+                self._partitions.move_to_end(partition_key)
+            partition.insert(vector, _signature_hash(query), response, time.time(), self.ttl_seconds)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "partitions": len(self._partitions),
+            "entries": sum(partition.size for partition in self._partitions.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "threshold": self.threshold
+        }
+
+semantic_cache = SemanticCache()
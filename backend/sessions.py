@@ -0,0 +1,209 @@
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from usage_store import usage_key
+from token_counter import count_tokens
+from config import (
+    SESSION_MAX_SESSIONS,
+    SESSION_IDLE_SECONDS,
+    SESSION_HISTORY_TOKEN_BUDGET,
+    SESSION_KEEP_RECENT_TURNS,
+    SESSION_DB_PATH,
+    SHARED_STATE
+)
+
+class Turn:
+    __slots__ = ("role", "text", "tokens")
+
+    def __init__(self, role: str, text: str):
+        self.role = role
+        self.text = text
+        # Counted once here, so prompt projection never re-tokenizes history
+        self.tokens = count_tokens(text) + 2
+
+class Session:
+    """
+    One learner's conversation: a running summary of compacted turns
+    followed by the recent turns verbatim.
+    """
+
+    def __init__(self, key: str = ""):
+        self.key = key
+        self.version = 0
+        self.summary = ""
+        self.summary_tokens = 0
+        self.turns: List[Turn] = []
+        self.turn_tokens = 0
+        self.compacting = False
+        self.last_used = time.monotonic()
+        self._rendered: Optional[str] = None
+
+    def to_json(self) -> str:
+        return json.dumps({"summary": self.summary, "turns": [[turn.role, turn.text] for turn in self.turns]})
+
+    @classmethod
+    def from_json(cls, key: str, version: int, data: str) -> "Session":
+        state = json.loads(data)
+        session = cls(key)
+        session.version = version
+        if state["summary"]:
+            session.summary = state["summary"]
+            session.summary_tokens = count_tokens(session.summary) + 4
+        for role, text in state["turns"]:
+            session.add(role, text)
+        return session
+
+    @property
+    def tokens(self) -> int:
+        return self.summary_tokens + self.turn_tokens
+
+    def render(self) -> str:
+        """
+        The history block for the prompt. It only ever grows at the end
+        between compactions, so consecutive prompts share a long prefix.
+        """
+        if self._rendered is None:
+            if not self.summary and not self.turns:
+                self._rendered = ""
+            else:
+                lines = ["Conversation so far:"]
+                if self.summary:
+                    lines.append(f"Summary of earlier turns: {self.summary}")
+                lines.extend(f"{turn.role}: {turn.text}" for turn in self.turns)
+                self._rendered = "\n".join(lines)
+        return self._rendered
+
+    def add(self, role: str, text: str) -> None:
+        turn = Turn(role, text)
+        self.turns.append(turn)
+        self.turn_tokens += turn.tokens
+        self._rendered = None
+
+    def needs_compaction(self) -> bool:
+        return self.tokens > SESSION_HISTORY_TOKEN_BUDGET and len(self.turns) > SESSION_KEEP_RECENT_TURNS
+
+    def compactable(self) -> Tuple[List[Turn], int]:
+        """
+        The turns a compaction would fold into the summary, and how many.
+        """
+        count = max(0, len(self.turns) - SESSION_KEEP_RECENT_TURNS)
+        return self.turns[:count], count
+
+    def apply_summary(self, summary: str, count: int) -> None:
+        """
+        Replace the first `count` turns with a new summary. Turns added while
+        the summary was being written come after them and are kept.
+        """
+        self.drop_oldest(count)
+        self.summary = summary
+        self.summary_tokens = count_tokens(summary) + 4
+        self._rendered = None
+
+    def drop_oldest(self, count: int) -> None:
+        dropped, self.turns = self.turns[:count], self.turns[count:]
+        self.turn_tokens -= sum(turn.tokens for turn in dropped)
+        self._rendered = None
+
+    def enforce_hard_limit(self) -> None:
+        # If summaries can't keep up, forget the oldest turns rather than grow
+        while self.tokens > 2 * SESSION_HISTORY_TOKEN_BUDGET and len(self.turns) > 1:
+            self.drop_oldest(1)
+
+class SessionStore:
+    """
+    In-memory sessions keyed by API key and client session id, with LRU
+    and idle eviction so memory stays bounded. Only used from the event loop.
+
+    With a database path, sessions are also written to SQLite after every
+    change, and get() reloads one whose stored version moved on, so a
+    conversation continues whichever worker process serves the next turn.
+    """
+
+    def __init__(self, max_sessions: int = SESSION_MAX_SESSIONS, idle_seconds: int = SESSION_IDLE_SECONDS, path: Optional[str] = SESSION_DB_PATH if SHARED_STATE else None):
+        self.max_sessions = max_sessions
+        self.idle_seconds = idle_seconds
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.compactions = 0
+        self._db = None
+        self._pruned_at = 0.0
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (key TEXT PRIMARY KEY, version INTEGER NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _key(self, api_key: str, session_id: str) -> str:
+        # Scoped to the key, so a guessed session id can't read someone else's history
+        return f"{usage_key(api_key)}:{session_id}"
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        while self._sessions:
+            oldest_key, oldest = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - oldest.last_used < self.idle_seconds:
+                break
+            del self._sessions[oldest_key]
+        if self._db is not None and now - self._pruned_at >= 60:
+            self._pruned_at = now
+            self._execute("DELETE FROM sessions WHERE updated_at < ?", (time.time() - self.idle_seconds,))
+
+    def _execute(self, sql: str, params: tuple) -> Optional[tuple]:
+        try:
+            row = self._db.execute(sql, params).fetchone()
+            self._db.commit()
+            return row
+        except sqlite3.Error as e:
+            # The in-memory copy still serves this worker
+            logging.error(f"Session store database error: {str(e)}")
+            return None
+
+    def _reload(self, key: str, session: Optional[Session]) -> Optional[Session]:
+        row = self._execute("SELECT version, data FROM sessions WHERE key = ?", (key,))
+        if row is None or (session is not None and row[0] == session.version):
+            return session
+        return Session.from_json(key, row[0], row[1])
+
+    def get(self, api_key: str, session_id: str) -> Session:
+        key = self._key(api_key, session_id)
+        session = self._sessions.get(key)
+        if self._db is not None:
+            # Another worker may have served the last turn
+            reloaded = self._reload(key, session)
+            if reloaded is not session:
+                session = self._sessions[key] = reloaded
+        if session is None:
+            session = self._sessions[key] = Session(key)
+        else:
+            self._sessions.move_to_end(key)
+        session.last_used = time.monotonic()
+        self._evict()
+        return session
+
+    def save(self, session: Session) -> None:
+        if self._db is None:
+            return
+        session.version += 1
+        self._execute(
+            "INSERT OR REPLACE INTO sessions (key, version, data, updated_at) VALUES (?, ?, ?, ?)",
+            (session.key, session.version, session.to_json(), time.time())
+        )
+
+    def history_tokens(self, api_key: str, session_id: Optional[str]) -> int:
+        if not api_key or not session_id:
+            return 0
+        session = self._sessions.get(self._key(api_key, session_id))
+        return session.tokens if session is not None else 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self._sessions),
+            "history_tokens": sum(session.tokens for session in self._sessions.values()),
+            "compactions": self.compactions
+        }
+
+session_store = SessionStore()
@@ -0,0 +1,181 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional
+from leases import LeaseStore, flight_leases
+from usage_store import usage_key
+from config import FLIGHT_LEASE_POLL_SECONDS
+
+def flight_key(kind: str, api_key: str, *parts: str) -> str:
+    """
+    Key for a call made with a learner's API key. Only requests with the
+    same key share such a call: a shared call runs on the first caller's key
+    and quota, and its key errors would fail every other caller too.
+    """
+    return f"{kind}:{usage_key(api_key)}:" + "|".join(parts)
+
+class _SharedStream:
+    """
+    Chunks produced by one upstream stream, replayable by any number of readers.
+    """
+
+    def __init__(self):
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.readers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        # Wake everyone waiting on the current event, then start a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self) -> None:
+        await self._changed.wait()
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls into one upstream call.
+
+    The first caller for a key starts the work as a task; callers that arrive
+    while it is running await the same task. The task is shielded, so a
+    leader that disconnects doesn't cancel the call for everyone else.
+
+    With several worker processes, the leader also takes a lease on the key.
+    Work that passes a `lookup` (reading the shared store the work writes its
+    result to) then waits for a leader in another process instead of
+    repeating the call, and only does the work itself if the lease is
+    released or expires without a result appearing.
+    """
+
+    def __init__(self, leases: Optional[LeaseStore] = flight_leases, poll_seconds: float = FLIGHT_LEASE_POLL_SECONDS):
+        self.leases = leases
+        self.poll_seconds = poll_seconds
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _SharedStream] = {}
+        self.calls = 0
+        self.deduplicated = 0
+        self.cross_process = 0
+        self.abandoned = 0
+
+    async def _lease_or_result(self, key: str, lookup: Optional[Callable[[], Any]]) -> Any:
+        """
+        Return None once this process holds the key's lease (or doesn't
+        need one), or the result another process's leader produced.
+        """
+        if self.leases is None or lookup is None:
+            return None
+        while not self.leases.try_acquire(key):
+            await asyncio.sleep(self.poll_seconds)
+            result = lookup()
+            if result is not None:
+                self.cross_process += 1
+                return result
+        # The previous holder may have finished just before the lease was taken
+        result = lookup()
+        if result is not None:
+            self.leases.release(key)
+            self.cross_process += 1
+        return result
+
+    async def _lead(self, key: str, fn: Callable[[], Awaitable[Any]], lookup: Optional[Callable[[], Any]]) -> Any:
+        result = await self._lease_or_result(key, lookup)
+        if result is not None:
+            return result
+        try:
+            return await fn()
+        finally:
+            if self.leases is not None and lookup is not None:
+                self.leases.release(key)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], lookup: Optional[Callable[[], Any]] = None) -> Any:
+        task = self._calls.get(key)
+        if task is not None:
+            self.deduplicated += 1
+        else:
+            self.calls += 1
+            task = asyncio.ensure_future(self._lead(key, fn, lookup))
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def stream(
+        self,
+        key: str,
+        fn: Callable[[], AsyncIterator[Any]],
+        lookup: Optional[Callable[[], Optional[List[Any]]]] = None
+    ) -> AsyncIterator[Any]:
+        """
+        Like do(), for async generators: every caller gets the full chunk
+        sequence, including chunks produced before it joined. `lookup`
+        returns the finished sequence as a list of chunks.
+
+        Unlike do(), the upstream stream is cancelled once every reader has
+        gone, so an abandoned generation stops using tokens.
+        """
+        shared = self._streams.get(key)
+        if shared is not None:
+            self.deduplicated += 1
+        else:
+            self.calls += 1
+            shared = _SharedStream()
+            self._streams[key] = shared
+            shared.task = asyncio.ensure_future(self._pump(key, shared, fn, lookup))
+
+        shared.readers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(shared.chunks):
+                    yield shared.chunks[index]
+                    index += 1
+                if shared.done:
+                    if shared.error is not None:
+                        raise shared.error
+                    return
+                await shared.wait()
+        finally:
+            shared.readers -= 1
+            if shared.readers == 0 and not shared.done:
+                self.abandoned += 1
+                shared.task.cancel()
+
+    async def _pump(
+        self,
+        key: str,
+        shared: _SharedStream,
+        fn: Callable[[], AsyncIterator[Any]],
+        lookup: Optional[Callable[[], Optional[List[Any]]]]
+    ) -> None:
+        leased = False
+        try:
+            finished = await self._lease_or_result(key, lookup)
+            if finished is not None:
+                shared.chunks.extend(finished)
+                return
+            leased = self.leases is not None and lookup is not None
+            async for chunk in fn():
+                shared.chunks.append(chunk)
+                shared.notify()
+        except Exception as e:
+            shared.error = e
+        finally:
+            if leased:
+                self.leases.release(key)
+            shared.done = True
+            self._streams.pop(key, None)
+            shared.notify()
+
+    def stats(self) -> Dict[str, int]:
+        stats = {
+            "upstream_calls": self.calls,
+            "deduplicated": self.deduplicated,
+            "abandoned": self.abandoned,
+            "in_flight": len(self._calls) + len(self._streams)
+        }
+        if self.leases is not None:
+            stats["cross_process"] = self.cross_process
+            stats.update({f"lease_{name}": value for name, value in self.leases.stats().items()})
+        return stats
+
+llm_flight = SingleFlight()
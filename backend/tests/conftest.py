@@ -0,0 +1,40 @@
+"""
+Shared setup for the backend tests. Everything runs offline against the
+fake LLM provider with in-memory stores; the environment must be set before
+any backend module reads config.py.
+
+Run from the backend directory:
+
+    python -m pytest
+"""
+import asyncio
+import os
+import sys
+
+os.environ.update({
+    "LLM_PROVIDER": "fake",
+    "FAKE_LLM_LATENCY_SECONDS": "0.01",
+    "FAKE_LLM_CHUNK_DELAY_SECONDS": "0",
+    "GEMINI_API_KEY": "",
+    "USAGE_STORE": "memory",
+    "QUIZ_BANK_PATH": ":memory:",
+    "WARMUP_DB_PATH": ":memory:",
+    "RESPONSE_CACHE_PATH": "",
+    "TRACE_RECORD_PATH": "",
+    "SERVER_WORKERS": "1",
+    "SHARED_STATE": "false",
+    "ROUTER_EXPLORE_RATIO": "0"
+})
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+@pytest.fixture
+def run():
+    """
+    Run a coroutine to completion on a fresh event loop.
+    """
+    def run_coroutine(coroutine):
+        return asyncio.run(coroutine)
+    return run_coroutine
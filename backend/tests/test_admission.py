@@ -0,0 +1,110 @@
+import asyncio
+import httpx
+import pytest
+import main
+from admission import AdmissionController, AdmissionRejected
+from models.chat import ChatRequest
+from usage_store import MemoryUsageStore
+
+API_KEY = "test-key-0123456789abcdef"
+
+def chat_request(**fields):
+    return ChatRequest(**{
+        "topic": "Variables",
+        "language": "English",
+        "model": "gemini-2.0-flash",
+        "query": "What is a variable?",
+        "familiarity_level": "Novice",
+        "conversation_mode": "Informative",
+        "api_key": API_KEY,
+        **fields
+    })
+
+async def read_events(response) -> str:
+    return "".join([chunk async for chunk in response.body_iterator])
+
+def test_slots_are_released_and_counted(run):
+    admission = AdmissionController(MemoryUsageStore(), quota_limit=1000, max_in_flight=1, max_waiting=1, queue_timeout=0.05)
+
+    async def scenario():
+        async with admission.admit(API_KEY):
+            assert admission.in_flight == 1
+            with pytest.raises(AdmissionRejected):
+                await admission.acquire(API_KEY)
+        assert admission.in_flight == 0
+        async with admission.slot():
+            assert admission.in_flight == 1
+
+    run(scenario())
+    assert admission.in_flight == 0
+    assert admission.rejected == 1
+
+def test_quota_is_checked_against_projected_tokens():
+    usage = MemoryUsageStore()
+    admission = AdmissionController(usage, quota_limit=100)
+    usage.add(API_KEY, 90)
+    admission.check(API_KEY, projected_tokens=10)
+    with pytest.raises(AdmissionRejected) as rejected:
+        admission.check(API_KEY, projected_tokens=11)
+    assert rejected.value.retry_after >= 1
+
+def test_server_key_is_exempt_from_per_key_limits():
+    usage = MemoryUsageStore()
+    server_key = "server-key-0123456789abcdef"
+    admission = AdmissionController(usage, quota_limit=100, server_key=server_key)
+    # Background refills and warm-ups have used up far more than a learner's quota
+    usage.add(server_key, 10_000)
+    for _ in range(50):
+        admission.check(server_key, projected_tokens=50)
+    usage.add(API_KEY, 100)
+    with pytest.raises(AdmissionRejected):
+        admission.check(API_KEY, projected_tokens=1)
+
+def test_unconsumed_chat_stream_holds_no_slot(run):
+    async def scenario():
+        # The client disconnects before the body is ever iterated
+        await main.chat_stream(chat_request())
+        assert main.admission.in_flight == 0
+        response = await main.chat_stream(chat_request())
+        body = await read_events(response)
+        assert "event: done" in body
+        assert main.admission.in_flight == 0
+
+    run(scenario())
+
+def test_chat_stream_abandoned_mid_stream_releases_its_slot(run):
+    async def scenario():
+        response = await main.chat_stream(chat_request(query="Tell me about loops"))
+        events = response.body_iterator
+        await events.__anext__()
+        assert main.admission.in_flight == 1
+        await events.aclose()
+        assert main.admission.in_flight == 0
+
+    run(scenario())
+
+def test_quiz_stream_checks_the_key_before_admitting(run):
+    async def scenario():
+        rejected = main.admission.rejected
+        response = await main.quiz_stream(chat_request(api_key=None))
+        body = await read_events(response)
+        assert "API key is required" in body
+        assert main.admission.rejected == rejected
+        assert main.admission.in_flight == 0
+
+        await main.quiz_stream(chat_request())
+        assert main.admission.in_flight == 0
+
+    run(scenario())
+
+def test_quiz_stream_over_quota_is_a_429(run):
+    async def scenario():
+        key = "quota-key-0123456789abcdef"
+        main.usage_store.add(key, main.admission.quota_limit)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            response = await client.post("/api/quiz/stream", json=chat_request(api_key=key).model_dump())
+        assert response.status_code == 429
+        assert "Retry-After" in response.headers
+
+    run(scenario())
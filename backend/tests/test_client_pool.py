@@ -0,0 +1,109 @@
+import threading
+from google.ai import generativelanguage as glm
+from client_pool import ClientPool
+from llm_handler import QUIZ_GENERATION_CONFIG, QUIZ_SAFETY_SETTINGS
+
+class StubTransport:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+class StubServiceClient:
+    """
+    Stands in for GenerativeServiceClient at the network boundary.
+    """
+
+    def __init__(self):
+        self.transport = StubTransport()
+        self.requests = []
+        self.stream = None
+
+    def generate_content(self, request, **options):
+        self.requests.append((request, options))
+        return glm.GenerateContentResponse(
+            candidates=[{"content": {"parts": [{"text": "hello"}], "role": "model"}}],
+            usage_metadata={"total_token_count": 7}
+        )
+
+    def stream_generate_content(self, request, **options):
+        self.requests.append((request, options))
+        self.stream = StubStream()
+        return self.stream
+
+class StubStream:
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.waiting = threading.Event()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # Blocks like a gRPC stream until the call is cancelled
+        self.waiting.set()
+        self.cancelled.wait(5)
+        raise RuntimeError("stream cancelled")
+
+    def cancel(self):
+        self.cancelled.set()
+
+def make_pool(max_keys=2):
+    pool = ClientPool(max_keys=max_keys)
+    clients = {}
+    pool._create_client = lambda api_key: clients.setdefault(api_key, StubServiceClient())
+    return pool, clients
+
+def test_request_is_built_for_the_keys_own_client():
+    pool, clients = make_pool()
+    response = pool.get_model("key-a", "gemini-2.0-flash", QUIZ_GENERATION_CONFIG).generate_content(
+        "hello", safety_settings=QUIZ_SAFETY_SETTINGS, request_options={"timeout": 5}
+    )
+
+    assert response.text == "hello"
+    assert response.usage_metadata.total_token_count == 7
+    request, options = clients["key-a"].requests[0]
+    assert request.model == "models/gemini-2.0-flash"
+    assert request.contents[-1].role == "user"
+    assert request.generation_config.response_mime_type == "application/json"
+    assert request.generation_config.response_schema.type_ == glm.Type.ARRAY
+    assert len(request.safety_settings) == len(QUIZ_SAFETY_SETTINGS)
+    assert options == {"timeout": 5}
+
+def test_evicted_client_is_closed():
+    pool, clients = make_pool(max_keys=1)
+    pool.get_model("key-a", "gemini-2.0-flash").generate_content("hello")
+    pool.get_model("key-b", "gemini-2.0-flash").generate_content("hello")
+
+    assert clients["key-a"].transport.closed
+    assert not clients["key-b"].transport.closed
+
+def test_client_in_use_is_closed_when_its_call_ends():
+    pool, clients = make_pool(max_keys=1)
+    model = pool.get_model("key-a", "gemini-2.0-flash")
+    pool.get_model("key-b", "gemini-2.0-flash").generate_content("hello")
+
+    assert not clients["key-a"].transport.closed
+    model.generate_content("hello")
+    assert clients["key-a"].transport.closed
+
+def test_stream_cancel_unblocks_the_reading_thread():
+    pool, clients = make_pool()
+    stream = pool.get_model("key-a", "gemini-2.0-flash").generate_content("hello", stream=True)
+    errors = []
+
+    def read():
+        try:
+            next(stream)
+        except Exception as e:
+            errors.append(type(e))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    clients["key-a"].stream.waiting.wait(5)
+    stream.cancel()
+    reader.join(5)
+
+    assert not reader.is_alive()
+    assert errors == [RuntimeError]
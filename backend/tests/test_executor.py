@@ -0,0 +1,113 @@
+import asyncio
+import threading
+from google.ai import generativelanguage as glm
+import providers
+import gc
+import executor
+from executor import iterate_blocking, run_in_background
+from test_client_pool import make_pool
+
+class BlockingStream:
+    """
+    A response stream whose second next() blocks until cancel(), like a
+    gRPC stream waiting on a slow generation.
+    """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.blocked = threading.Event()
+        self.released = threading.Event()
+        self.sent = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.sent == 0:
+            self.sent += 1
+            return "first"
+        self.blocked.set()
+        self.cancelled.wait(5)
+        self.released.set()
+        raise RuntimeError("stream cancelled")
+
+    def cancel(self):
+        self.cancelled.set()
+
+class StreamingServiceClient:
+    def __init__(self):
+        self.transport = None
+        self.stream = None
+
+    def stream_generate_content(self, request, **options):
+        self.stream = GrpcStream()
+        return self.stream
+
+class GrpcStream(BlockingStream):
+    def __next__(self):
+        text = super().__next__()
+        return glm.GenerateContentResponse(candidates=[{"content": {"parts": [{"text": text}], "role": "model"}}])
+
+def test_exhausted_iterator_is_not_cancelled(run):
+    async def scenario():
+        return [item async for item in iterate_blocking(iter(["a", "b"]))]
+
+    assert run(scenario()) == ["a", "b"]
+
+def test_closing_early_cancels_the_stream(run):
+    stream = BlockingStream()
+
+    async def scenario():
+        chunks = iterate_blocking(stream)
+        assert await chunks.__anext__() == "first"
+        await chunks.aclose()
+
+    run(scenario())
+    assert stream.cancelled.is_set()
+
+def test_cancelling_the_reader_releases_the_pool_thread(run):
+    stream = BlockingStream()
+
+    async def scenario():
+        async def read():
+            async for _ in iterate_blocking(stream):
+                pass
+
+        reader = asyncio.ensure_future(read())
+        await asyncio.get_running_loop().run_in_executor(None, stream.blocked.wait, 5)
+        reader.cancel()
+        await asyncio.gather(reader, return_exceptions=True)
+
+    run(scenario())
+    assert stream.released.wait(1)
+
+def test_gemini_stream_closed_early_cancels_the_grpc_call(run, monkeypatch):
+    pool, clients = make_pool()
+    monkeypatch.setattr(providers, "client_pool", pool)
+    clients["key-a"] = client = StreamingServiceClient()
+
+    async def scenario():
+        chunks = providers.GeminiProvider().stream("key-a", "gemini-2.0-flash", "hello")
+        assert (await chunks.__anext__()).text == "first"
+        await chunks.aclose()
+
+    run(scenario())
+    assert client.stream.cancelled.is_set()
+
+def test_background_task_is_kept_until_it_finishes(run):
+    async def scenario():
+        finished = []
+
+        async def work():
+            await asyncio.sleep(0.01)
+            finished.append(True)
+
+        run_in_background(work())
+        # Nothing else references the task
+        gc.collect()
+        assert len(executor._background_tasks) == 1
+        await asyncio.sleep(0.05)
+        assert finished == [True]
+        assert not executor._background_tasks
+
+    run(scenario())
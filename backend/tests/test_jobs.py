@@ -0,0 +1,91 @@
+import asyncio
+import pytest
+import jobs
+from admission import AdmissionRejected
+from jobs import QuizJobQueue
+
+GOOD_KEY = "good-key-0123456789abcdef"
+BAD_KEY = "bad-key-0123456789abcdef"
+
+@pytest.fixture
+def generations(monkeypatch):
+    calls = []
+
+    async def fake_quiz_questions(topic, language, familiarity_level, api_key=None):
+        calls.append(api_key)
+        await asyncio.sleep(0.05)
+        if api_key == BAD_KEY:
+            raise ValueError("API key not valid")
+        return []
+
+    monkeypatch.setattr(jobs, "get_quiz_questions", fake_quiz_questions)
+    return calls
+
+def submit(queue, api_key, topic="Variables", priority="normal"):
+    return queue.submit(topic=topic, language="English", familiarity_level="Novice", api_key=api_key, priority=priority)
+
+async def finish(queue, *quiz_jobs):
+    for quiz_job in quiz_jobs:
+        while not quiz_job.finished:
+            await queue.wait_for_change(quiz_job, 1)
+    await queue.stop()
+
+def test_identical_jobs_for_one_key_are_shared(run, generations):
+    async def scenario():
+        queue = QuizJobQueue(workers=2, path=None)
+        queue.start()
+        first = submit(queue, GOOD_KEY)
+        second = submit(queue, GOOD_KEY)
+        other_topic = submit(queue, GOOD_KEY, topic="Loops")
+        await finish(queue, first, other_topic)
+        return queue, first, second, other_topic
+
+    queue, first, second, other_topic = run(scenario())
+    assert second is first
+    assert other_topic is not first
+    assert queue.deduplicated == 1
+    assert generations == [GOOD_KEY, GOOD_KEY]
+
+def test_jobs_of_different_keys_run_separately(run, generations):
+    async def scenario():
+        queue = QuizJobQueue(workers=2, path=None)
+        queue.start()
+        failing = submit(queue, BAD_KEY)
+        other_learner = submit(queue, GOOD_KEY)
+        await finish(queue, failing, other_learner)
+        return failing, other_learner
+
+    failing, other_learner = run(scenario())
+    assert other_learner is not failing
+    assert sorted(generations) == sorted([BAD_KEY, GOOD_KEY])
+    assert failing.status == "failed"
+    assert "API key not valid" in failing.error
+    # An empty quiz is a failure of its own, but not the other key's
+    assert "API key not valid" not in (other_learner.error or "")
+    assert failing.api_key is None and other_learner.api_key is None
+
+def test_finished_job_is_not_shared(run, generations):
+    async def scenario():
+        queue = QuizJobQueue(workers=1, path=None)
+        queue.start()
+        first = submit(queue, GOOD_KEY)
+        await finish(queue, first)
+        queue.start()
+        second = submit(queue, GOOD_KEY)
+        await finish(queue, second)
+        return first, second
+
+    first, second = run(scenario())
+    assert second is not first
+    assert len(generations) == 2
+
+def test_queue_full_is_rejected(run, generations):
+    async def scenario():
+        queue = QuizJobQueue(workers=1, max_pending=1, path=None)
+        queue.start()
+        first = submit(queue, GOOD_KEY)
+        with pytest.raises(AdmissionRejected):
+            submit(queue, BAD_KEY)
+        await finish(queue, first)
+
+    run(scenario())
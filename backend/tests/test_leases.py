@@ -0,0 +1,35 @@
+import time
+from leases import LeaseStore
+
+def make_store(tmp_path, ttl_seconds=60.0):
+    return LeaseStore(str(tmp_path / "leases.db"), ttl_seconds=ttl_seconds)
+
+def test_one_holder_at_a_time(tmp_path):
+    first, second = make_store(tmp_path), make_store(tmp_path)
+    assert first.try_acquire("quiz:Variables")
+    assert not second.try_acquire("quiz:Variables")
+    assert second.try_acquire("quiz:Loops")
+    assert second.stats() == {"acquired": 1, "contended": 1}
+
+def test_released_lease_is_free(tmp_path):
+    first, second = make_store(tmp_path), make_store(tmp_path)
+    first.try_acquire("quiz:Variables")
+    first.release("quiz:Variables")
+    assert second.try_acquire("quiz:Variables")
+
+def test_only_the_holder_can_release(tmp_path):
+    first, second = make_store(tmp_path), make_store(tmp_path)
+    first.try_acquire("quiz:Variables")
+    second.release("quiz:Variables")
+    assert not second.try_acquire("quiz:Variables")
+
+def test_lease_of_a_crashed_holder_expires(tmp_path):
+    crashed = make_store(tmp_path, ttl_seconds=0.1)
+    survivor = make_store(tmp_path, ttl_seconds=0.1)
+    assert crashed.try_acquire("quiz:Variables")
+    assert not survivor.try_acquire("quiz:Variables")
+    time.sleep(0.15)
+    assert survivor.try_acquire("quiz:Variables")
+    # The expired holder can't take it back or release the new holder's lease
+    crashed.release("quiz:Variables")
+    assert not crashed.try_acquire("quiz:Variables")
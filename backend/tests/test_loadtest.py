@@ -0,0 +1,21 @@
+from bench.loadtest import QUIZ_VARIANTS, bench_query, build_request
+from semantic_cache import SemanticCache
+
+def test_quiz_requests_are_unique():
+    variants = {
+        tuple(build_request("quiz", index, repeat=False)["json"][field] for field in ("topic", "familiarity_level", "language"))
+        for index in range(QUIZ_VARIANTS)
+    }
+    assert len(variants) == QUIZ_VARIANTS
+
+def test_chat_and_quota_requests_are_unique():
+    chat_queries = [build_request("chat", index, repeat=False)["json"]["query"] for index in range(500)]
+    quota_keys = [build_request("check-quota", index, repeat=False)["json"]["api_key"] for index in range(500)]
+    assert len(set(chat_queries)) == 500
+    assert len(set(quota_keys)) == 500
+
+def test_chat_queries_miss_the_semantic_cache():
+    cache = SemanticCache(enabled=True)
+    for index in range(200):
+        cache.set("partition", bench_query(index), str(index))
+    assert all(cache.get("partition", bench_query(index)) is None for index in range(200, 400))
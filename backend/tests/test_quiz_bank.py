@@ -0,0 +1,33 @@
+import asyncio
+from contextlib import asynccontextmanager
+import pytest
+import llm_handler
+import quiz_bank
+from providers import FakeProvider
+
+API_KEY = "test-key-0123456789abcdef"
+TOPICS = ["Closures", "Decorators", "Generators"]
+
+@asynccontextmanager
+async def free_slot():
+    yield
+
+@pytest.fixture
+def slow_stream(monkeypatch):
+    monkeypatch.setattr(llm_handler, "provider", FakeProvider(latency=0, chunk_delay=0.005, blocking=False))
+
+def test_chapter_quiz_closed_early_still_banks_its_batches(run, slow_stream):
+    async def scenario():
+        pairs = quiz_bank.stream_chapter_quiz(TOPICS, "English", "Expert", 3, API_KEY, free_slot)
+        first_topic, _ = await pairs.__anext__()
+        # The client disconnects after its first question
+        await pairs.aclose()
+        for _ in range(200):
+            if all(quiz_bank.quiz_bank.count(topic, "Expert", "English") >= 3 for topic in TOPICS):
+                break
+            await asyncio.sleep(0.01)
+        return first_topic
+
+    assert run(scenario()) in TOPICS
+    for topic in TOPICS:
+        assert quiz_bank.quiz_bank.count(topic, "Expert", "English") >= 3
@@ -0,0 +1,77 @@
+import pytest
+from providers import FAKE_QUIZ_VARIANTS, fake_quiz_output
+from quiz_parser import BatchQuizParser, QuizStreamParser, parse_quiz
+
+TOPIC = "Variables"
+
+def feed_in_chunks(parser, text, size):
+    questions = []
+    for start in range(0, len(text), size):
+        questions.extend(parser.feed(text[start:start + size]))
+    parser.close()
+    return questions
+
+@pytest.mark.parametrize("size", [1, 7, 40, 10000])
+def test_questions_are_emitted_as_each_object_closes(size):
+    text = fake_quiz_output(TOPIC)
+    parser = QuizStreamParser(TOPIC)
+    emitted = []
+    for start in range(0, len(text), size):
+        emitted.append(len(parser.feed(text[start:start + size])))
+    parser.close()
+
+    assert sum(emitted) == 5
+    assert [question.question for question in parser.questions] == [f"Question {i} about {TOPIC}?" for i in range(1, 6)]
+    if size == 1:
+        # Every question arrives on its own chunk, before the array closes
+        assert emitted.count(1) == 5
+
+@pytest.mark.parametrize("variant, expected, dropped", [
+    ("valid", 5, 0),
+    ("fenced", 5, 0),
+    ("prose", 5, 0),
+    ("trailing_comma", 5, 0),
+    ("string_answer", 5, 0),
+    ("broken_item", 4, 1),
+    ("truncated", 4, 0)
+])
+def test_model_output_variants(variant, expected, dropped):
+    parser = QuizStreamParser(TOPIC)
+    questions = feed_in_chunks(parser, fake_quiz_output(TOPIC, variant), 13)
+    assert len(questions) == expected
+    assert parser.dropped == dropped
+    assert all(0 <= question.correct_answer < len(question.options) for question in questions)
+
+def test_question_cut_off_by_the_end_of_output_is_dropped():
+    text = fake_quiz_output(TOPIC)
+    cut = text.index("Question 3") + 20
+    parser = QuizStreamParser(TOPIC)
+    questions = feed_in_chunks(parser, text[:cut], 11)
+    assert len(questions) == 2
+    assert parser.dropped == 1
+
+def test_every_fake_variant_is_covered():
+    assert set(FAKE_QUIZ_VARIANTS) == {"valid", "fenced", "prose", "trailing_comma", "truncated", "string_answer", "broken_item"}
+
+def test_max_questions_stops_the_parser():
+    parser = QuizStreamParser(TOPIC, max_questions=2)
+    feed_in_chunks(parser, fake_quiz_output(TOPIC), 50)
+    assert len(parser.questions) == 2
+    assert parser.done
+
+def test_parse_quiz_matches_streaming():
+    text = fake_quiz_output(TOPIC, "prose")
+    assert parse_quiz(text, TOPIC) == feed_in_chunks(QuizStreamParser(TOPIC), text, 3)
+
+def test_batch_parser_routes_questions_by_topic():
+    topics = ["Variables", "Loops"]
+    text = fake_quiz_output(topics[0], count=3, batch_topics=topics + ["Unrequested"])
+    parser = BatchQuizParser(topics, per_topic=2)
+    tagged = []
+    for start in range(0, len(text), 17):
+        tagged.extend(parser.feed_tagged(text[start:start + 17]))
+    parser.close()
+
+    assert [topic for topic, _ in tagged] == ["Variables", "Variables", "Loops", "Loops"]
+    assert {topic: len(questions) for topic, questions in parser.by_topic.items()} == {"Variables": 2, "Loops": 2}
+    assert parser.dropped == 3
@@ -0,0 +1,106 @@
+import asyncio
+import time
+import pytest
+import llm_handler
+from providers import FakeProvider
+from resilience import resilience
+from router import ModelRouter
+
+API_KEY = "router-key-0123456789abcdef"
+
+class PerModelProvider(FakeProvider):
+    """
+    Blocking fake provider whose latency depends on the model.
+    """
+
+    def __init__(self, latencies):
+        super().__init__(latency=0, chunk_delay=0, blocking=True)
+        self.latencies = latencies
+
+    async def generate(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None, on_abandoned=None):
+        self.latency = self.latencies[model]
+        return await super().generate(api_key, model, prompt, generation_config, safety_settings, timeout, on_abandoned)
+
+    async def stream(self, api_key, model, prompt, generation_config=None, safety_settings=None, timeout=None):
+        self.latency = self.latencies[model]
+        async for chunk in super().stream(api_key, model, prompt, generation_config, safety_settings, timeout):
+            yield chunk
+
+def trained_router(latencies, samples=10):
+    router = ModelRouter("test", list(latencies))
+    for model, seconds in latencies.items():
+        for _ in range(samples):
+            router.observe(model, seconds, failed=False)
+    return router
+
+@pytest.fixture
+def fake_provider(monkeypatch):
+    def install(latencies):
+        provider = PerModelProvider(latencies)
+        monkeypatch.setattr(llm_handler, "provider", provider)
+        return provider
+    return install
+
+def test_unsampled_models_are_tried_first():
+    router = trained_router({"model-a": 0.1})
+    router.models.append("model-b")
+    assert router.choose() == "model-b"
+
+def test_lowest_expected_latency_wins():
+    router = trained_router({"model-a": 0.5, "model-b": 0.2, "model-c": 0.3})
+    assert router.choose() == "model-b"
+    assert router.choose(exclude=("model-b",)) == "model-c"
+
+def test_error_rate_raises_expected_latency():
+    router = trained_router({"model-a": 0.2, "model-b": 0.3})
+    for _ in range(10):
+        router.observe("model-a", failed=True)
+    assert router.choose() == "model-b"
+
+def test_models_with_an_open_breaker_are_skipped():
+    router = trained_router({"model-open": 0.1, "model-closed": 0.5})
+    breaker = resilience.breaker("model-open")
+    breaker.opened_at = time.monotonic()
+    try:
+        assert router.choose() == "model-closed"
+    finally:
+        breaker.record_success()
+
+def test_hedge_delay_is_the_p95():
+    router = ModelRouter("test", ["model-a"])
+    for seconds in range(1, 101):
+        router.observe("model-a", seconds / 100)
+    assert router.hedge_delay("model-a") == pytest.approx(0.96)
+
+def test_losing_hedge_is_charged_when_its_call_finishes(run, fake_provider):
+    fake_provider({"model-stalled": 0.4, "model-backup": 0.01})
+    # Historically fast, so it is chosen first and hedged after 20ms
+    router = trained_router({"model-stalled": 0.02, "model-backup": 0.05})
+    router.routed = 100
+    prompt = "Explain variables"
+
+    async def scenario():
+        response = await llm_handler.generate_upstream(API_KEY, "auto", prompt, router=router, hedge=True)
+        charged_at_return = llm_handler.usage_store.get(API_KEY)
+        # The stalled call keeps its pool thread until it finishes
+        await asyncio.sleep(0.6)
+        return response, charged_at_return
+
+    response, charged_at_return = run(scenario())
+    assert router.hedge_wins == 1
+    assert charged_at_return == 0
+    expected = llm_handler.count_tokens_in_text(prompt) + llm_handler.count_tokens_in_text(response.text)
+    assert llm_handler.usage_store.get(API_KEY) == expected
+    assert llm_handler.llm_abandoned_calls._values[("model-stalled",)] >= 1
+
+def test_streamed_calls_add_latency_samples(run, fake_provider):
+    fake_provider({"model-a": 0.01})
+    router = ModelRouter("test", ["model-a"])
+
+    async def scenario():
+        return [chunk.text async for chunk in llm_handler.stream_upstream(API_KEY, "model-a", "Explain loops", router=router)]
+
+    assert run(scenario())
+    stats = router.stats()["models"]["model-a"]
+    assert stats["samples"] == 1
+    assert stats["ewma_latency"] >= 0.01
@@ -0,0 +1,74 @@
+import pytest
+from semantic_cache import SemanticCache, embed_query, _stem
+
+PARTITION = "partition"
+
+# Same words, different question: none of these may share a response
+DIFFERENT_QUESTIONS = [
+    ("what is x = 5", "what is x == 5"),
+    ("explain a = b", "explain a != b"),
+    ("2**3", "3**2"),
+    ("int to float", "float to int"),
+    ("range(1, 10)", "range(10, 1)"),
+    ("convert string to int", "convert int to string")
+]
+
+PARAPHRASES = [
+    ("what is a variable", "explain variables please"),
+    ("what is a for loop", "explain for loops please"),
+    ("how do lists work?", "explain lists"),
+    ("what are dictionaries", "explain a dictionary"),
+    ("what is x == 5?", "explain x == 5")
+]
+
+@pytest.fixture
+def cache():
+    return SemanticCache(enabled=True)
+
+@pytest.mark.parametrize("cached, asked", DIFFERENT_QUESTIONS + [(b, a) for a, b in DIFFERENT_QUESTIONS])
+def test_different_questions_miss(cache, cached, asked):
+    cache.set(PARTITION, cached, "answer")
+    assert cache.get(PARTITION, asked) is None
+
+@pytest.mark.parametrize("cached, asked", PARAPHRASES)
+def test_paraphrases_hit(cache, cached, asked):
+    cache.set(PARTITION, cached, "answer")
+    assert cache.get(PARTITION, asked) == "answer"
+
+@pytest.mark.parametrize("cached, asked", [
+    ("int to float", "float to int"),
+    ("convert string to int", "convert int to string")
+])
+def test_word_order_alone_scores_below_the_threshold(cache, cached, asked):
+    # These have no numbers or operators, so only the ordered bigrams keep them apart
+    assert float(embed_query(cached) @ embed_query(asked)) < cache.threshold
+
+@pytest.mark.parametrize("word, inflected", [
+    ("variable", "variables"),
+    ("loop", "loops"),
+    ("loop", "looping"),
+    ("class", "classes"),
+    ("dictionary", "dictionaries"),
+    ("string", "strings"),
+    ("box", "boxes")
+])
+def test_stemmer_is_consistent(word, inflected):
+    assert _stem(word) == _stem(inflected)
+
+def test_partitions_are_separate(cache):
+    cache.set(PARTITION, "what is a variable", "answer")
+    assert cache.get("other", "what is a variable") is None
+
+def test_full_partition_replaces_least_recently_used():
+    cache = SemanticCache(enabled=True, max_per_partition=2)
+    cache.set(PARTITION, "lists", "lists answer")
+    cache.set(PARTITION, "tuples", "tuples answer")
+    assert cache.get(PARTITION, "lists") == "lists answer"
+    cache.set(PARTITION, "sets", "sets answer")
+    assert cache.get(PARTITION, "tuples") is None
+    assert cache.get(PARTITION, "lists") == "lists answer"
+
+def test_disabled_cache_never_hits():
+    cache = SemanticCache(enabled=False)
+    cache.set(PARTITION, "what is a variable", "answer")
+    assert cache.get(PARTITION, "what is a variable") is None
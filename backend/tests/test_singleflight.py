@@ -0,0 +1,86 @@
+import asyncio
+import pytest
+from google.api_core import exceptions as google_exceptions
+import llm_handler
+import quiz_bank
+from providers import FakeProvider
+from singleflight import flight_key
+
+GOOD_KEY = "good-key-0123456789abcdef"
+BAD_KEY = "bad-key-0123456789abcdef"
+
+class KeyCheckingProvider(FakeProvider):
+    """
+    Fails every call made with BAD_KEY, like Gemini with an invalid key.
+    """
+
+    def __init__(self):
+        super().__init__(latency=0.05, chunk_delay=0, blocking=False)
+        self.keys = []
+
+    def _check(self, api_key):
+        self.keys.append(api_key)
+        if api_key == BAD_KEY:
+            raise google_exceptions.InvalidArgument("API key not valid. Please pass a valid API key.")
+
+    async def generate(self, api_key, model, prompt, *args, **kwargs):
+        self._check(api_key)
+        return await super().generate(api_key, model, prompt, *args, **kwargs)
+
+    async def stream(self, api_key, model, prompt, *args, **kwargs):
+        self._check(api_key)
+        async for chunk in super().stream(api_key, model, prompt, *args, **kwargs):
+            yield chunk
+
+@pytest.fixture
+def key_checking_provider(monkeypatch):
+    provider = KeyCheckingProvider()
+    monkeypatch.setattr(llm_handler, "provider", provider)
+    return provider
+
+def chat(api_key, query):
+    return llm_handler.get_llm_response("Variables", "English", "gemini-2.0-flash", query, "Novice", "Informative", api_key)
+
+async def stream_chat(api_key, query):
+    chunks = llm_handler.stream_llm_response("Variables", "English", "gemini-2.0-flash", query, "Novice", "Informative", api_key)
+    return "".join([chunk async for chunk in chunks])
+
+def test_flight_keys_differ_by_api_key():
+    assert flight_key("quiz", GOOD_KEY, "Variables") != flight_key("quiz", BAD_KEY, "Variables")
+    assert GOOD_KEY not in flight_key("quiz", GOOD_KEY, "Variables")
+
+def test_chat_of_another_key_is_not_failed_by_an_invalid_key(run, key_checking_provider):
+    async def scenario():
+        return await asyncio.gather(chat(BAD_KEY, "what is shadowing"), chat(GOOD_KEY, "what is shadowing"))
+
+    failed, answered = run(scenario())
+    assert failed.startswith("Error")
+    assert not answered.startswith("Error")
+    assert sorted(key_checking_provider.keys) == sorted([BAD_KEY, GOOD_KEY])
+
+def test_streamed_chat_of_another_key_is_not_failed_by_an_invalid_key(run, key_checking_provider):
+    async def scenario():
+        return await asyncio.gather(stream_chat(BAD_KEY, "what is a closure"), stream_chat(GOOD_KEY, "what is a closure"))
+
+    failed, answered = run(scenario())
+    assert failed.startswith("Error")
+    assert not answered.startswith("Error")
+
+def test_same_key_still_shares_one_call(run, key_checking_provider):
+    async def scenario():
+        return await asyncio.gather(*(chat(GOOD_KEY, "what is a global") for _ in range(3)))
+
+    answers = run(scenario())
+    assert len(set(answers)) == 1
+    assert key_checking_provider.keys == [GOOD_KEY]
+
+def test_quiz_of_another_key_is_not_failed_by_an_invalid_key(run, key_checking_provider):
+    async def scenario():
+        return await asyncio.gather(
+            quiz_bank.get_quiz_questions("Recursion", "English", "Expert", BAD_KEY),
+            quiz_bank.get_quiz_questions("Recursion", "English", "Expert", GOOD_KEY)
+        )
+
+    failed, answered = run(scenario())
+    assert failed == []
+    assert len(answered) == 5
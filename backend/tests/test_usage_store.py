@@ -0,0 +1,108 @@
+import sys
+import threading
+import time
+from usage_store import MemoryUsageStore, SQLiteUsageStore
+
+class SlowWrites:
+    """
+    Wraps the store's connection so a flush pauses inside its write, leaving
+    time for a reader to look at the usage mid-flush.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self.writing = threading.Event()
+
+    def execute(self, sql, *args):
+        if sql.startswith("INSERT"):
+            self.writing.set()
+            time.sleep(0.2)
+        return self._db.execute(sql, *args)
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+def make_store(tmp_path, **kwargs):
+    return SQLiteUsageStore(str(tmp_path / "usage.db"), flush_interval=3600, **kwargs)
+
+def test_usage_survives_flush_and_reopen(tmp_path):
+    store = make_store(tmp_path)
+    store.add("key-a", 100)
+    store.add("key-a", 20)
+    store.add("key-b", 5)
+    assert store.get("key-a") == 120
+    store.close()
+
+    reopened = make_store(tmp_path)
+    assert reopened.get("key-a") == 120
+    assert reopened.get("key-b") == 5
+    reopened.close()
+
+def test_reader_never_sees_usage_missing_a_flushing_delta(tmp_path):
+    store = make_store(tmp_path, refresh_seconds=0)
+    added = [0]
+    undercounts = []
+    done = threading.Event()
+
+    def read():
+        while not done.is_set():
+            expected = added[0]
+            seen = store.get("key-a")
+            if seen < expected:
+                undercounts.append((seen, expected))
+
+    reader = threading.Thread(target=read)
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        reader.start()
+        for _ in range(300):
+            store.add("key-a", 1)
+            added[0] += 1
+            store.flush()
+    finally:
+        done.set()
+        reader.join()
+        sys.setswitchinterval(interval)
+
+    assert undercounts == []
+    assert store.get("key-a") == 300
+    store.close()
+
+def test_flush_picks_up_other_workers_usage(tmp_path):
+    first = make_store(tmp_path)
+    second = make_store(tmp_path)
+    first.add("key-a", 10)
+    second.add("key-a", 7)
+    first.flush()
+    second.flush()
+
+    assert second.get("key-a") == 17
+    first.close()
+    second.close()
+
+def test_adds_during_flush_stay_pending(tmp_path):
+    store = make_store(tmp_path)
+    store.add("key-a", 10)
+    store._db = slow = SlowWrites(store._db)
+    flusher = threading.Thread(target=store.flush)
+    flusher.start()
+    slow.writing.wait(5)
+    store.add("key-a", 3)
+    flusher.join()
+
+    assert store._pending == {next(iter(store._pending)): 3}
+    assert store.get("key-a") == 13
+    store._db = slow._db
+    store.close()
+    assert make_store(tmp_path).get("key-a") == 13
+
+def test_memory_store_reset():
+    store = MemoryUsageStore(max_keys=2)
+    store.add("key-a", 1)
+    store.add("key-b", 2)
+    store.add("key-c", 3)
+    assert store.get("key-a") == 0
+    store.reset("key-c")
+    assert store.get("key-c") == 0
+    assert store.get("key-b") == 2
@@ -0,0 +1,37 @@
+import threading
+from warmup import WarmupStore
+
+def test_concurrent_requests_survive_flushes():
+    store = WarmupStore(":memory:", flush_interval=60)
+    done = threading.Event()
+
+    def record():
+        for _ in range(5000):
+            store.record_request("Loops")
+
+    def flush():
+        while not done.is_set():
+            store.flush()
+
+    flusher = threading.Thread(target=flush)
+    flusher.start()
+    recorders = [threading.Thread(target=record) for _ in range(4)]
+    for thread in recorders:
+        thread.start()
+    for thread in recorders:
+        thread.join()
+    done.set()
+    flusher.join()
+
+    assert store.popularity() == {"Loops": 20000}
+    store.flush()
+    assert store.popularity() == {"Loops": 20000}
+    store.close()
+
+def test_failed_flush_keeps_pending_requests():
+    store = WarmupStore(":memory:", flush_interval=60)
+    store.record_request("Loops")
+    store._db.execute("DROP TABLE topic_popularity")
+    store.flush()
+    assert store._pending == {"Loops": 1}
+    store._stop.set()
@@ -0,0 +1,58 @@
+import math
+import re
+from functools import lru_cache
+from typing import Any, Optional
+
+# Split text into runs that tokenize similarly: whitespace, single digits,
+# Indic script runs (Devanagari through Malayalam, combining marks included),
+# other letter runs, and single punctuation/symbol characters.
+_PIECE_PATTERN = re.compile(r"(\s+)|(\d)|([\u0900-\u0DFF]+)|([^\W\d_]+)|(.)", re.DOTALL)
+
+# Approximate characters per token for each kind of run. Indic scripts pack
+# far fewer characters into a token than English, which is where
+# len(text) // 4 was most wrong.
+_CHARS_PER_TOKEN_WORD = 4
+_CHARS_PER_TOKEN_INDIC = 2
+
+def count_tokens(text: str) -> int:
+    """
+    Count tokens locally, without a round trip to the provider.
+
+    Digits and punctuation are one token each (this is what makes code
+    expensive), indentation and newlines cost a token per run, and letter
+    runs are charged by script.
+    """
+    if not text:
+        return 0
+    tokens = 0
+    for whitespace, digit, indic, word, other in _PIECE_PATTERN.findall(text):
+        if whitespace:
+            # A single space is absorbed into the following word
+            if len(whitespace) > 1 or "\n" in whitespace:
+                tokens += 1
+        elif indic:
+            tokens += math.ceil(len(indic) / _CHARS_PER_TOKEN_INDIC)
+        elif word:
+            tokens += math.ceil(len(word) / _CHARS_PER_TOKEN_WORD)
+        else:
+            tokens += 1
+    return tokens
+
+@lru_cache(maxsize=64)
+def count_static_tokens(text: str) -> int:
+    """
+    Memoized count_tokens for prompts that never change, like system messages.
+    """
+    return count_tokens(text)
+
+def count_prompt_tokens(system_prompt: str, user_prompt: str) -> int:
+    return count_static_tokens(system_prompt) + count_tokens(user_prompt)
+
+def usage_from_response(response: Any) -> Optional[int]:
+    """
+    Total tokens reported by the provider, if the response carries usage
+    metadata. For streams this is the last chunk, which holds the totals.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", 0) if usage is not None else 0
+    return total or None
@@ -0,0 +1,232 @@
+import gzip
+import json
+import logging
+import os
+import random
+import secrets
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+from usage_store import usage_key
+from config import (
+    SERVER_WORKERS,
+    TRACE_RECORD_PATH,
+    TRACE_SAMPLE_RATE,
+    TRACE_FLUSH_SECONDS,
+    TRACE_MAX_BODY_BYTES
+)
+
+# Id of the recorded request being handled, so upstream calls made on its
+# behalf (including from single-flight tasks it started) can refer to it
+current_trace_id: ContextVar[Optional[str]] = ContextVar("current_trace_id", default=None)
+
+# Request fields that identify a learner; only their hashes are recorded
+_HASHED_FIELDS = ("api_key", "session_id")
+
+def anonymize(body: Any) -> Any:
+    if not isinstance(body, dict):
+        return body
+    return {
+        name: usage_key(value) if name in _HASHED_FIELDS and isinstance(value, str) and value else value
+        for name, value in body.items()
+    }
+
+def read_trace(path: str) -> List[Dict[str, Any]]:
+    """
+    All records of one trace file, in the order they were written.
+    """
+    records = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                records.append(json.loads(line))
+    return records
+
+class TraceRecorder:
+    """
+    Appends request and upstream-call records to a gzip-compressed JSONL file.
+
+    Records are buffered in memory and written by a background thread every
+    flush_seconds, each flush as its own gzip member, so the file stays
+    readable while the server runs and a crash loses at most one interval.
+
+    Request records: {"type": "request", "id", "ts" (arrival, epoch seconds),
+    "method", "endpoint", "query_string", "body", "status", "first_byte_seconds",
+    "seconds"}. Upstream records: {"type": "upstream", "id" (of the request,
+    or null for background work), "ts", "model", "kind" ("generate" or
+    "stream"), "first_chunk_seconds", "seconds", "chars", "outcome"}.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = TRACE_SAMPLE_RATE,
+        flush_seconds: float = TRACE_FLUSH_SECONDS,
+        max_body_bytes: int = TRACE_MAX_BODY_BYTES
+    ):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.flush_seconds = flush_seconds
+        self.max_body_bytes = max_body_bytes
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.requests = 0
+        self.upstream_calls = 0
+        self.dropped = 0
+        self._writer = threading.Thread(target=self._flush_loop, name="trace-writer", daemon=True)
+        self._writer.start()
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1.0 or random.random() < self.sample_rate
+
+    def new_id(self) -> str:
+        return secrets.token_hex(8)
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(",", ":"))
+        with self._lock:
+            self._buffer.append(line)
+
+    def record_request(
+        self,
+        trace_id: str,
+        arrived_at: float,
+        method: str,
+        endpoint: str,
+        query_string: str,
+        raw_body: bytes,
+        status: int,
+        first_byte_seconds: Optional[float],
+        seconds: float
+    ) -> None:
+        body = None
+        if raw_body and len(raw_body) <= self.max_body_bytes:
+            try:
+                body = anonymize(json.loads(raw_body))
+            except ValueError:
+                body = None
+        self.requests += 1
+        self._append({
+            "type": "request",
+            "id": trace_id,
+            "ts": round(arrived_at, 6),
+            "method": method,
+            "endpoint": endpoint,
+            "query_string": query_string,
+            "body": body,
+            "status": status,
+            "first_byte_seconds": round(first_byte_seconds, 6) if first_byte_seconds is not None else None,
+            "seconds": round(seconds, 6)
+        })
+
+    def record_upstream(
+        self,
+        started_at: float,
+        model: str,
+        kind: str,
+        first_chunk_seconds: Optional[float],
+        seconds: float,
+        chars: int,
+        outcome: str
+    ) -> None:
+        self.upstream_calls += 1
+        self._append({
+            "type": "upstream",
+            "id": current_trace_id.get(),
+            "ts": round(started_at, 6),
+            "model": model,
+            "kind": kind,
+            "first_chunk_seconds": round(first_chunk_seconds, 6) if first_chunk_seconds is not None else None,
+            "seconds": round(seconds, 6),
+            "chars": chars,
+            "outcome": outcome
+        })
+
+    def flush(self) -> None:
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if not lines:
+            return
+        try:
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            logging.error(f"Failed to write trace records to {self.path}: {str(e)}")
+            self.dropped += len(lines)
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._writer.join(timeout=self.flush_seconds + 1)
+        self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "requests": self.requests,
+            "upstream_calls": self.upstream_calls,
+            "dropped": self.dropped
+        }
+
+class TraceRecordingMiddleware:
+    """
+    Records every sampled /api HTTP request with its timing. The request body
+    is captured as the app reads it, so nothing is read twice.
+    """
+
+    def __init__(self, app, recorder: TraceRecorder):
+        self.app = app
+        self.recorder = recorder
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/api/") or not self.recorder.sampled():
+            await self.app(scope, receive, send)
+            return
+
+        trace_id = self.recorder.new_id()
+        token = current_trace_id.set(trace_id)
+        arrived_at = time.time()
+        started = time.perf_counter()
+        body = bytearray()
+        status = [500]
+        first_byte: List[float] = []
+
+        async def receive_and_capture():
+            message = await receive()
+            if message["type"] == "http.request" and len(body) <= self.recorder.max_body_bytes:
+                body.extend(message.get("body", b""))
+            return message
+
+        async def send_and_time(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            elif message["type"] == "http.response.body" and not first_byte and message.get("body"):
+                first_byte.append(time.perf_counter() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_capture, send_and_time)
+        finally:
+            current_trace_id.reset(token)
+            self.recorder.record_request(
+                trace_id,
+                arrived_at,
+                scope["method"],
+                scope["path"],
+                scope.get("query_string", b"").decode("latin-1"),
+                bytes(body),
+                status[0],
+                first_byte[0] if first_byte else None,
+                time.perf_counter() - started
+            )
+
+def _trace_path(path: str) -> str:
+    # Worker processes can't share one gzip stream
+    return path if SERVER_WORKERS == 1 else f"{path}.{os.getpid()}"
+
+trace_recorder: Optional[TraceRecorder] = TraceRecorder(_trace_path(TRACE_RECORD_PATH)) if TRACE_RECORD_PATH else None
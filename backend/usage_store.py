@@ -0,0 +1,247 @@
+import calendar
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from config import USAGE_STORE, USAGE_DB_PATH, USAGE_FLUSH_INTERVAL_SECONDS, USAGE_MAX_KEYS, SHARED_STATE, SHARED_STATE_REFRESH_SECONDS
+
+def usage_key(api_key: str) -> str:
+    """
+    Stores never keep raw API keys, only a hash of them.
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:32]
+
+def current_period() -> str:
+    """
+    Usage is accounted per calendar month (UTC), e.g. "2024-05".
+    """
+    return time.strftime("%Y-%m", time.gmtime())
+
+def seconds_until_next_period() -> int:
+    now = time.gmtime()
+    year, month = (now.tm_year + 1, 1) if now.tm_mon == 12 else (now.tm_year, now.tm_mon + 1)
+    next_period = calendar.timegm((year, month, 1, 0, 0, 0, 0, 0, 0))
+    return max(1, int(next_period - time.time()))
+
+class UsageStore(ABC):
+    """
+    Token usage per API key for the current billing period.
+    """
+
+    @abstractmethod
+    def add(self, api_key: str, tokens: int) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, api_key: str) -> int:
+        ...
+
+    @abstractmethod
+    def reset(self, api_key: Optional[str] = None) -> None:
+        """
+        Zero the current period for one key, or for every key.
+        """
+
+    def close(self) -> None:
+        pass
+
+class MemoryUsageStore(UsageStore):
+    """
+    Process-local usage counters, bounded to max_keys in LRU order.
+    """
+
+    def __init__(self, max_keys: int = USAGE_MAX_KEYS):
+        self.max_keys = max_keys
+        self._usage: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, api_key: str, tokens: int) -> None:
+        key = (current_period(), usage_key(api_key))
+        with self._lock:
+            self._usage[key] = self._usage.get(key, 0) + tokens
+            self._usage.move_to_end(key)
+            while len(self._usage) > self.max_keys:
+                self._usage.popitem(last=False)
+
+    def get(self, api_key: str) -> int:
+        return self._usage.get((current_period(), usage_key(api_key)), 0)
+
+    def reset(self, api_key: Optional[str] = None) -> None:
+        with self._lock:
+            if api_key is None:
+                self._usage.clear()
+            else:
+                self._usage.pop((current_period(), usage_key(api_key)), None)
+
+class SQLiteUsageStore(UsageStore):
+    """
+    Durable usage counters in a SQLite database in WAL mode.
+
+    add() only touches memory: deltas are collected and written by a
+    background thread in one transaction every flush_interval seconds, so
+    accounting never waits on an fsync. A flush reads each key's new total
+    back in the same transaction as its increment. Totals read from the database are
+    kept in a bounded LRU, so get() is a dictionary lookup for active keys.
+
+    When several worker processes share the file, deltas are still added
+    with an upsert so no process overwrites another's, and a cached total
+    is re-read after refresh_seconds to pick up the other workers' usage.
+    """
+
+    def __init__(
+        self,
+        path: str = USAGE_DB_PATH,
+        flush_interval: float = USAGE_FLUSH_INTERVAL_SECONDS,
+        max_keys: int = USAGE_MAX_KEYS,
+        refresh_seconds: Optional[float] = SHARED_STATE_REFRESH_SECONDS if SHARED_STATE else None
+    ):
+        self.flush_interval = flush_interval
+        self.max_keys = max_keys
+        self.refresh_seconds = refresh_seconds
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS token_usage (
+                period TEXT NOT NULL,
+                key_hash TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (period, key_hash)
+            )
+        """)
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._totals: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._loaded_at: Dict[Tuple[str, str], float] = {}
+        self._pending: Dict[Tuple[str, str], int] = {}
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="usage-flush", daemon=True)
+        self._flusher.start()
+
+    def add(self, api_key: str, tokens: int) -> None:
+        key = (current_period(), usage_key(api_key))
+        self._load(key)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + tokens
+            total = self._totals.get(key)
+            if total is not None:
+                self._remember(key, total + tokens)
+
+    def get(self, api_key: str) -> int:
+        return self._load((current_period(), usage_key(api_key)))
+
+    def reset(self, api_key: Optional[str] = None) -> None:
+        period = current_period()
+        with self._db_lock, self._lock:
+            if api_key is None:
+                self._db.execute("DELETE FROM token_usage WHERE period = ?", (period,))
+                self._totals.clear()
+                self._loaded_at.clear()
+                self._pending.clear()
+            else:
+                key = (period, usage_key(api_key))
+                self._db.execute("DELETE FROM token_usage WHERE period = ? AND key_hash = ?", key)
+                self._totals.pop(key, None)
+                self._pending.pop(key, None)
+            self._db.commit()
+
+    def prune(self, keep_period: Optional[str] = None) -> None:
+        """
+        Delete rows from periods before keep_period (default: the current one).
+        """
+        with self._db_lock:
+            self._db.execute("DELETE FROM token_usage WHERE period < ?", (keep_period or current_period(),))
+            self._db.commit()
+
+    def _load(self, key: Tuple[str, str]) -> int:
+        total = self._totals.get(key)
+        if total is not None and not self._stale(key):
+            return total
+        # The row and the pending deltas are read under the database lock, so
+        # a flush can't move deltas from one to the other in between
+        with self._db_lock:
+            row = self._db.execute(
+                "SELECT tokens FROM token_usage WHERE period = ? AND key_hash = ?", key
+            ).fetchone()
+            with self._lock:
+                total = (row[0] if row else 0) + self._pending.get(key, 0)
+                self._remember(key, total)
+                if self.refresh_seconds is not None:
+                    self._loaded_at[key] = time.monotonic()
+        return total
+
+    def _stale(self, key: Tuple[str, str]) -> bool:
+        if self.refresh_seconds is None:
+            return False
+        return time.monotonic() - self._loaded_at.get(key, 0.0) >= self.refresh_seconds
+
+    def _remember(self, key: Tuple[str, str], total: int) -> None:
+        self._totals[key] = total
+        self._totals.move_to_end(key)
+        while len(self._totals) > self.max_keys:
+            evicted, _ = self._totals.popitem(last=False)
+            self._loaded_at.pop(evicted, None)
+
+    def flush(self) -> None:
+        """
+        Write the pending deltas. Each key is incremented and its new total
+        read back in the same transaction, and the deltas only leave
+        _pending once that transaction has committed, so no reader ever sees
+        a total missing them. The totals read back also include the other
+        workers' usage.
+        """
+        with self._db_lock:
+            with self._lock:
+                pending = dict(self._pending)
+            if not pending:
+                return
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                totals = {
+                    key: self._db.execute(
+                        "INSERT INTO token_usage (period, key_hash, tokens) VALUES (?, ?, ?) "
+                        "ON CONFLICT (period, key_hash) DO UPDATE SET tokens = tokens + excluded.tokens "
+                        "RETURNING tokens",
+                        (*key, tokens)
+                    ).fetchone()[0]
+                    for key, tokens in pending.items()
+                }
+                self._db.commit()
+            except sqlite3.Error as e:
+                # The deltas stay pending, so the next flush retries them
+                logging.error(f"Failed to flush token usage: {str(e)}")
+                self._db.rollback()
+                return
+            now = time.monotonic()
+            with self._lock:
+                for key, tokens in pending.items():
+                    remaining = self._pending.pop(key, 0) - tokens
+                    if remaining:
+                        self._pending[key] = remaining
+                    self._remember(key, totals[key] + remaining)
+                    if self.refresh_seconds is not None:
+                        self._loaded_at[key] = now
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._flusher.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+def create_usage_store(kind: str = USAGE_STORE) -> UsageStore:
+    if kind == "sqlite":
+        return SQLiteUsageStore()
+    if SHARED_STATE:
+        logging.warning(f"USAGE_STORE '{kind}' can't be shared between workers, using sqlite")
+        return SQLiteUsageStore()
+    if kind != "memory":
+        logging.warning(f"Unknown USAGE_STORE '{kind}', using in-memory usage accounting")
+    return MemoryUsageStore()
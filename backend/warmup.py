@@ -0,0 +1,343 @@
+"""
+Cache warm-up across the topic catalog.
+
+Pre-generates the default explanation and a quiz for each topic, so the
+first learners after a deploy don't pay full upstream latency. Runs as a
+background task after startup (WARMUP_ON_STARTUP) or from the command line:
+
+    python warmup.py --budget 500000 --concurrency 4 --languages English Hindi
+
+Pass --plan to print what would be generated without calling the model.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+from catalog import catalog_payload
+from leases import flight_leases
+from response_cache import response_cache, make_cache_key
+from token_counter import count_tokens
+from llm_handler import build_chat_prompt, count_quiz_prompt_tokens, get_llm_response
+from quiz_bank import quiz_bank, get_quiz_questions
+from config import (
+    GEMINI_API_KEY,
+    AVAILABLE_TOPICS,
+    FAMILIARITY_LEVELS,
+    CONVERSATION_MODES,
+    QUIZ_QUESTION_COUNT,
+    RESPONSE_CACHE_PATH,
+    WARMUP_LANGUAGES,
+    WARMUP_MODEL,
+    WARMUP_CONCURRENCY,
+    WARMUP_TOKEN_BUDGET,
+    WARMUP_DB_PATH,
+    WARMUP_POPULARITY_FLUSH_SECONDS
+)
+
+class WarmupItem(NamedTuple):
+    kind: str  # "explanation" or "quiz"
+    topic: str
+    language: str
+    familiarity_level: str
+    conversation_mode: str = ""
+
+    @property
+    def key(self) -> str:
+        return json.dumps(list(self), ensure_ascii=False)
+
+class WarmupStore:
+    """
+    Warm-up progress and topic popularity in SQLite.
+
+    Progress is kept per run, one run per UTC day and catalog version, so an
+    interrupted warm-up resumes where it stopped and its token budget holds
+    across restarts. Topic requests are counted in memory and added to the
+    database by a background thread, like token usage.
+    """
+
+    def __init__(self, path: str = WARMUP_DB_PATH, flush_interval: float = WARMUP_POPULARITY_FLUSH_SECONDS):
+        self.flush_interval = flush_interval
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS warmup_progress (
+                run_id TEXT NOT NULL,
+                item TEXT NOT NULL,
+                status TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                PRIMARY KEY (run_id, item)
+            )
+        """)
+        self._db.execute("CREATE TABLE IF NOT EXISTS topic_popularity (topic TEXT PRIMARY KEY, requests INTEGER NOT NULL)")
+        self._db.commit()
+        self._db_lock = threading.Lock()
+        # Guards _pending, which the request handlers add to while the flush thread drains it
+        self._lock = threading.Lock()
+        self._pending: Counter = Counter()
+        self._stop = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="popularity-flush", daemon=True)
+        self._flusher.start()
+
+    def record_request(self, topic: str) -> None:
+        with self._lock:
+            self._pending[topic] += 1
+
+    def popularity(self) -> Dict[str, int]:
+        # Rows and pending counts are read under the database lock, so a flush
+        # can't move counts from one to the other in between
+        with self._db_lock:
+            rows = self._db.execute("SELECT topic, requests FROM topic_popularity").fetchall()
+            with self._lock:
+                pending = Counter(self._pending)
+        counts = Counter(dict(rows))
+        counts.update(pending)
+        return dict(counts)
+
+    def spent(self, run_id: str) -> int:
+        with self._db_lock:
+            row = self._db.execute("SELECT COALESCE(SUM(tokens), 0) FROM warmup_progress WHERE run_id = ?", (run_id,)).fetchone()
+        return row[0]
+
+    def failed(self, run_id: str) -> Set[str]:
+        with self._db_lock:
+            rows = self._db.execute("SELECT item FROM warmup_progress WHERE run_id = ? AND status = 'failed'", (run_id,)).fetchall()
+        return {row[0] for row in rows}
+
+    def mark(self, run_id: str, item: WarmupItem, status: str, tokens: int) -> None:
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO warmup_progress (run_id, item, status, tokens) VALUES (?, ?, ?, ?)",
+                (run_id, item.key, status, tokens)
+            )
+            self._db.execute("DELETE FROM warmup_progress WHERE run_id < ?", (run_id[:10],))
+            self._db.commit()
+
+    def flush(self) -> None:
+        """
+        Add the pending counts to the database. They only leave _pending once
+        the write has committed, so a failed flush keeps them for the next one.
+        """
+        with self._db_lock:
+            with self._lock:
+                pending = Counter(self._pending)
+            if not pending:
+                return
+            try:
+                self._db.executemany(
+                    "INSERT INTO topic_popularity (topic, requests) VALUES (?, ?) "
+                    "ON CONFLICT (topic) DO UPDATE SET requests = requests + excluded.requests",
+                    list(pending.items())
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                self._db.rollback()
+                logging.error(f"Failed to flush topic popularity: {str(e)}")
+                return
+            with self._lock:
+                self._pending.subtract(pending)
+                self._pending = +self._pending
+
+    def _flush_loop(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._flusher.join(timeout=self.flush_interval + 1)
+        self.flush()
+
+def plan_warmup(popularity: Dict[str, int], languages: List[str] = WARMUP_LANGUAGES) -> List[WarmupItem]:
+    """
+    Every default explanation and quiz, most requested topics first and
+    otherwise in catalog order.
+    """
+    order = {topic: index for index, topic in enumerate(AVAILABLE_TOPICS)}
+    topics = sorted(order, key=lambda topic: (-popularity.get(topic, 0), order[topic]))
+
+    items = []
+    for topic in topics:
+        for language in languages:
+            for familiarity_level in FAMILIARITY_LEVELS:
+                items.append(WarmupItem("quiz", topic, language, familiarity_level))
+                for conversation_mode in CONVERSATION_MODES:
+                    items.append(WarmupItem("explanation", topic, language, familiarity_level, conversation_mode))
+    return items
+
+class WarmupRunner:
+    """
+    Work through the warm-up plan with at most `concurrency` generations at
+    a time, skipping whatever is already cached, until the plan is done or
+    the day's token budget is spent. Items that failed earlier in the run
+    are not retried until the next one.
+    """
+
+    def __init__(
+        self,
+        store: WarmupStore,
+        api_key: Optional[str] = GEMINI_API_KEY,
+        model: str = WARMUP_MODEL,
+        languages: List[str] = WARMUP_LANGUAGES,
+        concurrency: int = WARMUP_CONCURRENCY,
+        token_budget: int = WARMUP_TOKEN_BUDGET
+    ):
+        self.store = store
+        self.api_key = api_key
+        self.model = model
+        self.languages = languages
+        self.concurrency = concurrency
+        self.token_budget = token_budget
+        self.run_id = ""
+        self.planned = 0
+        self.generated = 0
+        self.cached = 0
+        self.failed = 0
+        self.tokens = 0
+        self.state = "idle"
+        self._task: Optional[asyncio.Task] = None
+
+    def _explanation_key(self, item: WarmupItem) -> str:
+        return make_cache_key(item.topic, item.familiarity_level, item.conversation_mode, item.language, self.model, "")
+
+    def _is_cached(self, item: WarmupItem) -> bool:
+        if item.kind == "quiz":
+            return quiz_bank.count(item.topic, item.familiarity_level, item.language) >= QUIZ_QUESTION_COUNT
+        return response_cache.peek(self._explanation_key(item)) is not None
+
+    async def _generate(self, item: WarmupItem) -> None:
+        if item.kind == "quiz":
+            questions = await get_quiz_questions(item.topic, item.language, item.familiarity_level, self.api_key)
+            output = json.dumps([question.model_dump() for question in questions])
+            tokens = count_quiz_prompt_tokens(item.topic, item.language, item.familiarity_level) + count_tokens(output)
+        else:
+            # The same call, and so the same cache entry, as a learner opening the topic
+            response = await get_llm_response(
+                item.topic, item.language, self.model, "", item.familiarity_level, item.conversation_mode, api_key=self.api_key
+            )
+            tokens = build_chat_prompt(item.topic, item.language, "", item.familiarity_level, item.conversation_mode)[1] + count_tokens(response)
+
+        self.tokens += tokens
+        if self._is_cached(item):
+            self.generated += 1
+            self.store.mark(self.run_id, item, "done", tokens)
+        else:
+            self.failed += 1
+            self.store.mark(self.run_id, item, "failed", tokens)
+
+    async def _work(self, queue: "asyncio.Queue[WarmupItem]") -> None:
+        while not queue.empty():
+            if self.store.spent(self.run_id) >= self.token_budget:
+                self.state = "budget_exhausted"
+                return
+            item = queue.get_nowait()
+            if self._is_cached(item):
+                self.cached += 1
+                continue
+            # With several server workers, each item is generated by only one of them
+            lease = "warmup:" + item.key
+            if flight_leases is not None and not flight_leases.try_acquire(lease):
+                continue
+            try:
+                await self._generate(item)
+            except Exception as e:
+                logging.error(f"Warm-up failed for {item}: {str(e)}")
+                self.failed += 1
+                self.store.mark(self.run_id, item, "failed", 0)
+            finally:
+                if flight_leases is not None:
+                    flight_leases.release(lease)
+
+    async def run(self) -> Dict[str, Any]:
+        self.run_id = f"{time.strftime('%Y-%m-%d', time.gmtime())}:{catalog_payload.etag}:{self.model}"
+        failed = self.store.failed(self.run_id)
+        plan = [item for item in plan_warmup(self.store.popularity(), self.languages) if item.key not in failed]
+        self.planned = len(plan)
+        self.state = "running"
+        started = time.monotonic()
+        logging.info(f"Warm-up started: {self.planned} items, {self.token_budget - self.store.spent(self.run_id)} tokens left today")
+
+        queue: "asyncio.Queue[WarmupItem]" = asyncio.Queue()
+        for item in plan:
+            queue.put_nowait(item)
+        await asyncio.gather(*(self._work(queue) for _ in range(self.concurrency)))
+        if self.state == "running":
+            self.state = "done"
+
+        logging.info(f"Warm-up {self.state} in {time.monotonic() - started:.0f}s: {self.stats()}")
+        return self.stats()
+
+    async def _run_logged(self) -> None:
+        try:
+            await self.run()
+        except Exception as e:
+            self.state = "failed"
+            logging.error(f"Warm-up failed: {str(e)}")
+
+    def start(self) -> None:
+        """
+        Start the warm-up in the background; the server is ready meanwhile.
+        """
+        if not self.api_key:
+            logging.info("GEMINI_API_KEY not set; warm-up disabled")
+            return
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run_logged())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "planned": self.planned,
+            "generated": self.generated,
+            "already_cached": self.cached,
+            "failed": self.failed,
+            "tokens": self.tokens
+        }
+
+warmup_store = WarmupStore()
+warmup_runner = WarmupRunner(warmup_store)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Pre-generate default explanations and quizzes for the topic catalog")
+    parser.add_argument("--budget", type=int, default=WARMUP_TOKEN_BUDGET, help="tokens to spend per UTC day")
+    parser.add_argument("--concurrency", type=int, default=WARMUP_CONCURRENCY)
+    parser.add_argument("--languages", nargs="+", default=WARMUP_LANGUAGES)
+    parser.add_argument("--model", default=WARMUP_MODEL)
+    parser.add_argument("--plan", action="store_true", help="print the plan and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.plan:
+        plan = plan_warmup(warmup_store.popularity(), args.languages)
+        print(json.dumps({
+            "items": len(plan),
+            "explanations": sum(1 for item in plan if item.kind == "explanation"),
+            "quizzes": sum(1 for item in plan if item.kind == "quiz"),
+            "first_topics": list(dict.fromkeys(item.topic for item in plan))[:10]
+        }, indent=2))
+        return
+    if not GEMINI_API_KEY:
+        parser.error("GEMINI_API_KEY must be set to warm up the caches")
+    if not RESPONSE_CACHE_PATH:
+        logging.warning("RESPONSE_CACHE_PATH is not set; explanations generated now are lost when this command exits")
+
+    runner = WarmupRunner(warmup_store, model=args.model, languages=args.languages, concurrency=args.concurrency, token_budget=args.budget)
+    try:
+        print(json.dumps(asyncio.run(runner.run()), indent=2))
+    finally:
+        warmup_store.close()
+
+if __name__ == "__main__":
+    main()
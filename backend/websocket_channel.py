@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+from fastapi import WebSocket, WebSocketDisconnect
+from pydantic import ValidationError
+from admission import AdmissionRejected
+from config import WS_MAX_CONCURRENT_REQUESTS, WS_SEND_QUEUE_SIZE, WS_MAX_MESSAGE_BYTES
+
+# Turns one client message into the events sent back for it
+Handler = Callable[[Dict[str, Any]], AsyncIterator[Dict[str, Any]]]
+
+class TutorChannel:
+    """
+    One WebSocket connection carrying many concurrent requests.
+
+    Every client message is a JSON object with an "id" chosen by the client
+    and a "type" naming its handler; every event sent back carries the id of
+    the request it belongs to. {"id": ..., "type": "cancel"} stops a request
+    in progress; its upstream generation is cancelled too, unless another
+    request is sharing it through single-flight.
+
+    Backpressure is per connection: at most max_concurrent requests run at
+    once, and events go through a bounded queue, so a client that reads
+    slowly holds up its own generations rather than buffering without limit.
+    """
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        handlers: Dict[str, Handler],
+        max_concurrent: int = WS_MAX_CONCURRENT_REQUESTS,
+        send_queue_size: int = WS_SEND_QUEUE_SIZE,
+        max_message_bytes: int = WS_MAX_MESSAGE_BYTES
+    ):
+        self.websocket = websocket
+        self.handlers = handlers
+        self.max_concurrent = max_concurrent
+        self.max_message_bytes = max_message_bytes
+        self._outgoing: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=send_queue_size)
+        self._requests: Dict[Any, asyncio.Task] = {}
+
+    async def _send_loop(self) -> None:
+        while True:
+            event = await self._outgoing.get()
+            await self.websocket.send_text(json.dumps(event))
+
+    async def _send(self, request_id: Any, event: Dict[str, Any]) -> None:
+        await self._outgoing.put({"id": request_id, **event})
+
+    async def _error(self, request_id: Any, error: str, retry_after: Optional[int] = None) -> None:
+        event = {"type": "error", "error": error}
+        if retry_after is not None:
+            event["retry_after"] = retry_after
+        await self._send(request_id, event)
+
+    async def _run(self, request_id: Any, handler: Handler, message: Dict[str, Any]) -> None:
+        try:
+            async for event in handler(message):
+                await self._send(request_id, event)
+        except AdmissionRejected as e:
+            await self._error(request_id, e.reason, e.retry_after)
+        except ValidationError as e:
+            await self._error(request_id, f"Invalid request: {e.errors()[0]['msg']}")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Error while handling WebSocket request {request_id}: {str(e)}")
+            await self._error(request_id, f"An error occurred: {str(e)}")
+        finally:
+            self._requests.pop(request_id, None)
+
+    async def _dispatch(self, raw: str) -> None:
+        if len(raw) > self.max_message_bytes:
+            await self._error(None, "Message too large.")
+            return
+        try:
+            message = json.loads(raw)
+        except json.JSONDecodeError:
+            await self._error(None, "Messages must be JSON objects.")
+            return
+        if not isinstance(message, dict) or not isinstance(message.get("id"), (str, int)):
+            await self._error(None, "Every message needs an \"id\" (string or number).")
+            return
+
+        request_id = message["id"]
+        kind = message.get("type")
+        if kind == "cancel":
+            task = self._requests.pop(request_id, None)
+            if task is not None:
+                task.cancel()
+            # Nothing more is sent for this id after the acknowledgement
+            await self._send(request_id, {"type": "cancelled"})
+            return
+        handler = self.handlers.get(kind)
+        if handler is None:
+            await self._error(request_id, f"Unknown message type: {kind!r}.")
+            return
+        if request_id in self._requests:
+            await self._error(request_id, "A request with this id is already in progress.")
+            return
+        if len(self._requests) >= self.max_concurrent:
+            await self._error(request_id, "Too many requests in progress on this connection.", 1)
+            return
+        self._requests[request_id] = asyncio.create_task(self._run(request_id, handler, message))
+
+    async def serve(self) -> None:
+        """
+        Handle messages until the client disconnects, then cancel whatever
+        is still in progress.
+        """
+        await self.websocket.accept()
+        sender = asyncio.create_task(self._send_loop())
+        try:
+            while True:
+                receive = asyncio.create_task(self.websocket.receive_text())
+                # A failed send means the client is gone too
+                done, _ = await asyncio.wait({receive, sender}, return_when=asyncio.FIRST_COMPLETED)
+                if sender in done:
+                    receive.cancel()
+                    return
+                await self._dispatch(receive.result())
+        except WebSocketDisconnect:
+            pass
+        finally:
+            tasks = [*self._requests.values(), sender]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
@@ -4,7 +4,7 @@ import Sidebar from './components/Sidebar';
 import MessageBox from './components/MessageBox';
 import Chatbot from './components/Chatbot';
 import Quiz from './components/Quiz';
-import { getConfig, sendStreamingChatRequest, getQuiz, API_BASE_URL } from './api/backend';
+import { getConfig, sendSocketChatRequest, streamSocketQuiz, API_BASE_URL } from './api/backend';
 import QuizIcon from '@mui/icons-material/Quiz';
 
 function App() {
@@ -37,6 +37,8 @@ function App() {
     const [currentStreamingMessage, setCurrentStreamingMessage] = useState('');
     const [responseTime, setResponseTime] = useState(null);
     const [apiKey, setApiKey] = useState(localStorage.getItem('geminiApiKey') || '');
+    // The backend keeps the conversation history for this id
+    const [sessionId, setSessionId] = useState(() => crypto.randomUUID());
 
     useEffect(() => {
         const fetchConfig = async () => {
@@ -75,6 +77,11 @@ function App() {
         setSidebarOpen(!isMobile);
     }, [isMobile]);
 
+    // A new topic starts a new conversation
+    useEffect(() => {
+        setSessionId(crypto.randomUUID());
+    }, [selectedTopic]);
+
     // Save API key to localStorage when it changes
     useEffect(() => {
         if (apiKey) {
@@ -103,7 +110,7 @@ function App() {
                 throw new Error("Please enter your Google Gemini API key in the settings panel.");
             }
 
-            const fullResponse = await sendStreamingChatRequest(
+            const fullResponse = await sendSocketChatRequest(
                 selectedTopic,
                 selectedLanguage,
                 selectedModel,
@@ -114,7 +121,8 @@ function App() {
                     setLoadingStage('generating');
                     setCurrentStreamingMessage(prev => prev + chunk);
                 },
-                apiKey
+                apiKey,
+                sessionId
             );
 
             const endTime = performance.now();
@@ -143,22 +151,26 @@ function App() {
 
         setIsLoadingQuiz(true);
         setShowQuiz(false);
+        setQuizQuestions([]);
 
         try {
             if (!apiKey) {
                 throw new Error("Please enter your Google Gemini API key in the settings panel.");
             }
 
-            const quizData = await getQuiz(
+            // Show the quiz as soon as the first question arrives; the rest
+            // are appended while they are still being generated
+            await streamSocketQuiz(
                 selectedTopic,
                 selectedLanguage,
                 selectedModel,
                 selectedFamiliarityLevel,
+                (question) => {
+                    setQuizQuestions(prev => [...prev, question]);
+                    setShowQuiz(true);
+                },
                 apiKey
             );
-
-            setQuizQuestions(quizData.questions);
-            setShowQuiz(true);
         } catch (error) {
             console.error('Failed to generate quiz:', error);
             // Show error message to user
@@ -293,6 +305,7 @@ function App() {
                         {showQuiz && quizQuestions.length > 0 && (
                             <Quiz
                                 questions={quizQuestions}
+                                isGenerating={isLoadingQuiz}
                                 onClose={() => setShowQuiz(false)}
                             />
                         )}
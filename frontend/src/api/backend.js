@@ -48,31 +48,221 @@ export const getQuiz = async (topic, language, model, familiarityLevel, apiKey)
     }
 };
 
-export const sendStreamingChatRequest = async (topic, language, model, query, familiarityLevel, conversationMode, onChunk, apiKey) => {
+// One WebSocket to /api/ws carries every chat turn, quiz and quota check,
+// each tagged with a request id; events come back tagged with the same id
+const SOCKET_URL = API_BASE_URL.replace(/^http/, 'ws') + '/ws';
+
+class TutorSocket {
+    constructor(url) {
+        this.url = url;
+        this.socket = null;
+        this.opening = null;
+        this.nextId = 1;
+        this.pending = new Map();
+    }
+
+    // Resolves with an open socket, reconnecting if the last one closed
+    connect() {
+        if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+            return Promise.resolve(this.socket);
+        }
+        if (this.opening) return this.opening;
+
+        this.opening = new Promise((resolve, reject) => {
+            const socket = new WebSocket(this.url);
+            socket.onopen = () => {
+                this.socket = socket;
+                this.opening = null;
+                resolve(socket);
+            };
+            socket.onerror = () => {
+                this.opening = null;
+                reject(new Error('Could not connect to the tutor socket'));
+            };
+            socket.onmessage = (message) => {
+                const event = JSON.parse(message.data);
+                const request = this.pending.get(event.id);
+                if (request) request.onEvent(event);
+            };
+            socket.onclose = () => {
+                this.socket = null;
+                this.pending.forEach(request => request.reject(new Error('Connection closed')));
+                this.pending.clear();
+            };
+        });
+        return this.opening;
+    }
+
+    // Send one request; onEvent sees every event for it. Resolves on "done"
+    // or "quota", rejects on "error". Aborting the signal cancels the
+    // request, including its generation on the server.
+    async request(type, payload, onEvent, signal) {
+        const socket = await this.connect();
+        const id = `r${this.nextId++}`;
+        return new Promise((resolve, reject) => {
+            const finish = () => {
+                this.pending.delete(id);
+                if (signal) signal.removeEventListener('abort', abort);
+            };
+            const abort = () => {
+                finish();
+                if (socket.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({ id, type: 'cancel' }));
+                }
+                reject(new DOMException('Request cancelled', 'AbortError'));
+            };
+            this.pending.set(id, {
+                reject: (error) => { finish(); reject(error); },
+                onEvent: (event) => {
+                    if (event.type === 'error') {
+                        finish();
+                        reject(new Error(event.error));
+                        return;
+                    }
+                    onEvent(event);
+                    if (event.type === 'done' || event.type === 'quota') {
+                        finish();
+                        resolve(event);
+                    }
+                }
+            });
+            if (signal) {
+                if (signal.aborted) return abort();
+                signal.addEventListener('abort', abort);
+            }
+            socket.send(JSON.stringify({ id, type, ...payload }));
+        });
+    }
+}
+
+export const tutorSocket = new TutorSocket(SOCKET_URL);
+
+// Read a Server-Sent Events response body, calling onEvent(eventType, payload) per event
+const readEventStream = async (response, onEvent) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    // Server-Sent Events are separated by a blank line
+    const handleEvent = (rawEvent) => {
+        let eventType = 'message';
+        let data = '';
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                eventType = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                data += line.slice(5).trim();
+            }
+        });
+        if (!data) return;
+        onEvent(eventType, JSON.parse(data));
+    };
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let separatorIndex;
+        while ((separatorIndex = buffer.indexOf('\n\n')) !== -1) {
+            const rawEvent = buffer.slice(0, separatorIndex);
+            buffer = buffer.slice(separatorIndex + 2);
+            handleEvent(rawEvent);
+        }
+    }
+    if (buffer.trim()) {
+        handleEvent(buffer);
+    }
+};
+
+const chatPayload = (topic, language, model, query, familiarityLevel, conversationMode, apiKey, sessionId) => ({
+    topic,
+    language,
+    model,
+    query,
+    familiarity_level: familiarityLevel,
+    conversation_mode: conversationMode,
+    api_key: apiKey,
+    session_id: sessionId
+});
+
+// The socket versions fall back to the Server-Sent Events endpoints when
+// the WebSocket can't be opened, e.g. behind a proxy that doesn't upgrade
+export const sendSocketChatRequest = async (topic, language, model, query, familiarityLevel, conversationMode, onChunk, apiKey, sessionId, signal) => {
     try {
-        const response = await axios.post(`${API_BASE_URL}/chat`, {
-            topic,
-            language,
-            model,
-            query,
-            familiarity_level: familiarityLevel,
-            conversation_mode: conversationMode,
-            api_key: apiKey
+        await tutorSocket.connect();
+    } catch (error) {
+        return sendStreamingChatRequest(topic, language, model, query, familiarityLevel, conversationMode, onChunk, apiKey, sessionId);
+    }
+    let fullResponse = '';
+    await tutorSocket.request(
+        'chat',
+        chatPayload(topic, language, model, query, familiarityLevel, conversationMode, apiKey, sessionId),
+        (event) => {
+            if (event.text) {
+                fullResponse += event.text;
+                onChunk(event.text);
+            }
+        },
+        signal
+    );
+    return fullResponse;
+};
+
+export const streamSocketQuiz = async (topic, language, model, familiarityLevel, onQuestion, apiKey, signal) => {
+    try {
+        await tutorSocket.connect();
+    } catch (error) {
+        return streamQuiz(topic, language, model, familiarityLevel, onQuestion, apiKey);
+    }
+    const questions = [];
+    await tutorSocket.request(
+        'quiz',
+        chatPayload(topic, language, model, "", familiarityLevel, "Informative", apiKey),
+        (event) => {
+            if (event.question) {
+                questions.push(event.question);
+                onQuestion(event.question);
+            }
+        },
+        signal
+    );
+    return questions;
+};
+
+export const sendStreamingChatRequest = async (topic, language, model, query, familiarityLevel, conversationMode, onChunk, apiKey, sessionId) => {
+    try {
+        // axios can't read a response body incrementally in the browser, so use fetch here
+        const response = await fetch(`${API_BASE_URL}/chat/stream`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                topic,
+                language,
+                model,
+                query,
+                familiarity_level: familiarityLevel,
+                conversation_mode: conversationMode,
+                api_key: apiKey,
+                session_id: sessionId
+            })
         });
 
-        // Simulate streaming by sending chunks of the response
-        const fullResponse = response.data.response;
-        const chunkSize = 5; // Number of characters per chunk
-        let currentIndex = 0;
-
-        while (currentIndex < fullResponse.length) {
-            const chunk = fullResponse.slice(currentIndex, currentIndex + chunkSize);
-            onChunk(chunk);
-            currentIndex += chunkSize;
-            // Add a small delay between chunks to simulate streaming
-            await new Promise(resolve => setTimeout(resolve, 50));
+        if (!response.ok) {
+            throw new Error(`Streaming request failed with status ${response.status}`);
         }
 
+        let fullResponse = '';
+        await readEventStream(response, (eventType, payload) => {
+            if (eventType === 'error') {
+                throw new Error(payload.error);
+            }
+            if (payload.text) {
+                fullResponse += payload.text;
+                onChunk(payload.text);
+            }
+        });
+
         return fullResponse;
     } catch (error) {
         console.error('Error in chat request:', error);
@@ -80,6 +270,45 @@ export const sendStreamingChatRequest = async (topic, language, model, query, fa
     }
 };
 
+export const streamQuiz = async (topic, language, model, familiarityLevel, onQuestion, apiKey) => {
+    try {
+        const response = await fetch(`${API_BASE_URL}/quiz/stream`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                topic,
+                language,
+                model,
+                query: "", // Not used for quiz generation but required by the API
+                familiarity_level: familiarityLevel,
+                conversation_mode: "Informative", // Default mode for quiz
+                api_key: apiKey
+            })
+        });
+
+        if (!response.ok) {
+            throw new Error(`Quiz stream failed with status ${response.status}`);
+        }
+
+        // Each question arrives as its own event as soon as it is generated
+        const questions = [];
+        await readEventStream(response, (eventType, payload) => {
+            if (eventType === 'error') {
+                throw new Error(payload.error);
+            }
+            if (payload.question) {
+                questions.push(payload.question);
+                onQuestion(payload.question);
+            }
+        });
+
+        return questions;
+    } catch (error) {
+        console.error('Error streaming quiz:', error);
+        throw error;
+    }
+};
+
 export const sendMessage = async (topic, language, model, query, familiarityLevel, conversationMode, apiKey) => {
     try {
         const response = await axios.post(`${API_BASE_URL}/chat`, {
@@ -109,3 +338,8 @@ export const checkApiKeyQuota = async (apiKey) => {
         throw error;
     }
 };
+
+export const checkSocketQuota = async (apiKey) => {
+    const { used, limit, error } = await tutorSocket.request('quota', { api_key: apiKey }, () => {});
+    return { used, limit, error };
+};
@@ -1,4 +1,4 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
 import {
     Box,
     Typography,
@@ -12,14 +12,15 @@ import {
     Divider,
     Collapse,
     IconButton,
-    Pagination
+    Pagination,
+    LinearProgress
 } from '@mui/material';
 import ExpandMoreIcon from '@mui/icons-material/ExpandMore';
 import ExpandLessIcon from '@mui/icons-material/ExpandLess';
 
 const QUESTIONS_PER_PAGE = 5;
 
-const Quiz = ({ questions = [], onClose }) => {
+const Quiz = ({ questions = [], isGenerating = false, onClose }) => {
     // Check if questions is valid and not empty
     const hasValidQuestions = Array.isArray(questions) && questions.length > 0;
 
@@ -29,6 +30,13 @@ const Quiz = ({ questions = [], onClose }) => {
     const [expandedQuestions, setExpandedQuestions] = useState({});
     const [currentPage, setCurrentPage] = useState(1);
 
+    // Questions can keep arriving after the quiz is shown; give each new one an empty answer
+    useEffect(() => {
+        if (answers.length < questions.length) {
+            setAnswers(prev => [...prev, ...Array(questions.length - prev.length).fill(null)]);
+        }
+    }, [questions.length, answers.length]);
+
     // Only calculate pagination if we have valid questions
     const totalPages = hasValidQuestions ? Math.ceil(questions.length / QUESTIONS_PER_PAGE) : 0;
     const startIndex = (currentPage - 1) * QUESTIONS_PER_PAGE;
@@ -97,8 +105,17 @@ const Quiz = ({ questions = [], onClose }) => {
 
             <Divider sx={{ mb: 3 }} />
 
+            {isGenerating && (
+                <Box sx={{ mb: 3 }}>
+                    <Typography variant="body2" color="text.secondary" gutterBottom>
+                        Generating more questions...
+                    </Typography>
+                    <LinearProgress />
+                </Box>
+            )}
+
             {/* Display error message if no valid questions */}
-            {!hasValidQuestions && (
+            {!hasValidQuestions && !isGenerating && (
                 <Alert
                     severity="error"
                     sx={{ mb: 3 }}
@@ -162,7 +179,7 @@ const Quiz = ({ questions = [], onClose }) => {
 
                         <FormControl component="fieldset" sx={{ width: '100%' }}>
                             <RadioGroup
-                                value={answers[questionIndex] !== null ? answers[questionIndex].toString() : ''}
+                                value={answers[questionIndex] != null ? answers[questionIndex].toString() : ''}
                                 onChange={(e) => handleAnswerChange(questionIndex, e.target.value)}
                             >
                                 {question.options.map((option, optionIndex) => (
@@ -260,7 +277,7 @@ const Quiz = ({ questions = [], onClose }) => {
                         variant="contained"
                         color="primary"
                         onClick={handleSubmit}
-                        disabled={answers.includes(null)}
+                        disabled={isGenerating || answers.length < questions.length || answers.includes(null)}
                     >
                         Submit Answers
                     </Button>